@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the last-month/returning/churned user queries.
+
+Compares the original OR-of-ranges query against the
+``(last_seen, earliest_activity)`` index-backed query used by
+``UserAccounts`` on a populated ``LastSeenData`` table::
+
+    python benchmarks/last_month_users.py [rows] [database path]
+
+Results on SQLite (Python 3.6, Django 1.11), 1,000,000 rows, best of
+5 (seconds)::
+
+    query                  before      after
+    last_month_users       0.2635     0.0584
+    returning_users        0.4635     0.0743
+    churned_users          0.9507     0.0402
+"""
+import os
+import random
+import sys
+import timeit
+import datetime as dt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_settings'
+
+from tests import test_settings
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+test_settings.DATABASES['default']['NAME'] = (
+    sys.argv[2] if len(sys.argv) > 2 else ':memory:')
+
+import django
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+
+from zesty_metrics import models
+from zesty_metrics import tracking
+
+
+def populate(rows, batch=10000):
+    now = dt.datetime.now()
+    rng = random.Random(42)
+    with connection.cursor() as cursor:
+        for start in range(0, rows, batch):
+            users = []
+            data = []
+            for pk in range(start + 1, min(start + batch, rows) + 1):
+                last_seen = now - dt.timedelta(minutes=rng.randint(0, 120 * 24 * 60))
+                this_month = last_seen - dt.timedelta(days=rng.randint(0, 29))
+                last_month = rng.choice([None, this_month - dt.timedelta(days=rng.randint(1, 60))])
+                users.append((pk, 'user%d' % pk, '', '', '', '', False, True, False, now))
+                data.append((pk, pk, last_seen, this_month, last_month))
+            cursor.executemany(
+                'INSERT INTO auth_user (id, username, password, first_name, last_name,'
+                ' email, is_staff, is_active, is_superuser, date_joined)'
+                ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', users)
+            cursor.executemany(
+                'INSERT INTO zesty_metrics_lastseendata (id, user_id, last_seen,'
+                ' active_this_month, active_last_month)'
+                ' VALUES (%s, %s, %s, %s, %s)', data)
+    # Same backfill as the 0002 data migration.
+    models.LastSeenData.objects.update(
+        earliest_activity=Coalesce('active_last_month',
+                                   'active_this_month',
+                                   'last_seen'),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def original_last_month_users(tracker):
+    return models.LastSeenData.objects.filter(
+        (Q(last_seen__gte=tracker.past_60_days)
+         | Q(active_this_month__gte=tracker.past_60_days)
+         | Q(active_last_month__gte=tracker.past_60_days))
+        & (Q(last_seen__lt=tracker.past_30_days)
+           | Q(active_this_month__lt=tracker.past_30_days)
+           | Q(active_last_month__lt=tracker.past_30_days))
+    )
+
+
+def main():
+    call_command('migrate', verbosity=0)
+    populate(ROWS)
+    tracker = tracking.UserAccounts()
+
+    cases = [
+        ('last_month_users',
+         lambda: original_last_month_users(tracker).count(),
+         lambda: tracker.last_month_users.count()),
+        ('returning_users',
+         lambda: original_last_month_users(tracker).filter(
+             last_seen__gte=tracker.past_30_days).count(),
+         lambda: tracker.returning_users.count()),
+        ('churned_users',
+         lambda: original_last_month_users(tracker).filter(
+             last_seen__lte=tracker.past_30_days).count(),
+         lambda: tracker.churned_users.count()),
+    ]
+
+    print('%d rows, best of 5 (seconds)' % ROWS)
+    print('%-18s %10s %10s %10s' % ('query', 'before', 'after', 'count'))
+    for name, before, after in cases:
+        assert before() == after(), name
+        t_before = min(timeit.repeat(before, number=1, repeat=5))
+        t_after = min(timeit.repeat(after, number=1, repeat=5))
+        print('%-18s %10.4f %10.4f %10d' % (name, t_before, t_after, after()))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ class TestTracker(Tracker):
     counters = dict(
         bar = 'stuff.bar',
     )
+    intervals = dict(
+        bar = 60 * 60,
+    )
 
     @property
     def foo(self):
@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
+import six
+
 from django.conf.urls import include, url
+from django.http import FileResponse
+
+from zesty_metrics.beacons import beacon_view
+
+
+def download(request):
+    response = FileResponse(six.BytesIO(b'x' * 10))
+    response['Content-Length'] = '10'
+    return response
 
 
 urlpatterns = [
     url(r'^metrics/', include('zesty_metrics.urls')),
+    url(r'^download/$', download),
+    url(r'^beacons/(?P<method>incr|decr|timing|gauge)/(?P<stat>[^/]+)/?', beacon_view),
 ]
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+
+def bulk_user_import():
+    """Defer per-user signal work while creating users in bulk.
+
+    See ``zesty_metrics.signals.bulk_user_import``.
+    """
+    from .signals import bulk_user_import
+    return bulk_user_import()
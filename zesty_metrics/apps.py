@@ -7,3 +7,8 @@ class ZestyMetricsConfig(AppConfig):
 
     def ready(self):
         import zesty_metrics.signals
+
+        from . import conf
+        if conf.TIME_TEMPLATES:
+            from . import rendering
+            rendering.install()
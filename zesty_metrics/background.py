@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Run the middleware's side effects off the request path.
+
+With ``ZESTY_BACKGROUND_WORKERS`` set, ``MetricsMiddleware`` hands the
+``LastSeenData`` update, sending the request's stats and the RUM cache
+write to a small pool of threads instead of doing them before returning
+the response. The queue holds at most ``ZESTY_BACKGROUND_QUEUE_SIZE``
+tasks; when it's full, tasks are dropped rather than blocking requests,
+and counted in the ``background.dropped`` stat. At exit, workers finish
+everything already queued, for up to ``ZESTY_BACKGROUND_DRAIN_TIMEOUT``
+seconds.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+from six.moves import queue
+
+from . import clients
+from . import conf
+
+logger = logging.getLogger('metrics')
+
+_STOP = object()
+
+
+class Executor(object):
+    """A bounded queue of ``(func, args, kwargs)`` and the threads running them.
+    """
+    def __init__(self, workers, size):
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.unreported = 0
+        self.closed = False
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work,
+                                      name='zesty-metrics-background-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call. Returns False if it was dropped.
+
+        After ``shutdown`` calls run inline, so late ones aren't lost.
+        """
+        if self.closed:
+            func(*args, **kwargs)
+            return True
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.unreported += 1
+            return False
+        return True
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is _STOP:
+                    return
+                func, args, kwargs = task
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logger.exception('Exception occurred in a background task.')
+                finally:
+                    # Like the end of a request: don't keep broken or
+                    # expired connections around in this thread.
+                    close_old_connections()
+                self.report_dropped()
+            finally:
+                self.queue.task_done()
+
+    def report_dropped(self):
+        with self.lock:
+            count, self.unreported = self.unreported, 0
+        if count:
+            try:
+                clients.get_client().incr('background.dropped', count)
+            except Exception:
+                logger.exception('Exception occurred while logging to statsd.')
+
+    def shutdown(self, timeout=None):
+        """Run everything queued, then stop the workers.
+        """
+        self.closed = True
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.time())
+
+        try:
+            for thread in self.threads:
+                self.queue.put(_STOP, timeout=remaining())
+        except queue.Full:
+            # Workers are stuck; don't hold up the exit past the deadline.
+            logger.warning('Background tasks still queued at shutdown were dropped.')
+        for thread in self.threads:
+            thread.join(remaining())
+        self.report_dropped()
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """Return this process's ``Executor``, or ``None`` if disabled.
+    """
+    global _executor
+    if not conf.BACKGROUND_WORKERS:
+        return None
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = Executor(conf.BACKGROUND_WORKERS,
+                                     conf.BACKGROUND_QUEUE_SIZE)
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func`` in the background if enabled, else right away.
+    """
+    executor = get_executor()
+    if executor is None:
+        func(*args, **kwargs)
+    else:
+        executor.submit(func, *args, **kwargs)
+
+
+@atexit.register
+def drain():
+    """Finish queued tasks before the process exits.
+    """
+    if _executor is not None:
+        _executor.shutdown(conf.BACKGROUND_DRAIN_TIMEOUT)
+
+
+@clients.after_fork
+def reset():
+    """Drop the parent's executor; its threads didn't survive the fork.
+    """
+    global _executor, _lock
+    _lock = threading.Lock()
+    _executor = None
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Fast path for the incr/decr/timing/gauge beacons.
+
+These are the highest-volume endpoints, and all they do is parse a
+couple of numbers. ``beacon_view`` does that directly instead of going
+through ``ProcessFormView`` and Django forms, and sends with the shared
+client. ``BeaconApplication`` answers beacons at the WSGI layer, before
+Django's middleware and URL resolution. Both keep the semantics of
+``views.StatView``: the same defaults, validation and error payloads,
+a transparent PNG for GET and an empty 204 for POST.
+"""
+import json
+import math
+import re
+
+from django.core.handlers.wsgi import get_bytes_from_wsgi, get_path_info
+from django.http import HttpResponse, HttpResponseNotAllowed, QueryDict
+from django.views.decorators.csrf import csrf_exempt
+
+from . import clients
+from . import prometheus
+from . import tagging
+from .registry import default_registry
+from .views import TRANSPARENT_1X1_PNG
+
+REQUIRED = 'This field is required.'
+NOT_AN_INTEGER = 'Enter a whole number.'
+NOT_A_NUMBER = 'Enter a number.'
+
+_trailing_decimal = re.compile(r'\.0*\s*$')
+
+
+def parse_integer(value):
+    """Parse like ``forms.IntegerField``; ``None`` for empty values.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        return int(_trailing_decimal.sub('', value))
+    except (ValueError, TypeError):
+        raise ValueError(NOT_AN_INTEGER)
+
+
+def parse_float(value):
+    """Parse like ``forms.FloatField``; ``None`` for empty values.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        result = float(value)
+    except (ValueError, TypeError):
+        raise ValueError(NOT_A_NUMBER)
+    if math.isnan(result) or math.isinf(result):
+        raise ValueError(NOT_A_NUMBER)
+    return result
+
+
+def parse_boolean(value):
+    """Parse like an optional ``forms.BooleanField`` with a checkbox.
+    """
+    if value is None or value.lower() == 'false':
+        return False
+    return bool(value)
+
+
+# (name, parser, required, default) for each field of each stat method;
+# mirrors forms.CountForm, forms.TimingForm and forms.GaugeForm.
+FIELDS = {
+    'incr': (('rate', parse_float, False, 1.0),
+             ('count', parse_integer, False, 1)),
+    'decr': (('rate', parse_float, False, 1.0),
+             ('count', parse_integer, False, 1)),
+    'timing': (('delta', parse_integer, True, None),),
+    'gauge': (('value', parse_float, True, None),
+              ('delta', parse_boolean, False, False)),
+}
+
+
+def clean(method, params):
+    """Validate beacon parameters.
+
+    Returns ``(data, errors)``; ``errors`` is shaped like ``form.errors``.
+    """
+    data = {}
+    errors = {}
+    for name, parse, required, default in FIELDS[method]:
+        try:
+            value = parse(params.get(name))
+        except ValueError as e:
+            errors[name] = [str(e)]
+            continue
+        if value is None:
+            if required:
+                errors[name] = [REQUIRED]
+                continue
+            value = default
+        data[name] = value
+    return data, errors
+
+
+def send(method, stat, data, tags=None, registry=default_registry):
+    client = clients.get_client()
+    tagged, folded = registry.resolve(stat, tagging.tag_stat(stat, tags))
+    if folded is not None:
+        client.incr('stats.' + folded)
+        stat = tagged
+    getattr(client, method)(tagged, **data)
+    prometheus.record_stat(method, stat, **data)
+
+
+def handle(method, stat, http_method, params):
+    """Handle a beacon. Returns ``(status, body, content type)``.
+    """
+    data, errors = clean(method, params)
+    if errors:
+        return 400, json.dumps(errors).encode('utf-8'), 'text/html; charset=utf-8'
+    send(method, stat, data, tagging.client_tags(params.get('tags')))
+    if http_method == 'POST':
+        return 204, b'', 'text/html; charset=utf-8'
+    return 200, TRANSPARENT_1X1_PNG, 'image/png'
+
+
+@csrf_exempt
+def beacon_view(request, method, stat):
+    """Drop-in replacement for ``IncrView``, ``DecrView``, ``TimingView``
+    and ``GaugeView``; ``method`` is the stat method.
+    """
+    if request.method not in ('GET', 'POST'):
+        return HttpResponseNotAllowed(['GET', 'POST'])
+    params = request.GET if request.method == 'GET' else request.POST
+    status, body, content_type = handle(method, stat, request.method, params)
+    return HttpResponse(body, status=status, content_type=content_type)
+
+
+class BeaconApplication(object):
+    """WSGI wrapper that answers beacons without entering Django.
+
+    Usage, in ``wsgi.py``::
+
+        application = BeaconApplication(get_wsgi_application())
+
+    ``prefix`` is where ``zesty_metrics.urls`` is mounted. Requests it
+    can't handle cheaply (other methods, non-urlencoded bodies) are
+    passed through to ``application``.
+    """
+    STATUS = {
+        200: '200 OK',
+        204: '204 No Content',
+        400: '400 Bad Request',
+    }
+
+    def __init__(self, application, prefix='/metrics/'):
+        self.application = application
+        self.pattern = re.compile(r'%s(%s)/([^/]+)/?' % (
+            re.escape(prefix), '|'.join(sorted(FIELDS))))
+
+    def __call__(self, environ, start_response):
+        match = self.pattern.match(get_path_info(environ))
+        http_method = environ.get('REQUEST_METHOD', '').upper()
+        if match is None:
+            return self.application(environ, start_response)
+
+        if http_method == 'GET':
+            params = QueryDict(get_bytes_from_wsgi(environ, 'QUERY_STRING', ''))
+        elif (http_method == 'POST' and environ.get('CONTENT_TYPE', '')
+              .startswith('application/x-www-form-urlencoded')):
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            params = QueryDict(environ['wsgi.input'].read(length) if length else '')
+        else:
+            return self.application(environ, start_response)
+
+        method, stat = match.groups()
+        status, body, content_type = handle(method, stat, http_method, params)
+        start_response(self.STATUS[status], [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
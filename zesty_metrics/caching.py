@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Cache backend that measures another cache.
+
+Wrap any configured cache to get its hit rate and latency::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'zesty_metrics.caching.InstrumentedCache',
+            'LOCATION': 'redis',
+        },
+        'redis': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': 'redis://127.0.0.1:6379/1',
+        },
+    }
+
+``LOCATION`` is the alias of the wrapped cache. Calls are counted and
+timed in process, per operation and key prefix, and sent every
+``ZESTY_CACHE_FLUSH_INTERVAL`` seconds as:
+
+- ``cache.<name>.<prefix>.hits`` and ``.misses``
+- ``cache.<name>.<prefix>.<operation>``, the mean time of the calls,
+  and ``cache.<name>.<prefix>.<operation>.calls``
+
+``<name>`` is ``OPTIONS['NAME']``, by default the wrapped alias. A key's
+prefix is the longest of ``OPTIONS['PREFIXES']`` (plus this package's
+own) it starts with, else what comes before its first ``:``, else
+``other``. At most ``OPTIONS['PREFIX_LIMIT']`` (default 100) distinct
+prefixes are reported; the rest are counted as ``other``.
+"""
+import threading
+import time
+
+from django.core.cache.backends.base import BaseCache
+
+from . import clients
+from . import conf
+from .registry import StatNameRegistry, stat_name
+
+# Key prefixes used by this package.
+PREFIXES = (
+    'zesty_metric_',
+    'zesty_signups_',
+    'zesty_prometheus_',
+    'request:',
+)
+
+MISSING = object()
+
+
+class InstrumentedCache(BaseCache):
+    def __init__(self, location, params):
+        super(InstrumentedCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.alias = location
+        self.name = options.get('NAME', location)
+        self.prefixes = sorted(PREFIXES + tuple(options.get('PREFIXES', ())),
+                               key=len, reverse=True)
+        self.registry = StatNameRegistry(limit=options.get('PREFIX_LIMIT', 100),
+                                         window=float('inf'), other='other')
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.next_flush = time.time() + conf.CACHE_FLUSH_INTERVAL
+        self._cache = None
+
+    @property
+    def cache(self):
+        # Looked up on first use; the wrapped cache may not be set up yet.
+        if self._cache is None:
+            from django.core.cache import caches
+            self._cache = caches[self.alias]
+        return self._cache
+
+    def prefix(self, key):
+        for prefix in self.prefixes:
+            if key.startswith(prefix):
+                break
+        else:
+            prefix = key.split(':', 1)[0] if ':' in key else 'other'
+        return self.registry.resolve(stat_name(prefix))[0]
+
+    def prefix_of(self, keys):
+        prefixes = set(self.prefix(key) for key in keys)
+        return prefixes.pop() if len(prefixes) == 1 else 'mixed'
+
+    def record(self, operation, prefix, elapsed, hits=0, misses=0):
+        now = time.time()
+        with self.lock:
+            stat = self.stats.get((prefix, operation))
+            if stat is None:
+                stat = self.stats[(prefix, operation)] = [0, 0.0, 0, 0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] += hits
+            stat[3] += misses
+            if now < self.next_flush:
+                return
+            self.next_flush = now + conf.CACHE_FLUSH_INTERVAL
+            stats, self.stats = self.stats, {}
+        self.flush(stats)
+
+    def flush(self, stats=None):
+        """Send the counts and mean times aggregated since the last flush.
+        """
+        if stats is None:
+            with self.lock:
+                stats, self.stats = self.stats, {}
+        pipeline = clients.get_pipeline()
+        lookups = {}
+        for (prefix, operation), (calls, total, hits, misses) in sorted(stats.items()):
+            name = 'cache.%s.%s' % (self.name, prefix)
+            pipeline.timing('%s.%s' % (name, operation), total / calls)
+            pipeline.incr('%s.%s.calls' % (name, operation), calls)
+            counts = lookups.setdefault(name, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+        for name, (hits, misses) in sorted(lookups.items()):
+            if hits:
+                pipeline.incr(name + '.hits', hits)
+            if misses:
+                pipeline.incr(name + '.misses', misses)
+        try:
+            pipeline.send()
+        except (AttributeError, IndexError):
+            # Not a pipeline, or nothing to send.
+            pass
+
+    def timed(self, operation, key, func, *args, **kwargs):
+        started = time.time()
+        result = func(*args, **kwargs)
+        self.record(operation, self.prefix(key), time.time() - started)
+        return result
+
+    def get(self, key, default=None, version=None):
+        started = time.time()
+        value = self.cache.get(key, MISSING, version=version)
+        hit = value is not MISSING
+        self.record('get', self.prefix(key), time.time() - started,
+                    hits=int(hit), misses=int(not hit))
+        return value if hit else default
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        started = time.time()
+        values = self.cache.get_many(keys, version=version)
+        self.record('get_many', self.prefix_of(keys), time.time() - started,
+                    hits=len(values), misses=len(keys) - len(values))
+        return values
+
+    def set(self, key, value, timeout=MISSING, version=None):
+        kwargs = {'version': version}
+        if timeout is not MISSING:
+            kwargs['timeout'] = timeout
+        return self.timed('set', key, self.cache.set, key, value, **kwargs)
+
+    def add(self, key, value, timeout=MISSING, version=None):
+        kwargs = {'version': version}
+        if timeout is not MISSING:
+            kwargs['timeout'] = timeout
+        return self.timed('add', key, self.cache.add, key, value, **kwargs)
+
+    def set_many(self, data, timeout=MISSING, version=None):
+        kwargs = {'version': version}
+        if timeout is not MISSING:
+            kwargs['timeout'] = timeout
+        started = time.time()
+        result = self.cache.set_many(data, **kwargs)
+        self.record('set_many', self.prefix_of(data), time.time() - started)
+        return result
+
+    def delete(self, key, version=None):
+        return self.timed('delete', key, self.cache.delete, key, version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        started = time.time()
+        result = self.cache.delete_many(keys, version=version)
+        self.record('delete_many', self.prefix_of(keys), time.time() - started)
+        return result
+
+    def incr(self, key, delta=1, version=None):
+        return self.timed('incr', key, self.cache.incr, key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        return self.timed('decr', key, self.cache.decr, key, delta, version=version)
+
+    def has_key(self, key, version=None):
+        return self.cache.has_key(key, version=version)
+
+    def make_key(self, key, version=None):
+        return self.cache.make_key(key, version=version)
+
+    def validate_key(self, key):
+        return self.cache.validate_key(key)
+
+    def clear(self):
+        return self.cache.clear()
+
+    def close(self, **kwargs):
+        return self.cache.close(**kwargs)
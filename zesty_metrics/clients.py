@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Lazily created, fork-safe StatsD clients.
+
+Nothing here opens a socket at import time, so preforking servers
+(e.g. ``gunicorn --preload``) don't share one across workers. Clients
+are dropped in the child after ``os.fork()``: automatically on Python
+3.7+, and on older Pythons by calling ``reset()`` from the server's
+post-fork hook.
+"""
+import os
+
+import statsd
+from statsd.client import Pipeline
+
+from . import conf
+from . import tagging
+
+_client = None
+_pid = None
+_after_fork = []
+
+
+class DogStatsdMixin(object):
+    """Send DogStatsD tags, carried in the stat name, after the value.
+    """
+    def _prepare(self, stat, value, rate):
+        stat, sep, tags = stat.partition(tagging.DOGSTATSD_TAGS)
+        data = super(DogStatsdMixin, self)._prepare(stat, value, rate)
+        if data is not None and sep:
+            data += sep + tags
+        return data
+
+
+class TaggedPipeline(DogStatsdMixin, Pipeline):
+    pass
+
+
+class TaggedStatsClient(DogStatsdMixin, statsd.StatsClient):
+    """``StatsClient`` for ``ZESTY_TAG_FORMAT = 'dogstatsd'``.
+    """
+    def pipeline(self):
+        return TaggedPipeline(self)
+
+
+def get_client():
+    """Return this process's shared ``StatsClient``, creating it on first use.
+    """
+    global _client, _pid
+    if _client is None or _pid != os.getpid():
+        client_class = statsd.StatsClient
+        if conf.TAG_FORMAT == 'dogstatsd':
+            client_class = TaggedStatsClient
+        _client = client_class(
+            host = conf.HOST,
+            port = conf.PORT,
+            prefix = conf.PREFIX,
+        )
+        _pid = os.getpid()
+    return _client
+
+
+def get_pipeline(client=None):
+    """Return a new pipeline on ``client`` (default: the shared client).
+    """
+    if client is None:
+        client = get_client()
+    try:
+        return client.pipeline()
+    except AttributeError:
+        # In case we're using an older statsd version.
+        return client
+
+
+def after_fork(func):
+    """Register ``func`` to run in the child process after a fork.
+    """
+    _after_fork.append(func)
+    return func
+
+
+def reset():
+    """Drop every client created before a fork.
+    """
+    global _client, _pid
+    _client = _pid = None
+    for func in _after_fork:
+        func()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
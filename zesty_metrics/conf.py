@@ -8,6 +8,14 @@ PORT = statsd.port
 PREFIX = statsd.prefix
 TIME_RESPONSES = getattr(settings, 'ZESTY_TIME_RESPONSES',
                          defaults.ZESTY_TIME_RESPONSES)
+TIME_TEMPLATES = getattr(settings, 'ZESTY_TIME_TEMPLATES',
+                         defaults.ZESTY_TIME_TEMPLATES)
+LATENCY_BREAKDOWN = getattr(settings, 'ZESTY_LATENCY_BREAKDOWN',
+                            defaults.ZESTY_LATENCY_BREAKDOWN)
+QUEUE_TIME_HEADERS = getattr(settings, 'ZESTY_QUEUE_TIME_HEADERS',
+                             defaults.ZESTY_QUEUE_TIME_HEADERS)
+QUEUE_TIME_FORMAT = getattr(settings, 'ZESTY_QUEUE_TIME_FORMAT',
+                            defaults.ZESTY_QUEUE_TIME_FORMAT)
 
 TIMING_SAMPLE_RATE = getattr(settings, 'ZESTY_TIMING_SAMPLE_RATE',
                              defaults.ZESTY_TIMING_SAMPLE_RATE)
@@ -16,3 +24,77 @@ TRACKING_CLASSES = getattr(settings, 'ZESTY_TRACKING_CLASSES',
 
 TRACK_USER_ACTIVITY = getattr(settings, 'ZESTY_TRACK_USER_ACTIVITY',
                               defaults.ZESTY_TRACK_USER_ACTIVITY)
+
+TAG_FORMAT = getattr(settings, 'ZESTY_TAG_FORMAT', defaults.ZESTY_TAG_FORMAT)
+
+BACKGROUND_WORKERS = getattr(settings, 'ZESTY_BACKGROUND_WORKERS',
+                             defaults.ZESTY_BACKGROUND_WORKERS)
+BACKGROUND_QUEUE_SIZE = getattr(settings, 'ZESTY_BACKGROUND_QUEUE_SIZE',
+                                defaults.ZESTY_BACKGROUND_QUEUE_SIZE)
+BACKGROUND_DRAIN_TIMEOUT = getattr(settings, 'ZESTY_BACKGROUND_DRAIN_TIMEOUT',
+                                   defaults.ZESTY_BACKGROUND_DRAIN_TIMEOUT)
+
+TRACKER_CONCURRENCY = getattr(settings, 'ZESTY_TRACKER_CONCURRENCY',
+                              defaults.ZESTY_TRACKER_CONCURRENCY)
+
+REPORT_INTERVAL = getattr(settings, 'ZESTY_REPORT_INTERVAL',
+                          defaults.ZESTY_REPORT_INTERVAL)
+REPORT_JITTER = getattr(settings, 'ZESTY_REPORT_JITTER',
+                        defaults.ZESTY_REPORT_JITTER)
+REPORT_LOCK = getattr(settings, 'ZESTY_REPORT_LOCK', defaults.ZESTY_REPORT_LOCK)
+
+ALLOWED_STATS = getattr(settings, 'ZESTY_ALLOWED_STATS',
+                        defaults.ZESTY_ALLOWED_STATS)
+ALLOWED_TAGS = getattr(settings, 'ZESTY_ALLOWED_TAGS',
+                       defaults.ZESTY_ALLOWED_TAGS)
+STAT_CARDINALITY_LIMIT = getattr(settings, 'ZESTY_STAT_CARDINALITY_LIMIT',
+                                 defaults.ZESTY_STAT_CARDINALITY_LIMIT)
+STAT_CARDINALITY_WINDOW = getattr(settings, 'ZESTY_STAT_CARDINALITY_WINDOW',
+                                  defaults.ZESTY_STAT_CARDINALITY_WINDOW)
+STAT_OTHER = getattr(settings, 'ZESTY_STAT_OTHER', defaults.ZESTY_STAT_OTHER)
+
+FAST_BEACONS = getattr(settings, 'ZESTY_FAST_BEACONS', defaults.ZESTY_FAST_BEACONS)
+
+PROMETHEUS = getattr(settings, 'ZESTY_PROMETHEUS', defaults.ZESTY_PROMETHEUS)
+PROMETHEUS_BUCKETS = getattr(settings, 'ZESTY_PROMETHEUS_BUCKETS',
+                             defaults.ZESTY_PROMETHEUS_BUCKETS)
+PROMETHEUS_DIR = getattr(settings, 'ZESTY_PROMETHEUS_DIR', defaults.ZESTY_PROMETHEUS_DIR)
+PROMETHEUS_WRITE_INTERVAL = getattr(settings, 'ZESTY_PROMETHEUS_WRITE_INTERVAL',
+                                    defaults.ZESTY_PROMETHEUS_WRITE_INTERVAL)
+
+SHARED_METRICS_PATH = getattr(settings, 'ZESTY_SHARED_METRICS_PATH',
+                              defaults.ZESTY_SHARED_METRICS_PATH)
+SHARED_METRICS_SLOTS = getattr(settings, 'ZESTY_SHARED_METRICS_SLOTS',
+                               defaults.ZESTY_SHARED_METRICS_SLOTS)
+SHARED_FLUSH_INTERVAL = getattr(settings, 'ZESTY_SHARED_FLUSH_INTERVAL',
+                                defaults.ZESTY_SHARED_FLUSH_INTERVAL)
+
+SNAPSHOTS = getattr(settings, 'ZESTY_SNAPSHOTS', defaults.ZESTY_SNAPSHOTS)
+
+READ_DB = getattr(settings, 'ZESTY_READ_DB', defaults.ZESTY_READ_DB)
+READ_DB_MAX_LAG = getattr(settings, 'ZESTY_READ_DB_MAX_LAG',
+                          defaults.ZESTY_READ_DB_MAX_LAG)
+
+PROFILE_SAMPLE_RATE = getattr(settings, 'ZESTY_PROFILE_SAMPLE_RATE',
+                              defaults.ZESTY_PROFILE_SAMPLE_RATE)
+PROFILE_VIEWS = getattr(settings, 'ZESTY_PROFILE_VIEWS', defaults.ZESTY_PROFILE_VIEWS)
+PROFILE_THRESHOLD = getattr(settings, 'ZESTY_PROFILE_THRESHOLD',
+                            defaults.ZESTY_PROFILE_THRESHOLD)
+PROFILE_DIR = getattr(settings, 'ZESTY_PROFILE_DIR', defaults.ZESTY_PROFILE_DIR)
+PROFILE_KEEP = getattr(settings, 'ZESTY_PROFILE_KEEP', defaults.ZESTY_PROFILE_KEEP)
+
+SAMPLER_HZ = getattr(settings, 'ZESTY_SAMPLER_HZ', defaults.ZESTY_SAMPLER_HZ)
+SAMPLER_DUMP_INTERVAL = getattr(settings, 'ZESTY_SAMPLER_DUMP_INTERVAL',
+                                defaults.ZESTY_SAMPLER_DUMP_INTERVAL)
+SAMPLER_MAX_STACKS = getattr(settings, 'ZESTY_SAMPLER_MAX_STACKS',
+                             defaults.ZESTY_SAMPLER_MAX_STACKS)
+SAMPLER_KEEP = getattr(settings, 'ZESTY_SAMPLER_KEEP', defaults.ZESTY_SAMPLER_KEEP)
+
+CACHE_FLUSH_INTERVAL = getattr(settings, 'ZESTY_CACHE_FLUSH_INTERVAL',
+                               defaults.ZESTY_CACHE_FLUSH_INTERVAL)
+
+ACTIVITY_TOP = getattr(settings, 'ZESTY_ACTIVITY_TOP', defaults.ZESTY_ACTIVITY_TOP)
+ACTIVITY_DEDUPE_SIZE = getattr(settings, 'ZESTY_ACTIVITY_DEDUPE_SIZE',
+                               defaults.ZESTY_ACTIVITY_DEDUPE_SIZE)
+ACTIVITY_DEDUPE_CACHE = getattr(settings, 'ZESTY_ACTIVITY_DEDUPE_CACHE',
+                                defaults.ZESTY_ACTIVITY_DEDUPE_CACHE)
@@ -7,4 +7,119 @@ ZESTY_TIMING_SAMPLE_RATE = 1
 
 ZESTY_TIME_RESPONSES = True
 
+# Time Django template rendering per request.
+ZESTY_TIME_TEMPLATES = False
+
+# Split response times into queue, before-view, view and after-view time.
+ZESTY_LATENCY_BREAKDOWN = False
+
+# WSGI environ keys holding the time the proxy got the request.
+ZESTY_QUEUE_TIME_HEADERS = ('HTTP_X_REQUEST_START', 'HTTP_X_QUEUE_START')
+
+# Unit of those timestamps: 's', 'ms', 'us', or 'auto' to guess.
+ZESTY_QUEUE_TIME_FORMAT = 'auto'
+
 ZESTY_TRACK_USER_ACTIVITY = True
+
+# Send view/browser dimensions as tags: 'dogstatsd', 'influx' or 'graphite'.
+ZESTY_TAG_FORMAT = None
+
+# Threads running the middleware's side effects after the response; 0 runs
+# them inline.
+ZESTY_BACKGROUND_WORKERS = 0
+
+ZESTY_BACKGROUND_QUEUE_SIZE = 1000
+
+ZESTY_BACKGROUND_DRAIN_TIMEOUT = 5
+
+ZESTY_TRACKER_CONCURRENCY = 1
+
+ZESTY_REPORT_INTERVAL = 60
+
+ZESTY_REPORT_JITTER = 0.1
+
+# Claim each report through the cache so only one host runs it per interval.
+ZESTY_REPORT_LOCK = False
+
+# Shell-style patterns for stat names accepted from clients; None allows all.
+ZESTY_ALLOWED_STATS = None
+
+# Tag keys accepted from clients in tagged mode; None allows all.
+ZESTY_ALLOWED_TAGS = None
+
+ZESTY_STAT_CARDINALITY_LIMIT = 1000
+
+ZESTY_STAT_CARDINALITY_WINDOW = 60 * 60
+
+ZESTY_STAT_OTHER = 'other'
+
+ZESTY_FAST_BEACONS = False
+
+ZESTY_PROMETHEUS = False
+
+# Upper bounds, in seconds, of the Prometheus histogram buckets.
+ZESTY_PROMETHEUS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Directory where each worker process writes its Prometheus metrics, for
+# scrapes to merge; None serves only the scraped process's own.
+ZESTY_PROMETHEUS_DIR = None
+
+ZESTY_PROMETHEUS_WRITE_INTERVAL = 5
+
+# Memory-mapped file for per-host aggregation of view metrics, e.g.
+# '/dev/shm/zesty_metrics'; None sends from each worker.
+ZESTY_SHARED_METRICS_PATH = None
+
+ZESTY_SHARED_METRICS_SLOTS = 4096
+
+ZESTY_SHARED_FLUSH_INTERVAL = 10
+
+# Persist every reported tracker value as a MetricSnapshot.
+ZESTY_SNAPSHOTS = True
+
+# Database alias tracker and report reads go to, e.g. a read replica;
+# None reads from the default database.
+ZESTY_READ_DB = None
+
+# Seconds ZESTY_READ_DB may lag behind before reading from the default
+# database instead; None doesn't check.
+ZESTY_READ_DB_MAX_LAG = None
+
+# Fraction of requests to profile; see zesty_metrics.profiling.
+ZESTY_PROFILE_SAMPLE_RATE = 0
+
+# Shell-style patterns for the view names to profile; None profiles all.
+ZESTY_PROFILE_VIEWS = None
+
+# Keep profiles of requests that took at least this many seconds.
+ZESTY_PROFILE_THRESHOLD = 1.0
+
+# Directory for kept profiles; None disables profiling.
+ZESTY_PROFILE_DIR = None
+
+ZESTY_PROFILE_KEEP = 100
+
+# Stack samples per second of threads serving requests, written to
+# ZESTY_PROFILE_DIR; 0 disables the sampler.
+ZESTY_SAMPLER_HZ = 0
+
+ZESTY_SAMPLER_DUMP_INTERVAL = 60
+
+ZESTY_SAMPLER_MAX_STACKS = 10000
+
+# Collapsed-stack files kept in ZESTY_PROFILE_DIR, one per process and
+# dump interval; the oldest is overwritten.
+ZESTY_SAMPLER_KEEP = 100
+
+# Seconds between sends of the stats zesty_metrics.caching.InstrumentedCache
+# aggregates.
+ZESTY_CACHE_FLUSH_INTERVAL = 10
+
+# Number of activities zesty_metrics.tracking.ActivityTracker reports on.
+ZESTY_ACTIVITY_TOP = 50
+
+# Activity recorded today that record_activity skips without a query: keys
+# remembered per process, and whether to also check the cache.
+ZESTY_ACTIVITY_DEDUPE_SIZE = 10000
+
+ZESTY_ACTIVITY_DEDUPE_CACHE = True
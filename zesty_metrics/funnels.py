@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Conversion funnels over ``DailyActivityRecord``.
+
+A funnel is an ordered list of activities (``what`` values). The cohort
+of a day is the users who did the first step that day; a user reaches a
+later step by doing it on or after the day they reached the previous
+one, within ``window`` days of the cohort day. Activity is only recorded
+per day, so steps done on the same day count as being in order.
+
+Each step is one query per cohort day; the ordering is checked in
+memory. Once a cohort's window is over its counts can't change, so they
+are cached and computed only once.
+"""
+import datetime
+from hashlib import md5
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+from . import models
+
+# Cached cohorts outlive the activity records ``cleanup`` deletes.
+CACHE_TIMEOUT = 120 * 24 * 60 * 60
+
+
+def conversion(totals):
+    """Step-to-step conversion rates for a list of step counts.
+    """
+    return [float(count) / previous if previous else 0.0
+            for previous, count in zip(totals, totals[1:])]
+
+
+class Funnel(object):
+    def __init__(self, steps, window=7, using=None):
+        if not steps:
+            raise ValueError('A funnel needs at least one step.')
+        self.steps = list(steps)
+        self.window = window
+        self.using = using
+
+    def cache_key(self, day):
+        steps = md5(force_bytes('\n'.join(self.steps))).hexdigest()
+        return 'zesty_funnel_%s_%d_%s' % (steps, self.window, day.isoformat())
+
+    def closed(self, day, today=None):
+        """Whether ``day``'s cohort has had its whole window.
+        """
+        today = today or datetime.date.today()
+        return day + datetime.timedelta(days=self.window) <= today
+
+    def compute(self, day):
+        """Users reaching each step from ``day``'s cohort, as a list.
+        """
+        last_day = day + datetime.timedelta(days=self.window - 1)
+        records = models.DailyActivityRecord.objects.using(self.using)
+        reached = None
+        counts = []
+        for step in self.steps:
+            if reached is None:
+                users = records.filter(what=step, when=day).values_list('user', flat=True)
+                reached = dict((user, day) for user in users)
+            else:
+                rows = records.filter(
+                    what=step, when__range=(day, last_day),
+                ).values_list('user', 'when').order_by('user', 'when')
+                following = {}
+                for user, when in rows.iterator():
+                    if user not in following and user in reached and when >= reached[user]:
+                        following[user] = when
+                reached = following
+            counts.append(len(reached))
+        return counts
+
+    def counts(self, start, end):
+        """Map each cohort day in ``[start, end]`` to its step counts.
+
+        Closed days are read from, and stored in, the cache.
+        """
+        days = [start + datetime.timedelta(days=i)
+                for i in range((end - start).days + 1)]
+        keys = dict((self.cache_key(day), day) for day in days if self.closed(day))
+        cached = cache.get_many(list(keys))
+        results = dict((keys[key], counts) for key, counts in cached.items())
+        computed = {}
+        for day in days:
+            if day not in results:
+                results[day] = self.compute(day)
+                if self.closed(day):
+                    computed[self.cache_key(day)] = results[day]
+        if computed:
+            cache.set_many(computed, CACHE_TIMEOUT)
+        return results
+
+    def totals(self, start, end):
+        """Users reaching each step, summed over the cohorts in ``[start, end]``.
+        """
+        totals = [0] * len(self.steps)
+        for counts in self.counts(start, end).values():
+            totals = [total + count for total, count in zip(totals, counts)]
+        return totals
+
+    def conversion(self, start, end):
+        """Fraction of the previous step's users reaching each step after the first.
+        """
+        return conversion(self.totals(start, end))
@@ -9,11 +9,12 @@ import statsd
 
 from zesty_metrics import conf
 
-from zesty_metrics.models import DailyActivityRecord
+from zesty_metrics.models import DailyActivityRecord, DailySignupCount, MetricSnapshot
 
 
 class Command(BaseCommand):
-    help = """Clean up old activity records."""
+    help = """Clean up old activity records, compact old metric snapshots
+and reconcile the daily signup counters."""
 
     def add_arguments(self, parser):
         parser.add_argument('--days',
@@ -21,6 +22,16 @@ class Command(BaseCommand):
                             type=int,
                             default=90,
                             help='Delete records older than this many days.')
+        parser.add_argument('--snapshot-days',
+                            dest='snapshot_days',
+                            type=int,
+                            default=30,
+                            help='Keep one averaged snapshot per day for snapshots older than this many days.')
+        parser.add_argument('--reconcile-days',
+                            dest='reconcile_days',
+                            type=int,
+                            default=31,
+                            help='Recount daily signups from the user table for this many days.')
 
     def delete_records(self, delete_before):
         DailyActivityRecord.objects.filter(when__lt=delete_before).delete()
@@ -32,3 +43,11 @@ class Command(BaseCommand):
         delete_before = today - datetime.timedelta(days=days)
 
         self.delete_records(delete_before)
+
+        snapshot_days = options.get('snapshot_days', 30)
+        compact_before = datetime.datetime.combine(
+            today - datetime.timedelta(days=snapshot_days), datetime.time())
+        MetricSnapshot.objects.compact(compact_before, datetime.timedelta(days=1))
+
+        reconcile_days = options.get('reconcile_days', 31)
+        DailySignupCount.objects.reconcile(today - datetime.timedelta(days=reconcile_days))
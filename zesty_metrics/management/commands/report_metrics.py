@@ -1,43 +1,83 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
 
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.core import exceptions
+from django.db import close_old_connections
 from importlib import import_module
 
-import statsd
-
+from zesty_metrics import clients
 from zesty_metrics import conf
+from zesty_metrics import prometheus
+from zesty_metrics.models import MetricSnapshot
 
 
 class Command(BaseCommand):
-    help = """Report metrics to StatsD. Run as a cron job for maximum effect."""
+    help = """Report metrics to StatsD. Run as a cron job for maximum effect,
+    or with --daemon to stay resident and report each metric on its own
+    interval."""
 
-    statsd = statsd.StatsClient(
-        host = conf.HOST,
-        port = conf.PORT,
-        prefix = conf.PREFIX,
-        )
+    @property
+    def statsd(self):
+        return clients.get_client()
 
-    try:
-        pipeline = statsd.pipeline()
-    except AttributeError:
-        # statsd < 2.0
-        pipeline = statsd
+    @property
+    def pipeline(self):
+        if '_pipeline' not in self.__dict__:
+            self._pipeline = clients.get_pipeline()
+        return self._pipeline
 
-    def _track(self, tracker, kind, func):
-        """Track items on a tracker. Internal helper method.
+    def add_arguments(self, parser):
+        parser.add_argument('--daemon',
+                            action='store_true',
+                            dest='daemon',
+                            default=False,
+                            help='Stay resident and report metrics on their intervals.')
+        parser.add_argument('--interval',
+                            dest='interval',
+                            type=int,
+                            default=conf.REPORT_INTERVAL,
+                            help='Default seconds between reports of a metric in daemon mode.')
+        parser.add_argument('--jitter',
+                            dest='jitter',
+                            type=float,
+                            default=conf.REPORT_JITTER,
+                            help='Random delay added to each interval, as a fraction of it.')
+
+    def _stats(self, tracker, kind, values, names=None):
+        """Yield ``(stat name, value)`` for items on a tracker; ``value``
+        is ``None`` if the item wasn't computed.
+
+        Items whose value is a dict expand into one stat per key, with
+        the key in place of ``%s`` in the stat name.
         """
         for attr, name in getattr(tracker, kind, {}).items():
-            try:
-                value = getattr(tracker, attr)
-                if callable(value):
-                    value = value()
-            except:
-                logging.error("%s::%s.%s: NO VALUE", kind, conf.PREFIX, name)
+            if names is not None and attr not in names:
+                continue
+            if attr not in values:
+                yield name, None
+            elif isinstance(values[attr], dict):
+                for key, value in sorted(values[attr].items()):
+                    yield name % key, value
             else:
+                yield name, values[attr]
+
+    def _track(self, tracker, kind, func, values, names=None):
+        """Track items on a tracker. Internal helper method.
+        """
+        for name, value in self._stats(tracker, kind, values, names):
+            if value is not None:
                 logging.info("%s::%s.%s: %s", kind, conf.PREFIX, name, value)
                 func(name, value)
+            else:
+                logging.error("%s::%s.%s: NO VALUE", kind, conf.PREFIX, name)
 
     def _import_tracker(self, path):
         """"Import and instantiate a tracker from the given dotted path.
@@ -56,13 +96,7 @@ class Command(BaseCommand):
             raise exceptions.ImproperlyConfigured('Tracker module "%s" does not define a "%s" class' % (module, classname))
         return klass()
 
-    def handle(self, **options):
-        trackers = [self._import_tracker(tp) for tp in conf.TRACKING_CLASSES]
-
-        for tracker in trackers:
-            self._track(tracker, 'gauges', self.pipeline.gauge)
-            self._track(tracker, 'counters', self.pipeline.incr)
-
+    def _send(self):
         try:
             self.pipeline.send()
         except AttributeError:
@@ -71,3 +105,134 @@ class Command(BaseCommand):
         except IndexError:
             # Nothing in the pipeline to send.
             pass
+
+    def _claim(self, name, interval, now=None):
+        """Claim this interval's report of ``name`` for this host.
+
+        With ``ZESTY_REPORT_LOCK`` on, the first host to ``cache.add`` the
+        key for the current interval reports it and the others skip. The
+        key expires with the interval, so a host that dies mid-report
+        holds it no longer than that.
+        """
+        if not conf.REPORT_LOCK:
+            return True
+        if now is None:
+            now = time.time()
+        interval = max(int(interval), 1)
+        key = 'zesty_report_lock_%s_%d_%d' % (name, interval, now // interval)
+        owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        if cache.add(key, owner, interval):
+            return True
+        logging.info("Skipping %s: reported by %s this interval.", name, cache.get(key))
+        return False
+
+    def _report(self, tracker, names=None):
+        """Evaluate and report a tracker's metrics, or just ``names``.
+        """
+        if names is None:
+            names = list(getattr(tracker, 'gauges', {}))
+            names.extend(getattr(tracker, 'counters', {}))
+        values = tracker.evaluate(names)
+        self._track(tracker, 'gauges', self.pipeline.gauge, values, names)
+        prometheus.store_tracker_gauges(dict(
+            (name, value)
+            for name, value in self._stats(tracker, 'gauges', values, names)
+            if value is not None
+        ))
+        self._track(tracker, 'counters', self.pipeline.incr, values, names)
+        if conf.SNAPSHOTS:
+            # History is secondary; don't let it stop reporting.
+            try:
+                MetricSnapshot.objects.record(tracker.snapshot_name(), values)
+            except Exception:
+                logging.exception("Error storing snapshots of %s", tracker.snapshot_name())
+
+    def handle(self, **options):
+        trackers = [self._import_tracker(tp) for tp in conf.TRACKING_CLASSES]
+
+        if options.get('daemon'):
+            self.stop = threading.Event()
+            self.run_daemon(trackers,
+                            options.get('interval', conf.REPORT_INTERVAL),
+                            options.get('jitter', conf.REPORT_JITTER))
+            return
+
+        interval = options.get('interval', conf.REPORT_INTERVAL)
+        for tracker in trackers:
+            if self._claim(tracker.snapshot_name(), interval):
+                self._report(tracker)
+
+        self._send()
+
+    # Daemon mode
+    def schedule(self, trackers, interval):
+        """Build the initial schedule: every metric is due immediately.
+
+        Returns a list of ``[due, tracker, metric, interval]`` entries.
+        """
+        now = time.time()
+        entries = []
+        for tracker in trackers:
+            intervals = getattr(tracker, 'intervals', {})
+            names = set(getattr(tracker, 'gauges', {}))
+            names.update(getattr(tracker, 'counters', {}))
+            for name in sorted(names):
+                entries.append([now, tracker, name, intervals.get(name, interval)])
+        return entries
+
+    def tick(self, entries, jitter, now=None):
+        """Report every metric that is due and reschedule it.
+
+        Returns the time the next metric falls due.
+        """
+        if now is None:
+            now = time.time()
+        due = {}
+        for entry in entries:
+            if entry[0] <= now:
+                due.setdefault(entry[1], []).append(entry)
+
+        if due:
+            # Drop connections the database closed on us while we slept.
+            close_old_connections()
+            for tracker, tracker_entries in due.items():
+                names = [
+                    entry[2] for entry in tracker_entries
+                    if self._claim('%s.%s' % (tracker.snapshot_name(), entry[2]),
+                                   entry[3], now)
+                ]
+                if names:
+                    tracker.reset()
+                    try:
+                        self._report(tracker, names)
+                    except Exception:
+                        logging.exception("Error reporting %s", type(tracker).__name__)
+                for entry in tracker_entries:
+                    entry[0] = now + entry[3] * (1 + random.uniform(0, jitter))
+            self._send()
+
+        return min(entry[0] for entry in entries)
+
+    def run_daemon(self, trackers, interval, jitter):
+        """Report metrics on their intervals until SIGTERM/SIGINT.
+        """
+        def shutdown(signum, frame):
+            logging.info("Received signal %s, shutting down.", signum)
+            self.stop.set()
+
+        previous = {}
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous[signum] = signal.signal(signum, shutdown)
+        except ValueError:
+            # Not in the main thread; rely on ``self.stop`` being set.
+            pass
+
+        try:
+            entries = self.schedule(trackers, interval)
+            while entries and not self.stop.is_set():
+                next_due = self.tick(entries, jitter)
+                self.stop.wait(max(0, next_due - time.time()))
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
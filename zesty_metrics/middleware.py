@@ -6,18 +6,21 @@ from uuid import uuid1
 from hashlib import md5
 
 from django.core.cache import cache
+from django.core.signals import request_finished, request_started
 from django.db import IntegrityError
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     class MiddlewareMixin(object):
         pass
 
-from user_agents import parse as parse_ua
-import statsd
-
+from . import clients
 from . import models
 from . import conf
+from . import tagging
+from .registry import stat_name
 
 logger = logging.getLogger('metrics')
 
@@ -40,21 +43,152 @@ def id_request(request):
         request.META.get(k, '')
         for k in request_id_keys
     ])
-    return md5(uuid1().get_hex() + key).hexdigest()
+    return md5(force_bytes(uuid1().hex + key)).hexdigest()
+
+
+QUEUE_TIME_UNITS = {
+    's': 1.0,
+    'ms': 1e3,
+    'us': 1e6,
+}
+
+
+def parse_request_start(value, unit='auto'):
+    """Parse an ``X-Request-Start`` style header into seconds since the epoch.
+
+    Accepts ``t=<timestamp>`` or a bare timestamp, in ``unit`` (``s``,
+    ``ms`` or ``us``); ``auto`` tells them apart by magnitude. Returns
+    ``None`` if the value can't be parsed.
+    """
+    value = value.strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        timestamp = float(value)
+    except ValueError:
+        return None
+    if unit == 'auto':
+        if timestamp > 1e14:
+            unit = 'us'
+        elif timestamp > 1e11:
+            unit = 'ms'
+        else:
+            unit = 's'
+    return timestamp / QUEUE_TIME_UNITS[unit]
+
+
+# Optional features' modules are only imported once their setting is on,
+# so the middleware stays cheap to import.
+
+def get_aggregator():
+    """This process's ``shared.SharedAggregator``, or ``None`` if disabled.
+    """
+    if not conf.SHARED_METRICS_PATH:
+        return None
+    from . import shared
+    return shared.get_aggregator()
+
+
+def get_sampler():
+    """This process's ``profiling.StackSampler``, or ``None`` if disabled.
+    """
+    if not (conf.SAMPLER_HZ and conf.PROFILE_DIR):
+        return None
+    from . import profiling
+    return profiling.get_sampler()
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func`` on the background workers if enabled, else right away.
+    """
+    if not conf.BACKGROUND_WORKERS:
+        func(*args, **kwargs)
+    else:
+        from . import background
+        background.submit(func, *args, **kwargs)
+
+
+def parse_ua(ua_string):
+    """Parse a User-Agent string.
+
+    ``user_agents`` compiles its regex tables on import, so it isn't
+    imported until the first request needs it.
+    """
+    from user_agents import parse
+    return parse(ua_string)
 
 
 class LocalStatsd(threading.local):
-    def __init__(self):
-        client = self.client = statsd.StatsClient(
-            host = conf.HOST,
-            port = conf.PORT,
-            prefix = conf.PREFIX,
-        )
+    """Per-thread StatsD pipeline, created on first use.
+    """
+    def __getattr__(self, name):
+        if name == 'client':
+            self.client = clients.get_client()
+            return self.client
+        elif name == 'pipeline':
+            self.pipeline = clients.get_pipeline(self.client)
+            return self.pipeline
+        raise AttributeError(name)
+
+
+class TimedStream(object):
+    """Iterator over a streaming response's content that reports when
+    the stream is exhausted or closed.
+
+    Calls ``on_finish(first byte time, bytes sent)`` once. Chunks are
+    passed through as they come; only their sizes are counted.
+    """
+    def __init__(self, content, on_finish, size=None):
+        self.iterator = iter(content)
+        self.on_finish = on_finish
+        # Reported if the server sent the content without iterating,
+        # e.g. with ``wsgi.file_wrapper``.
+        self.size = size
+        self.sent = 0
+        self.first_byte = None
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
         try:
-            self.pipeline = client.pipeline()
-        except AttributeError:
-            # In case we're using an older statsd version.
-            self.pipeline = client
+            chunk = next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.sent += len(chunk)
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            if self.first_byte is None and self.size is not None:
+                self.on_finish(None, self.size)
+            else:
+                self.on_finish(self.first_byte, self.sent)
+
+
+class ClosingFile(object):
+    """A ``FileResponse``'s file that closes the response along with it.
+
+    Django 1.11 hands ``file_to_stream`` to ``wsgi.file_wrapper`` and
+    the server only closes that, never the response; later versions
+    patch the file's ``close`` the same way.
+    """
+    def __init__(self, filelike, close):
+        self.filelike = filelike
+        self.close = close
+
+    def __getattr__(self, name):
+        return getattr(self.filelike, name)
+
+    def __iter__(self):
+        return iter(self.filelike)
 
 
 class MetricsMiddleware(MiddlewareMixin):
@@ -62,7 +196,8 @@ class MetricsMiddleware(MiddlewareMixin):
 
     Includes:
 
-    - Performance timing
+    - Performance timing, to the end of the stream for streaming responses
+    - Response sizes
     - Last-seen data for authenticated users.
     """
     scope = LocalStatsd()
@@ -70,37 +205,105 @@ class MetricsMiddleware(MiddlewareMixin):
     def process_request(self, request):
         request.statsd = self.scope.pipeline
         request.zesty = self.scope
+        # Left running if a previous response never reached us.
+        profiler = self.scope.__dict__.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        sampler = get_sampler()
+        if sampler is not None:
+            sampler.leave()
         try:
             if conf.TIME_RESPONSES:
                 self.start_timing(request)
+                if conf.TIME_TEMPLATES:
+                    from . import rendering
+                    rendering.start()
         except:
             logger.exception('Exception occurred while logging to statsd.')
 
     def process_exception(self, request, exception):
         try:
             if hasattr(self.scope, 'client'):
-                self.scope.pipeline.incr('view.exceptions')
-                view_name = (getattr(self.scope, 'view_name', 'UNKNOWN') +
-                             '.exceptions')
-                self.scope.pipeline.incr(view_name)
+                client = get_aggregator() or self.scope.pipeline
+                view_name = getattr(self.scope, 'view_name', 'UNKNOWN')
+                for name in tagging.view_stats(view_name, 'exceptions', aggregate=True):
+                    client.incr(name)
+                if conf.PROMETHEUS:
+                    from . import prometheus
+                    prometheus.record_exception(view_name)
         except:
             logger.exception('Exception occurred while logging to statsd.')
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         if conf.TIME_RESPONSES:
             self.gather_view_data(request, view_func)
+            self.scope.profiler = None
+            if conf.PROFILE_SAMPLE_RATE and conf.PROFILE_DIR:
+                from . import profiling
+                self.scope.profiler = profiling.sample(self.scope.view_name)
+            sampler = get_sampler()
+            if sampler is not None:
+                sampler.enter(self.scope.view_name)
+            if conf.LATENCY_BREAKDOWN:
+                self.scope.view_start = time.time()
 
     def process_response(self, request, response):
+        if conf.LATENCY_BREAKDOWN:
+            self.scope.view_end = time.time()
+        sampler = get_sampler()
+        if sampler is not None:
+            sampler.leave()
+        try:
+            self.stop_profiling()
+        except:
+            logger.exception('Exception occurred while saving a profile.')
         if conf.TRACK_USER_ACTIVITY:
             self.update_last_seen_data(request)
         if conf.TIME_RESPONSES:
             try:
-                self.stop_timing(request)
+                if conf.TIME_TEMPLATES:
+                    self.record_templates()
+                if getattr(response, 'streaming', False):
+                    self.time_stream(request, response)
+                else:
+                    self.stop_timing(request, len(response.content))
             except:
                 logger.exception('Exception occurred while logging to statsd.')
 
         return response
 
+    def record_templates(self):
+        """Send the request's template rendering time and slowest template.
+        """
+        from . import rendering
+        total, count, templates = rendering.finish()
+        if not count:
+            return
+        pipeline = self.scope.pipeline
+        counters = get_aggregator() or pipeline
+        view_name = getattr(self.scope, 'view_name', 'UNKNOWN')
+        for stat in tagging.view_stats(view_name, 'template.time'):
+            pipeline.timing(stat, total, conf.TIMING_SAMPLE_RATE)
+        for stat in tagging.view_stats(view_name, 'template.count'):
+            counters.incr(stat, count)
+        name, slowest = max(templates.items(), key=lambda item: item[1])
+        if conf.TAG_FORMAT:
+            stats = tagging.view_stats(view_name, 'template.slowest', template=name)
+        else:
+            stats = ['%s.template.slowest.%s' % (view_name, stat_name(name))]
+        for stat in stats:
+            pipeline.timing(stat, slowest, conf.TIMING_SAMPLE_RATE)
+
+    def stop_profiling(self):
+        """Stop this request's profiler, if sampled, and keep slow profiles.
+        """
+        profiler = self.scope.__dict__.pop('profiler', None)
+        if profiler is not None:
+            from . import profiling
+            started = getattr(self.scope, 'request_start', None)
+            elapsed = 0 if started is None else time.time() - started
+            profiling.finish(profiler, getattr(self.scope, 'view_name', 'UNKNOWN'), elapsed)
+
     def start_timing(self, request):
         """Start performance timing.
         """
@@ -128,46 +331,114 @@ class MetricsMiddleware(MiddlewareMixin):
         self.scope.agent = parse_ua(request.META.get('HTTP_USER_AGENT', ''))
         self.scope.view_name = "view." + name
 
-    def stop_timing(self, request):
+    def timing_data(self):
+        """What ``record_timing`` needs to know about the current request.
+        """
+        return {
+            'started': getattr(self.scope, 'request_start', None),
+            'view_name': getattr(self.scope, 'view_name', 'UNKNOWN'),
+            'agent': getattr(self.scope, 'agent', None),
+            'rid': getattr(self.scope, 'rid', None),
+        }
+
+    def stop_timing(self, request, size=None):
         """Stop performance timing.
         """
         now = time.time()
-        started = getattr(self.scope, 'request_start', now)
-        time_elapsed = now - started
         if hasattr(self.scope, 'client'):
-            client = self.scope.pipeline
-            view_name = getattr(self.scope, 'view_name', 'UNKNOWN')
-            if time_elapsed:
-                client.timing(
-                    view_name,
-                    time_elapsed,
-                    conf.TIMING_SAMPLE_RATE)
-                client.timing(
-                    'view.aggregate-response-time',
-                    time_elapsed,
-                    conf.TIMING_SAMPLE_RATE)
-            client.incr(view_name + '.requests')
-            client.incr('view.requests')
-            logger.info("Processed %s.%s in %ss", conf.PREFIX, view_name, time_elapsed)
+            submit(self.record_timing, self.timing_data(), now, size,
+                   pipeline=self.take_pipeline())
+
+    def take_pipeline(self):
+        """The pipeline holding this request's stats, for ``record_timing``.
+
+        When that runs in the background, the pipeline is handed over
+        and this thread starts a new one for its next request.
+        """
+        pipeline = self.scope.pipeline
+        if conf.BACKGROUND_WORKERS:
+            self.scope.pipeline = clients.get_pipeline(self.scope.client)
+        return pipeline
+
+    def time_stream(self, request, response):
+        """Time a streaming response until its content is consumed.
+
+        Headers being ready says little about how long a large export
+        takes to serve, so time to first byte, total time and bytes
+        sent are recorded when the stream is exhausted or closed.
+        """
+        if not hasattr(self.scope, 'client'):
+            return
+        data = self.timing_data()
+
+        def on_finish(first_byte, size):
             try:
-                client.send()
-            except AttributeError:
-                # Client isn't a pipeline, data already sent.
-                pass
-            except IndexError:
-                # Nothing to send.
-                pass
-            logger.debug("Sent stats to %s:%s", conf.HOST, conf.PORT)
-            agent = getattr(self.scope, "agent", None)
-            rid = getattr(self.scope, "rid", None)
-            if agent and rid:
-                data = {
-                    'started': started,
-                    'server_time': time_elapsed,
-                    'agent': agent,
-                    'view_name': view_name,
-                }
-                cache.set('request:' + rid, data, 5 * 60)
+                submit(self.record_timing, data, time.time(), size, first_byte,
+                       pipeline=self.take_pipeline())
+            except:
+                logger.exception('Exception occurred while logging to statsd.')
+
+        # Served directly by the WSGI server, if it has a file wrapper.
+        file_to_stream = getattr(response, 'file_to_stream', None)
+        size = None
+        if file_to_stream is not None and response.has_header('Content-Length'):
+            size = int(response['Content-Length'])
+        response.streaming_content = TimedStream(response.streaming_content,
+                                                 on_finish, size)
+        if file_to_stream is not None:
+            # Closing the response closes the file and ``TimedStream``.
+            response.file_to_stream = ClosingFile(file_to_stream, response.close)
+
+    def record_timing(self, data, finished, size=None, first_byte=None, pipeline=None):
+        """Send a request's timing and size metrics, and ``pipeline``.
+        """
+        started = data['started']
+        if started is None:
+            started = finished
+        view_name = data['view_name']
+        time_elapsed = finished - started
+        if pipeline is None:
+            pipeline = self.scope.pipeline
+        # Per-host aggregation, if configured, sends view counters itself.
+        counters = get_aggregator() or pipeline
+        if time_elapsed:
+            if conf.TAG_FORMAT:
+                stats = tagging.view_stats(view_name, 'response-time')
+            else:
+                stats = [view_name, 'view.aggregate-response-time']
+            for stat in stats:
+                pipeline.timing(stat, time_elapsed, conf.TIMING_SAMPLE_RATE)
+        if first_byte is not None:
+            for stat in tagging.view_stats(view_name, 'ttfb'):
+                pipeline.timing(stat, first_byte - started, conf.TIMING_SAMPLE_RATE)
+        if size is not None:
+            for stat in tagging.view_stats(view_name, 'bytes', aggregate=True):
+                counters.incr(stat, size)
+        for stat in tagging.view_stats(view_name, 'requests', aggregate=True):
+            counters.incr(stat)
+        if conf.PROMETHEUS:
+            from . import prometheus
+            prometheus.record_request(view_name, time_elapsed, size)
+        logger.info("Processed %s.%s in %ss", conf.PREFIX, view_name, time_elapsed)
+        try:
+            pipeline.send()
+        except AttributeError:
+            # Client isn't a pipeline, data already sent.
+            pass
+        except IndexError:
+            # Nothing to send.
+            pass
+        logger.debug("Sent stats to %s:%s", conf.HOST, conf.PORT)
+        agent = data['agent']
+        rid = data['rid']
+        if agent and rid:
+            data = {
+                'started': started,
+                'server_time': time_elapsed,
+                'agent': agent,
+                'view_name': view_name,
+            }
+            cache.set('request:' + rid, data, 5 * 60)
 
     # Other visit data
     def update_last_seen_data(self, request):
@@ -180,14 +451,87 @@ class MetricsMiddleware(MiddlewareMixin):
             return
 
         if user.is_authenticated():
-            try:
-                data = models.LastSeenData.objects.get(user=user)
-            except models.LastSeenData.DoesNotExist:
-                data = models.LastSeenData(user=user)
-            try:
-                data.update(request)
-            except IntegrityError:
-                # User probably got created in a concurrent request?
-                pass
-            except:
-                logger.exception("Couldn't update user LastSeenData:")
+            submit(self.record_last_seen, user, request)
+
+    def record_last_seen(self, user, request):
+        try:
+            data = models.LastSeenData.objects.get(user=user)
+        except models.LastSeenData.DoesNotExist:
+            data = models.LastSeenData(user=user)
+        try:
+            data.update(request)
+        except IntegrityError:
+            # User probably got created in a concurrent request?
+            pass
+        except:
+            logger.exception("Couldn't update user LastSeenData:")
+
+
+@receiver(request_started)
+def start_latency_breakdown(sender, environ=None, **kwargs):
+    """Note when the handler got the request, and when the proxy did.
+    """
+    if not (conf.TIME_RESPONSES and conf.LATENCY_BREAKDOWN):
+        return
+    scope = MetricsMiddleware.scope
+    scope.handler_start = time.time()
+    scope.queue_start = None
+    for header in conf.QUEUE_TIME_HEADERS:
+        value = (environ or {}).get(header)
+        if value:
+            scope.queue_start = parse_request_start(value, conf.QUEUE_TIME_FORMAT)
+            break
+
+
+@receiver(request_finished)
+def send_latency_breakdown(sender, **kwargs):
+    """Send where the request's time went, once the response is closed.
+
+    - ``<view>.latency.queue``: from the proxy to the handler
+    - ``<view>.latency.before_view``: request middleware, URL resolution
+    - ``<view>.latency.view``: the view, and middleware inside this one
+    - ``<view>.latency.after_view``: middleware outside this one, and
+      sending the response
+
+    The last two split at ``process_response``, so list
+    ``MetricsMiddleware`` last to measure the view alone.
+    """
+    if not (conf.TIME_RESPONSES and conf.LATENCY_BREAKDOWN):
+        return
+    now = time.time()
+    scope = MetricsMiddleware.scope
+    points = {}
+    for name in ('queue_start', 'handler_start', 'view_start', 'view_end'):
+        points[name] = scope.__dict__.pop(name, None)
+    view_name = getattr(scope, 'view_name', None)
+    if points['view_start'] is None or view_name is None:
+        # Not a request we saw through to a view.
+        return
+    try:
+        pipeline = scope.pipeline
+        steps = [
+            ('queue', points['queue_start'], points['handler_start']),
+            ('before_view', points['handler_start'], points['view_start']),
+            ('view', points['view_start'], points['view_end']),
+            ('after_view', points['view_end'], now),
+        ]
+        for step, started, finished in steps:
+            if started is not None and finished is not None:
+                # Clamp clock skew between the proxy and this host.
+                for stat in tagging.view_stats(view_name, 'latency.' + step,
+                                               aggregate=step == 'queue'):
+                    pipeline.timing(stat, max(finished - started, 0),
+                                    conf.TIMING_SAMPLE_RATE)
+        try:
+            pipeline.send()
+        except (AttributeError, IndexError):
+            pass
+    except:
+        logger.exception('Exception occurred while logging to statsd.')
+
+
+@clients.after_fork
+def reset_scope():
+    """Forget the forking thread's client and pipeline in the child.
+    """
+    MetricsMiddleware.scope.__dict__.clear()
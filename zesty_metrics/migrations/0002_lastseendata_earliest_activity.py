@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def populate_earliest_activity(apps, schema_editor):
+    LastSeenData = apps.get_model('zesty_metrics', 'LastSeenData')
+    # The remembered timestamps are ordered
+    # (active_last_month <= active_this_month <= last_seen), so the
+    # first non-null one is the earliest. One UPDATE, no row fetching.
+    LastSeenData.objects.update(
+        earliest_activity=Coalesce('active_last_month',
+                                   'active_this_month',
+                                   'last_seen'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zesty_metrics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lastseendata',
+            name='earliest_activity',
+            field=models.DateTimeField(editable=False, help_text='Earliest activity we still remember for this user.', null=True),
+        ),
+        migrations.RunPython(populate_earliest_activity, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='lastseendata',
+            index_together=set([('last_seen', 'earliest_activity')]),
+        ),
+    ]
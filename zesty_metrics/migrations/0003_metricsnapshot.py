@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zesty_metrics', '0002_lastseendata_earliest_activity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tracker', models.CharField(help_text='Dotted path of the tracker class.', max_length=255)),
+                ('metric', models.CharField(help_text='Tracker attribute the value came from.', max_length=255)),
+                ('timestamp', models.DateTimeField(help_text='When the value was reported.')),
+                ('value', models.FloatField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='metricsnapshot',
+            index_together=set([('tracker', 'metric', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def signup_day(joined):
+    # As models.signup_day when this migration was written.
+    if timezone.is_aware(joined):
+        joined = timezone.localtime(joined)
+    return joined.date()
+
+
+def populate_signup_counts(apps, schema_editor):
+    # Seed the counters for the windows UserAccounts reports; the
+    # cache fills itself from these rows.
+    User = apps.get_model('auth', 'User')
+    DailySignupCount = apps.get_model('zesty_metrics', 'DailySignupCount')
+    since = datetime.datetime.combine(
+        datetime.date.today() - datetime.timedelta(days=31), datetime.time())
+    counts = {}
+    for joined in User.objects.filter(date_joined__gte=since).values_list(
+            'date_joined', flat=True).iterator():
+        day = signup_day(joined)
+        counts[day] = counts.get(day, 0) + 1
+    DailySignupCount.objects.bulk_create([
+        DailySignupCount(day=day, count=count) for day, count in sorted(counts.items())
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        ('zesty_metrics', '0003_metricsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySignupCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('count', models.PositiveIntegerField(default=0, help_text='Users who signed up that day.')),
+            ],
+        ),
+        migrations.RunPython(populate_signup_counts, migrations.RunPython.noop),
+    ]
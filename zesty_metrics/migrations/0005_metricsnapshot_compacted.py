@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zesty_metrics', '0004_dailysignupcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metricsnapshot',
+            name='compacted',
+            field=models.BooleanField(default=False, help_text='Is this an average of older snapshots?'),
+        ),
+    ]
@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 import datetime
+import logging
+import threading
+from hashlib import md5
 
 from django.db import models
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+from . import conf
+
+logger = logging.getLogger('metrics')
 
 
 class LastSeenData(models.Model):
@@ -18,6 +29,28 @@ class LastSeenData(models.Model):
     active_last_month = models.DateTimeField(null=True, db_index=True,
                                              editable=False,
                                              help_text="Was the user active 30-60 days ago?")
+    earliest_activity = models.DateTimeField(null=True, editable=False,
+                                             help_text="Earliest activity we still remember for this user.")
+
+    class Meta:
+        # Serves the last-month/returning/churned queries in
+        # ``tracking.UserAccounts`` with a single range scan.
+        index_together = (
+            ('last_seen', 'earliest_activity'),
+        )
+
+    def save(self, *args, **kwargs):
+        # ``last_seen`` is always the most recent activity, so the
+        # earliest of the remembered timestamps is enough to tell
+        # whether the user was around 30-60 days ago.
+        self.earliest_activity = min(
+            ts for ts in (self.active_last_month,
+                          self.active_this_month,
+                          self.last_seen,
+                          datetime.datetime.now())
+            if ts is not None
+        )
+        super(LastSeenData, self).save(*args, **kwargs)
 
     def update(self, request):
         this_month = datetime.datetime.now() - datetime.timedelta(days=30)
@@ -45,8 +78,61 @@ class LastSeenData(models.Model):
             self.save()
 
 
+class RecentActivity(object):
+    """Keys of activity this process recorded today, at most ``size``.
+
+    Forgets everything at day rollover, or when full.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self, day=None):
+        self.day = day
+        self.keys = set()
+
+    def seen(self, key, day):
+        return self.day == day and key in self.keys
+
+    def add(self, key, day):
+        if not self.size:
+            return
+        with self.lock:
+            if self.day != day or len(self.keys) >= self.size:
+                self.clear(day)
+            self.keys.add(key)
+
+
+recent_activity = RecentActivity(conf.ACTIVITY_DEDUPE_SIZE)
+
+
+def seconds_until_tomorrow(now=None):
+    now = now or datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                         datetime.time())
+    return max(int((tomorrow - now).total_seconds()), 1)
+
+
 class DailyActivityRecordManager(models.Manager):
+    def activity_key(self, who, what, day):
+        return 'zesty_activity_%s_%s_%s' % (
+            day.isoformat(), who.pk, md5(force_bytes(what)).hexdigest())
+
     def record_activity(self, who, what):
+        """Record that ``who`` did ``what`` today.
+
+        Repeats are answered from ``recent_activity`` or, with
+        ``ZESTY_ACTIVITY_DEDUPE_CACHE``, the cache, without a query. A
+        key is only remembered once its row is committed.
+        """
+        today = datetime.date.today()
+        key = self.activity_key(who, what, today)
+        if recent_activity.seen(key, today):
+            return
+        if conf.ACTIVITY_DEDUPE_CACHE and cache.get(key):
+            recent_activity.add(key, today)
+            return
         try:
             with transaction.atomic():
                 self.create(
@@ -55,6 +141,12 @@ class DailyActivityRecordManager(models.Manager):
                 )
         except IntegrityError:
             pass
+        transaction.on_commit(lambda: self._remember(key, today))
+
+    def _remember(self, key, day):
+        recent_activity.add(key, day)
+        if conf.ACTIVITY_DEDUPE_CACHE:
+            cache.set(key, True, seconds_until_tomorrow())
 
 
 class DailyActivityRecord(models.Model):
@@ -71,3 +163,241 @@ class DailyActivityRecord(models.Model):
         )
 
     objects = DailyActivityRecordManager()
+
+
+def microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def flatten(values):
+    flat = {}
+    for metric, value in values.items():
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flat[('%s.%s' % (metric, key))[:255]] = item
+        else:
+            flat[metric] = value
+    return flat
+
+
+def average(snapshots, bucket):
+    """Average ``snapshots``, ordered by timestamp, over ``bucket``-sized
+    windows; ``[(window start, mean value)]``.
+    """
+    size = microseconds(bucket)
+    epoch = datetime.datetime(1970, 1, 1)
+    results = []
+    current = total = count = None
+    for timestamp, value in snapshots.values_list('timestamp', 'value').iterator():
+        offset = microseconds(timestamp.replace(tzinfo=None) - epoch)
+        window = timestamp - datetime.timedelta(microseconds=offset % size)
+        if window != current:
+            if current is not None:
+                results.append((current, total / count))
+            current, total, count = window, 0.0, 0
+        total += value
+        count += 1
+    if current is not None:
+        results.append((current, total / count))
+    return results
+
+
+class MetricSnapshotManager(models.Manager):
+    def record(self, tracker, values, timestamp=None):
+        """Store a run's numeric metric values for ``tracker`` (a name).
+
+        Dict values are stored per key, as ``<metric>.<key>``.
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        snapshots = []
+        for metric, value in sorted(flatten(values).items()):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            snapshots.append(self.model(tracker=tracker, metric=metric,
+                                        timestamp=timestamp, value=value))
+        self.bulk_create(snapshots)
+
+    def series(self, tracker, metric, start=None, end=None):
+        """Query one metric's snapshots, oldest first, in ``[start, end)``.
+        """
+        query = self.filter(tracker=tracker, metric=metric)
+        if start is not None:
+            query = query.filter(timestamp__gte=start)
+        if end is not None:
+            query = query.filter(timestamp__lt=end)
+        return query.order_by('timestamp')
+
+    def previous(self, tracker, metric, before=None):
+        """The most recent snapshot of a metric (before ``before``), or None.
+        """
+        query = self.filter(tracker=tracker, metric=metric)
+        if before is not None:
+            query = query.filter(timestamp__lt=before)
+        return query.order_by('-timestamp').first()
+
+    def downsample(self, tracker, metric, bucket, start=None, end=None):
+        """Average a metric over ``bucket``-sized (a timedelta) windows.
+
+        Returns ``[(window start, mean value)]``, oldest first.
+        """
+        return average(self.series(tracker, metric, start, end), bucket)
+
+    def compact(self, before, bucket):
+        """Replace snapshots older than ``before`` with ``bucket`` averages.
+
+        Averages are stored as ``compacted``, and later runs only
+        compact what's been recorded since.
+        """
+        old = self.filter(compacted=False, timestamp__lt=before)
+        series = old.values_list('tracker', 'metric').distinct()
+        with transaction.atomic():
+            for tracker, metric in list(series):
+                rows = old.filter(tracker=tracker, metric=metric)
+                averages = average(rows.order_by('timestamp'), bucket)
+                rows.delete()
+                self.bulk_create([
+                    self.model(tracker=tracker, metric=metric, timestamp=window,
+                               value=value, compacted=True)
+                    for window, value in averages
+                ])
+
+
+class MetricSnapshot(models.Model):
+    tracker = models.CharField(max_length=255,
+                               help_text="Dotted path of the tracker class.")
+    metric = models.CharField(max_length=255,
+                              help_text="Tracker attribute the value came from.")
+    timestamp = models.DateTimeField(help_text="When the value was reported.")
+    value = models.FloatField()
+    compacted = models.BooleanField(default=False,
+                                    help_text="Is this an average of older snapshots?")
+
+    class Meta:
+        index_together = (
+            ('tracker', 'metric', 'timestamp'),
+        )
+
+    objects = MetricSnapshotManager()
+
+
+def signup_day(joined):
+    """The day a ``date_joined`` value is counted under.
+    """
+    if timezone.is_aware(joined):
+        joined = timezone.localtime(joined)
+    return joined.date()
+
+
+class DailySignupCountManager(models.Manager):
+    # Long enough to serve the 30-day window from the cache.
+    cache_timeout = 32 * 24 * 60 * 60
+
+    def cache_key(self, day):
+        return 'zesty_signups_%s' % day.isoformat()
+
+    def record(self, day, count=1):
+        """Add ``count`` signups to ``day``'s counter, once the current
+        transaction commits.
+
+        Concurrent signups would otherwise queue on the counter row's
+        lock for as long as their transactions are open. An increment
+        lost in between is corrected by ``reconcile``.
+        """
+        transaction.on_commit(lambda: self._incr(day, count))
+
+    def _incr(self, day, count):
+        try:
+            with transaction.atomic():
+                if not self.filter(day=day).update(count=F('count') + count):
+                    try:
+                        with transaction.atomic():
+                            self.create(day=day, count=count)
+                    except IntegrityError:
+                        self.filter(day=day).update(count=F('count') + count)
+        except DatabaseError:
+            logger.exception("Couldn't count %s signups on %s.", count, day)
+            return
+        self._incr_cached(day, count)
+
+    def _incr_cached(self, day, count):
+        try:
+            cache.incr(self.cache_key(day), count)
+        except ValueError:
+            # Not cached; the next read loads it from the database.
+            pass
+
+    def counts(self, start, end):
+        """Map each day in ``[start, end]`` to its number of signups.
+
+        Read from the cache, falling back to the database.
+        """
+        days = [start + datetime.timedelta(days=i)
+                for i in range((end - start).days + 1)]
+        keys = dict((self.cache_key(day), day) for day in days)
+        cached = cache.get_many(list(keys))
+        counts = dict((keys[key], value) for key, value in cached.items())
+        missing = [day for day in days if day not in counts]
+        if missing:
+            stored = dict(self.filter(day__in=missing).values_list('day', 'count'))
+            for day in missing:
+                counts[day] = stored.get(day, 0)
+            cache.set_many(dict((self.cache_key(day), counts[day]) for day in missing),
+                           self.cache_timeout)
+        return counts
+
+    def window(self, since, now=None):
+        """Number of signups since ``since`` (a datetime).
+
+        Days are the finest grain kept, so the first, partial day is
+        prorated.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        first = since.date()
+        counts = self.counts(first, now.date())
+        elapsed = since - datetime.datetime.combine(first, datetime.time())
+        share = 1 - elapsed.total_seconds() / (24 * 60 * 60)
+        total = counts.pop(first) * share + sum(counts.values())
+        return int(round(total))
+
+    def reconcile(self, since):
+        """Recount signups from ``auth_user`` for every day from ``since``
+        up to yesterday.
+
+        Corrects any drift in the counters, e.g. from users created
+        with signals disconnected or from cache races. Users are read
+        from the primary, since the counts are written back. Today is
+        left alone: its signups are still being counted, and a recount
+        would race them.
+        """
+        today = datetime.date.today()
+        with transaction.atomic():
+            # Hold back increments to these counters until we're done.
+            list(self.select_for_update().filter(day__gte=since, day__lt=today))
+            counts = {}
+            joined = User.objects.filter(
+                date_joined__gte=datetime.datetime.combine(since, datetime.time()),
+                date_joined__lt=datetime.datetime.combine(today, datetime.time()),
+            ).values_list('date_joined', flat=True)
+            for value in joined.iterator():
+                day = signup_day(value)
+                if since <= day < today:
+                    counts[day] = counts.get(day, 0) + 1
+            self.filter(day__gte=since, day__lt=today).delete()
+            self.bulk_create([self.model(day=day, count=count)
+                              for day, count in sorted(counts.items())])
+        days = [since + datetime.timedelta(days=i)
+                for i in range(max((today - since).days, 0))]
+        cache.set_many(dict((self.cache_key(day), counts.get(day, 0)) for day in days),
+                       self.cache_timeout)
+
+
+class DailySignupCount(models.Model):
+    day = models.DateField(unique=True)
+    count = models.PositiveIntegerField(default=0,
+                                        help_text="Users who signed up that day.")
+
+    objects = DailySignupCountManager()
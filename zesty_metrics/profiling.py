@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Profiles of slow requests, and stack samples of all requests.
+
+With ``ZESTY_PROFILE_DIR`` set and a ``ZESTY_PROFILE_SAMPLE_RATE``
+above zero, the middleware runs ``cProfile`` for that fraction of
+requests to the views matching ``ZESTY_PROFILE_VIEWS``. A profile is
+kept only if the request took at least ``ZESTY_PROFILE_THRESHOLD``
+seconds. Kept profiles go to a ring of ``ZESTY_PROFILE_KEEP`` pstats
+files in the directory, shared by all processes on the host, with an
+``index.json`` saying which view and request each one is for::
+
+    python -m pstats /tmp/zesty_profiles/12.prof
+
+Unsampled requests cost one call to ``random()``.
+
+With ``ZESTY_SAMPLER_HZ`` above zero as well, a ``StackSampler`` thread
+in each process captures the stacks of the threads serving requests
+that many times per second, and attributes them to the view being
+served. Every ``ZESTY_SAMPLER_DUMP_INTERVAL`` seconds, the counts per
+collapsed stack since the last dump go to a ring of
+``ZESTY_SAMPLER_KEEP`` ``stacks.<n>.collapsed`` files in the directory,
+also listed in the index, ready for ``flamegraph.pl``::
+
+    cat /tmp/zesty_profiles/stacks.*.collapsed | flamegraph.pl > cpu.svg
+"""
+import cProfile
+import fcntl
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from . import clients
+from . import conf
+from .registry import compile_patterns
+
+logger = logging.getLogger('metrics')
+
+INDEX = 'index.json'
+
+
+class ProfileStore(object):
+    """Bounded ring of pstats files in ``directory``, indexed by view.
+    """
+    def __init__(self, directory, keep=100):
+        self.directory = directory
+        self.keep = keep
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def locked(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created concurrently.
+                pass
+        fd = os.open(self.path(INDEX + '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def read_index(self):
+        try:
+            with open(self.path(INDEX)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'next': 0, 'profiles': {}}
+
+    def write(self, name, write):
+        # Write to a temporary file and rename, so readers never see a
+        # partial file.
+        tmp = self.path('.%s.%d' % (name, os.getpid()))
+        write(tmp)
+        os.rename(tmp, self.path(name))
+
+    def write_index(self, index):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(index, f)
+        self.write(INDEX, write)
+
+    def save(self, view_name, profiler, elapsed):
+        """Store ``profiler``'s stats over the oldest profile in the ring.
+        """
+        with self.locked():
+            index = self.read_index()
+            slot = index['next'] % self.keep
+            name = '%d.prof' % slot
+            self.write(name, profiler.dump_stats)
+            index['next'] = slot + 1
+            index['profiles'][str(slot)] = {
+                'file': name,
+                'view': view_name,
+                'elapsed': elapsed,
+                'time': time.time(),
+            }
+            self.write_index(index)
+        return self.path(name)
+
+    def save_stacks(self, lines, started):
+        """Store collapsed-stack ``lines`` sampled since ``started`` over
+        the oldest stacks file in their ring.
+        """
+        with self.locked():
+            index = self.read_index()
+            slot = index.get('next_stacks', 0) % self.keep
+            name = 'stacks.%d.collapsed' % slot
+
+            def write_stacks(path):
+                with open(path, 'w') as f:
+                    f.writelines(lines)
+            self.write(name, write_stacks)
+            index['next_stacks'] = slot + 1
+            index.setdefault('stacks', {})[str(slot)] = {
+                'file': name,
+                'pid': os.getpid(),
+                'started': started,
+                'time': time.time(),
+            }
+            self.write_index(index)
+        return self.path(name)
+
+    def profiles(self, view_name=None):
+        """Index entries, newest first, optionally only for one view.
+
+        Each has the ``file`` name, the ``view``, the request's
+        ``elapsed`` seconds and the ``time`` it was stored.
+        """
+        entries = self.read_index()['profiles'].values()
+        if view_name is not None:
+            entries = [e for e in entries if e['view'] == view_name]
+        return sorted(entries, key=lambda e: e['time'], reverse=True)
+
+
+_views = None
+
+
+def sample(view_name):
+    """Start and return a profiler for a sampled request, else ``None``.
+    """
+    global _views
+    rate = conf.PROFILE_SAMPLE_RATE
+    if not rate or not conf.PROFILE_DIR or random.random() >= rate:
+        return None
+    if conf.PROFILE_VIEWS is not None:
+        if _views is None:
+            _views = compile_patterns(conf.PROFILE_VIEWS)
+        if not _views.match(view_name):
+            return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish(profiler, view_name, elapsed):
+    """Stop ``profiler``; keep its stats if the request was slow.
+    """
+    profiler.disable()
+    if elapsed >= conf.PROFILE_THRESHOLD:
+        return ProfileStore(conf.PROFILE_DIR, conf.PROFILE_KEEP).save(
+            view_name, profiler, elapsed)
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of threads serving requests, keyed by view.
+
+    The middleware calls ``enter`` and ``leave`` around each view.
+    Memory is bounded by ``max_stacks`` distinct stacks per dump
+    interval; further new stacks are counted under ``<view>;[other]``.
+    Stacks deeper than ``max_depth`` keep their innermost frames.
+    """
+    daemon = True
+    OTHER = '[other]'
+
+    def __init__(self, directory, hz, dump_interval=60, max_stacks=10000, max_depth=128,
+                 keep=100):
+        super(StackSampler, self).__init__(name='zesty-metrics-sampler')
+        self.directory = directory
+        self.interval = 1.0 / hz
+        self.dump_interval = dump_interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.keep = keep
+        self.views = {}
+        self.stacks = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def enter(self, view_name):
+        self.views[threading.current_thread().ident] = view_name
+
+    def leave(self):
+        self.views.pop(threading.current_thread().ident, None)
+
+    def collapse(self, view_name, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append('%s.%s' % (frame.f_globals.get('__name__', '?'), code.co_name))
+            frame = frame.f_back
+        names.append(view_name)
+        names.reverse()
+        return ';'.join(names)
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, view_name in list(self.views.items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = self.collapse(view_name, frame)
+            with self.lock:
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = '%s;%s' % (view_name, self.OTHER)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def dump(self):
+        """Write the counts since the last dump in the collapsed-stack
+        format, and start counting afresh. Returns the file's path, or
+        ``None`` if nothing was sampled.
+        """
+        with self.lock:
+            stacks, self.stacks = self.stacks, {}
+            started, self.started = self.started, time.time()
+        if not stacks:
+            return None
+        lines = ['%s %d\n' % item for item in sorted(stacks.items())]
+        return ProfileStore(self.directory, self.keep).save_stacks(lines, started)
+
+    def run(self):
+        next_dump = time.time() + self.dump_interval
+        while not self.stop.wait(self.interval):
+            try:
+                self.sample()
+                if time.time() >= next_dump:
+                    next_dump = time.time() + self.dump_interval
+                    self.dump()
+            except Exception:
+                logger.exception('Error sampling stacks.')
+
+
+_sampler = None
+_lock = threading.Lock()
+
+
+def get_sampler():
+    """Return this process's running ``StackSampler``, or ``None`` if disabled.
+    """
+    global _sampler
+    if not conf.SAMPLER_HZ or not conf.PROFILE_DIR:
+        return None
+    if _sampler is None:
+        with _lock:
+            if _sampler is None:
+                sampler = StackSampler(conf.PROFILE_DIR, conf.SAMPLER_HZ,
+                                       conf.SAMPLER_DUMP_INTERVAL,
+                                       conf.SAMPLER_MAX_STACKS,
+                                       keep=conf.SAMPLER_KEEP)
+                sampler.start()
+                _sampler = sampler
+    return _sampler
+
+
+@clients.after_fork
+def reset():
+    """Drop the parent's sampler; its thread didn't survive the fork.
+    """
+    global _sampler, _lock
+    _lock = threading.Lock()
+    if _sampler is not None:
+        _sampler.stop.set()
+        _sampler = None
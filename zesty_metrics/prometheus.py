@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""In-process metrics for Prometheus/OpenMetrics scraping.
+
+When ``ZESTY_PROMETHEUS`` is on, the middleware and the stat views feed
+``registry`` alongside StatsD, and ``views.PrometheusView`` renders it
+in the text exposition format. Tracker gauges are read from the values
+``report_metrics`` last stored in the cache, so a scrape never runs
+tracker queries.
+
+Each process keeps its own registry. With ``ZESTY_PROMETHEUS_DIR`` set,
+each also writes it to ``<pid>.json`` there every
+``ZESTY_PROMETHEUS_WRITE_INTERVAL`` seconds and at exit, and a scrape
+serves the sum over all of them, whichever worker it reaches. Files left
+by exited processes are folded into ``archive.json``, so counters never
+go backwards.
+"""
+import atexit
+import bisect
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.core.cache import cache
+
+from . import clients
+from . import conf
+
+logger = logging.getLogger('metrics')
+
+TRACKER_GAUGES_KEY = 'zesty_prometheus_tracker_gauges'
+ARCHIVE = 'archive.json'
+
+
+def escape(value):
+    return (u'%s' % value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+
+def format_value(value):
+    return repr(float(value))
+
+
+class Registry(object):
+    """Thread-safe counters, gauges and fixed-bucket histograms.
+
+    Series are keyed by metric name and a tuple of ``(label, value)``
+    pairs.
+    """
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or conf.PROMETHEUS_BUCKETS))
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            # When each gauge was set, so merging keeps the latest value.
+            self.gauge_times = {}
+            self.histograms = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def incr(self, name, value=1, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, labels=None, delta=False):
+        key = self._key(name, labels)
+        with self.lock:
+            if delta:
+                value += self.gauges.get(key, 0)
+            self.gauges[key] = value
+            self.gauge_times[key] = time.time()
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def collect(self):
+        """Return copies of the counters, gauges and histograms.
+        """
+        with self.lock:
+            return (dict(self.counters),
+                    dict(self.gauges),
+                    dict((key, [list(h[0]), h[1], h[2]])
+                         for key, h in self.histograms.items()))
+
+    def dump(self):
+        """Return the registry as JSON-serializable data, for ``merge``.
+        """
+        with self.lock:
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, labels, value]
+                             for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value, self.gauge_times[name, labels]]
+                           for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, labels, h[0], h[1], h[2]]
+                               for (name, labels), h in self.histograms.items()],
+            }
+
+    def merge(self, data):
+        """Add another registry's ``dump`` to this one.
+
+        Counters and histograms are summed; gauges keep the value set
+        last. Histograms with other buckets are skipped.
+        """
+        def key(name, labels):
+            return name, tuple(tuple(label) for label in labels)
+
+        with self.lock:
+            for name, labels, value in data['counters']:
+                k = key(name, labels)
+                self.counters[k] = self.counters.get(k, 0) + value
+            for name, labels, value, when in data['gauges']:
+                k = key(name, labels)
+                if when >= self.gauge_times.get(k, when):
+                    self.gauges[k] = value
+                    self.gauge_times[k] = when
+            if tuple(data['buckets']) != self.buckets:
+                return
+            for name, labels, counts, count, total in data['histograms']:
+                k = key(name, labels)
+                histogram = self.histograms.setdefault(k, [[0] * len(self.buckets), 0, 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += count
+                histogram[2] += total
+
+    def render(self, extra_gauges=None):
+        """Render all series in the Prometheus text exposition format.
+        """
+        counters, gauges, histograms = self.collect()
+        gauges.update(extra_gauges or {})
+        lines = []
+
+        def by_name(series):
+            names = {}
+            for (name, labels), value in series.items():
+                names.setdefault(name, []).append((labels, value))
+            return sorted((name, sorted(values)) for name, values in names.items())
+
+        for name, series in by_name(counters):
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in series:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+        for name, series in by_name(gauges):
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in series:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+        for name, series in by_name(histograms):
+            lines.append('# TYPE %s histogram' % name)
+            for labels, (counts, count, total) in series:
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    le = labels + (('le', format_value(bound)),)
+                    lines.append('%s_bucket%s %d' % (name, format_labels(le), cumulative))
+                le = labels + (('le', '+Inf'),)
+                lines.append('%s_bucket%s %d' % (name, format_labels(le), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+# Sharing metrics between processes.
+
+def write(path, data):
+    """Replace the JSON file at ``path`` atomically.
+    """
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp, path)
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def save():
+    """Write this process's registry to ``ZESTY_PROMETHEUS_DIR``.
+    """
+    if not os.path.isdir(conf.PROMETHEUS_DIR):
+        os.makedirs(conf.PROMETHEUS_DIR)
+    write(os.path.join(conf.PROMETHEUS_DIR, '%d.json' % os.getpid()), registry.dump())
+
+
+def collect_processes(directory):
+    """Return a ``Registry`` merging every process's file in ``directory``.
+
+    Files of processes that have exited are folded into the archive and
+    removed, under a lock so concurrent scrapes don't count them twice.
+    """
+    merged = Registry()
+    lock_fd = os.open(os.path.join(directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, ARCHIVE)
+        archive = read(archive_path)
+        exited = []
+        for filename in os.listdir(directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            path = os.path.join(directory, filename)
+            data = read(path)
+            if data is None:
+                continue
+            if alive(int(pid)):
+                merged.merge(data)
+            else:
+                exited.append((path, data))
+        if exited:
+            archived = Registry()
+            for data in [archive] + [data for path, data in exited]:
+                if data is not None:
+                    archived.merge(data)
+            archive = archived.dump()
+            write(archive_path, archive)
+            for path, data in exited:
+                os.remove(path)
+        if archive is not None:
+            merged.merge(archive)
+    finally:
+        os.close(lock_fd)
+    return merged
+
+
+class Writer(threading.Thread):
+    """Save this process's registry every ``interval`` seconds.
+    """
+    daemon = True
+
+    def __init__(self, interval):
+        super(Writer, self).__init__(name='zesty-metrics-prometheus')
+        self.interval = interval
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                save()
+            except Exception:
+                logger.exception('Error writing Prometheus metrics.')
+
+
+_writer = None
+_lock = threading.Lock()
+
+
+def start_writer():
+    """Start this process's ``Writer``, if ``ZESTY_PROMETHEUS_DIR`` is set.
+    """
+    global _writer
+    if conf.PROMETHEUS_DIR and _writer is None:
+        with _lock:
+            if _writer is None:
+                writer = Writer(conf.PROMETHEUS_WRITE_INTERVAL)
+                writer.start()
+                _writer = writer
+
+
+@atexit.register
+def save_at_exit():
+    if _writer is not None:
+        try:
+            save()
+        except Exception:
+            logger.exception('Error writing Prometheus metrics.')
+
+
+@clients.after_fork
+def reset():
+    """Start the child afresh; the parent's metrics are in its own file.
+    """
+    global _writer, _lock
+    _lock = threading.Lock()
+    if _writer is not None:
+        _writer.stop.set()
+        _writer = None
+    registry.clear()
+
+
+# Hooks, called from the middleware and views.
+
+def record_request(view_name, seconds, size=None):
+    if conf.PROMETHEUS:
+        start_writer()
+        labels = {'view': view_name}
+        registry.incr('zesty_view_requests_total', labels=labels)
+        if seconds:
+            registry.observe('zesty_view_response_seconds', seconds, labels=labels)
+        if size is not None:
+            registry.incr('zesty_view_response_bytes_total', size, labels=labels)
+
+
+def record_exception(view_name):
+    if conf.PROMETHEUS:
+        start_writer()
+        registry.incr('zesty_view_exceptions_total', labels={'view': view_name})
+
+
+def record_stat(method, stat, unit='ms', **kwargs):
+    """Mirror a client-side StatsD call; ``unit`` is that of timings,
+    ``'ms'`` or ``'s'``.
+    """
+    if not conf.PROMETHEUS:
+        return
+    start_writer()
+    labels = {'stat': stat}
+    if method == 'incr':
+        registry.incr('zesty_client_increments_total', kwargs.get('count', 1), labels)
+    elif method == 'decr':
+        registry.incr('zesty_client_decrements_total', kwargs.get('count', 1), labels)
+    elif method == 'timing':
+        seconds = kwargs['delta'] / 1000.0 if unit == 'ms' else kwargs['delta']
+        registry.observe('zesty_client_timing_seconds', seconds, labels)
+    elif method == 'gauge':
+        registry.gauge('zesty_client_gauge', kwargs['value'], labels,
+                       delta=kwargs.get('delta', False))
+
+
+def store_tracker_gauges(values):
+    """Remember reported tracker gauges (``{gauge name: value}``) for scrapes.
+    """
+    if conf.PROMETHEUS and values:
+        gauges = cache.get(TRACKER_GAUGES_KEY) or {}
+        gauges.update(values)
+        cache.set(TRACKER_GAUGES_KEY, gauges, None)
+
+
+def tracker_gauges():
+    gauges = cache.get(TRACKER_GAUGES_KEY) or {}
+    return dict((('zesty_tracker', (('name', name),)), value)
+                for name, value in gauges.items())
+
+
+def render():
+    if conf.PROMETHEUS_DIR:
+        save()
+        return collect_processes(conf.PROMETHEUS_DIR).render(tracker_gauges())
+    return registry.render(tracker_gauges())
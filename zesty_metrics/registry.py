@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Guard rails for stat names that come from clients.
+"""
+import re
+import threading
+import time
+
+from . import conf
+
+
+def stat_name(name, default='other'):
+    """Make ``name`` (e.g. a template path) usable as one stat name component.
+    """
+    return re.sub(r'[^\w-]+', '_', name).strip('_') or default
+
+
+def compile_patterns(patterns):
+    """Compile shell-style patterns (``*`` and ``?``) into one regex.
+    """
+    translated = [
+        re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.')
+        for pattern in patterns
+    ]
+    return re.compile(r'(?:%s)\Z' % '|'.join(translated))
+
+
+class StatNameRegistry(object):
+    """Allowlist of stat name patterns, plus a cardinality limit.
+
+    At most ``limit`` distinct names are let through per ``window``
+    seconds; later new names, and names matching none of ``patterns``,
+    are folded into the ``other`` stat. Memory is bounded by ``limit``.
+    ``patterns=None`` allows every name, ``limit=None`` any number.
+    """
+    REJECTED = 'rejected'
+    OVERFLOW = 'overflow'
+
+    def __init__(self, patterns=None, limit=None, window=60 * 60, other='other'):
+        self.pattern = compile_patterns(patterns) if patterns is not None else None
+        self.limit = limit
+        self.window = window
+        self.other = other
+        self.seen = set()
+        self.window_start = time.time()
+        self.lock = threading.Lock()
+
+    def allowed(self, name):
+        return self.pattern is None or self.pattern.match(name) is not None
+
+    def resolve(self, name, tagged=None):
+        """Return ``(stat name to emit, reason)`` for a requested name.
+
+        ``tagged`` is ``name`` with its client tags, if any: the patterns
+        check ``name``, and each distinct ``tagged`` counts toward the
+        limit, since every tag value makes a new series.
+        ``reason`` is ``None``, ``REJECTED`` or ``OVERFLOW``.
+        """
+        if not self.allowed(name):
+            return self.other, self.REJECTED
+        if tagged is not None:
+            name = tagged
+        if self.limit is None:
+            return name, None
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.window:
+                self.seen.clear()
+                self.window_start = now
+            if name in self.seen:
+                return name, None
+            if len(self.seen) < self.limit:
+                self.seen.add(name)
+                return name, None
+        return self.other, self.OVERFLOW
+
+
+default_registry = StatNameRegistry(
+    patterns = conf.ALLOWED_STATS,
+    limit = conf.STAT_CARDINALITY_LIMIT,
+    window = conf.STAT_CARDINALITY_WINDOW,
+    other = conf.STAT_OTHER,
+)
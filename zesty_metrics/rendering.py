@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Template rendering time per request.
+
+With ``ZESTY_TIME_TEMPLATES`` on, ``install()`` wraps Django's
+``Template.render``, which every template goes through, including
+``{% include %}``d ones. Times are only accumulated in a thread-local
+while the request runs; the middleware sends one total and the slowest
+template for the whole request.
+"""
+import threading
+import time
+from functools import wraps
+
+_local = threading.local()
+
+
+def start():
+    """Forget the templates rendered for the previous request.
+    """
+    _local.stack = []
+    _local.total = 0.0
+    _local.count = 0
+    _local.templates = {}
+
+
+def finish():
+    """Stop timing; return ``(total seconds, templates rendered,
+    {name: own seconds})`` for the request.
+
+    Nested renders count towards the total once; a template's own time
+    excludes the templates rendered inside it.
+    """
+    if getattr(_local, 'stack', None) is None:
+        return 0.0, 0, {}
+    _local.stack = None
+    return _local.total, _local.count, _local.templates
+
+
+def timed(render):
+    @wraps(render)
+    def wrapper(self, context):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            # Outside a request.
+            return render(self, context)
+        frame = [0.0]
+        stack.append(frame)
+        started = time.time()
+        try:
+            return render(self, context)
+        finally:
+            elapsed = time.time() - started
+            stack.pop()
+            name = self.name or 'UNKNOWN'
+            _local.templates[name] = _local.templates.get(name, 0.0) + elapsed - frame[0]
+            _local.count += 1
+            if stack:
+                stack[-1][0] += elapsed
+            else:
+                _local.total += elapsed
+    wrapper.zesty_timed = True
+    return wrapper
+
+
+def install():
+    """Time ``django.template.base.Template.render``; safe to call twice.
+    """
+    from django.template.base import Template
+    if not getattr(Template.render, 'zesty_timed', False):
+        Template.render = timed(Template.render)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Routing of tracker and report reads to a read replica.
+
+Only analytical reads are routed; everything written, and anything
+read in order to be written, stays on the primary.
+"""
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models import Max
+
+from . import conf
+
+logger = logging.getLogger('metrics')
+
+
+def replication_lag(alias):
+    """Seconds the ``alias`` database is behind the primary.
+
+    Measured as the difference between the latest ``last_seen`` on
+    each; both lookups are served by its index.
+    """
+    from .models import LastSeenData
+
+    def latest(db):
+        return LastSeenData.objects.using(db).aggregate(
+            latest=Max('last_seen'))['latest']
+
+    primary = latest(DEFAULT_DB_ALIAS)
+    if primary is None:
+        return 0.0
+    replica = latest(alias)
+    if replica is None:
+        return float('inf')
+    return max((primary - replica).total_seconds(), 0.0)
+
+
+def read_database(alias=None, max_lag=None):
+    """Database alias to read tracker data from.
+
+    ``alias`` defaults to ``ZESTY_READ_DB`` and ``max_lag`` to
+    ``ZESTY_READ_DB_MAX_LAG``. Falls back to the primary when no
+    replica is configured, when it can't be reached, or when it is more
+    than ``max_lag`` seconds behind.
+    """
+    alias = alias or conf.READ_DB
+    if max_lag is None:
+        max_lag = conf.READ_DB_MAX_LAG
+    if not alias or alias == DEFAULT_DB_ALIAS:
+        return DEFAULT_DB_ALIAS
+    try:
+        connections[alias].ensure_connection()
+        if max_lag is not None:
+            lag = replication_lag(alias)
+            if lag > max_lag:
+                logger.warning('Database %s is %.0fs behind; reading from %s.',
+                               alias, lag, DEFAULT_DB_ALIAS)
+                return DEFAULT_DB_ALIAS
+    except DatabaseError:
+        logger.warning('Database %s is unavailable; reading from %s.',
+                       alias, DEFAULT_DB_ALIAS, exc_info=True)
+        return DEFAULT_DB_ALIAS
+    return alias
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Per-host aggregation of view metrics across worker processes.
+
+With ``ZESTY_SHARED_METRICS_PATH`` set (ideally under ``/dev/shm``),
+every worker on a host adds its ``view.*`` counters into one
+memory-mapped file of fixed-size slots instead of sending its own
+packets. One worker at a time holds the flusher lock and sends the
+per-host totals every ``ZESTY_SHARED_FLUSH_INTERVAL`` seconds. The file
+outlives workers: when the flushing worker exits, the kernel releases
+its lock and another worker takes over, flushing whatever accumulated
+in the meantime.
+
+Each slot is guarded by a striped thread lock plus an ``fcntl`` lock on
+its byte range, so increments from threads and processes don't race.
+Timings aren't aggregated here: StatsD needs every value to compute
+their distribution, so they stay on each process's own pipeline.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from hashlib import md5
+
+from . import clients
+from . import conf
+
+logger = logging.getLogger('metrics')
+
+NAME_SIZE = 240
+# key hash, count, name: 256 bytes per slot.
+SLOT = struct.Struct('<Qq%ds' % NAME_SIZE)
+COUNT = struct.Struct('<q')
+HASH = struct.Struct('<Q')
+STRIPES = 64
+
+
+class SharedAggregator(object):
+    """Counters aggregated in a shared memory-mapped file.
+
+    Has the ``incr``/``send`` interface of a StatsD pipeline. Stats that
+    don't fit in the table, or whose names don't fit in a slot, go to
+    ``fallback`` directly.
+    """
+    def __init__(self, path, slots, fallback=None):
+        self.path = path
+        self.slots = slots
+        self.fallback = fallback
+        size = SLOT.size * slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, size)
+        self.index = {}
+        self.stripes = [threading.Lock() for i in range(STRIPES)]
+        self.leader_fd = None
+        self.flusher = None
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.stop.set()
+        self.map.close()
+        os.close(self.fd)
+        if self.leader_fd is not None:
+            os.close(self.leader_fd)
+
+    @contextmanager
+    def locked(self, i):
+        with self.stripes[i % STRIPES]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT.size, i * SLOT.size)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT.size, i * SLOT.size)
+
+    def slot(self, name):
+        """Find or claim the slot for ``name``; ``None`` if the table is
+        full or the name is too long to store.
+        """
+        i = self.index.get(name)
+        if i is not None:
+            return i
+        encoded = name.encode('utf-8')
+        if len(encoded) > NAME_SIZE:
+            # Truncated, it could collide with another name.
+            return None
+        key = HASH.unpack(md5(encoded).digest()[:8])[0] or 1
+        start = key % self.slots
+        for probe in range(self.slots):
+            i = (start + probe) % self.slots
+            with self.locked(i):
+                found, count, found_name = SLOT.unpack_from(self.map, i * SLOT.size)
+                if found == 0:
+                    SLOT.pack_into(self.map, i * SLOT.size, key, 0, encoded)
+                elif found != key or found_name.rstrip(b'\0') != encoded:
+                    continue
+            self.index[name] = i
+            return i
+        return None
+
+    def add(self, name, count):
+        i = self.slot(name)
+        if i is None:
+            return False
+        offset = i * SLOT.size + HASH.size
+        with self.locked(i):
+            COUNT.pack_into(self.map, offset, COUNT.unpack_from(self.map, offset)[0] + count)
+        return True
+
+    def incr(self, stat, count=1, rate=1):
+        if not self.add(stat, count) and self.fallback is not None:
+            self.fallback.incr(stat, count, rate)
+
+    def send(self):
+        # Sent by the flusher.
+        pass
+
+    def drain(self):
+        """Reset every slot; return ``[(name, count)]``.
+        """
+        drained = []
+        for i in range(self.slots):
+            offset = i * SLOT.size
+            if HASH.unpack_from(self.map, offset)[0] == 0:
+                continue
+            with self.locked(i):
+                key, count, name = SLOT.unpack_from(self.map, offset)
+                if count:
+                    COUNT.pack_into(self.map, offset + HASH.size, 0)
+            if count:
+                drained.append((name.rstrip(b'\0').decode('utf-8', 'replace'), count))
+        return drained
+
+    def flush(self, client):
+        """Send and reset the per-host totals.
+        """
+        pipeline = clients.get_pipeline(client)
+        for name, count in self.drain():
+            pipeline.incr(name, count)
+        try:
+            pipeline.send()
+        except (AttributeError, IndexError):
+            # Not a pipeline, or nothing to send.
+            pass
+
+    def lead(self):
+        """Try to become this host's flusher. Returns True if we are.
+        """
+        if self.leader_fd is None:
+            self.leader_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.leader_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def start_flusher(self, interval):
+        self.flusher = Flusher(self, interval)
+        self.flusher.start()
+
+
+class Flusher(threading.Thread):
+    """Flush the shared totals while this process holds the flusher lock.
+    """
+    daemon = True
+
+    def __init__(self, aggregator, interval):
+        super(Flusher, self).__init__(name='zesty-metrics-flusher')
+        self.aggregator = aggregator
+        self.interval = interval
+        self.stop = threading.Event()
+
+    def run(self):
+        leader = False
+        while not self.stop.wait(self.interval):
+            try:
+                leader = leader or self.aggregator.lead()
+                if leader:
+                    self.aggregator.flush(clients.get_client())
+            except Exception:
+                logger.exception('Error flushing shared metrics.')
+
+
+_aggregator = None
+_lock = threading.Lock()
+
+
+def get_aggregator():
+    """Return this process's ``SharedAggregator``, or ``None`` if disabled.
+    """
+    global _aggregator
+    if not conf.SHARED_METRICS_PATH:
+        return None
+    if _aggregator is None:
+        with _lock:
+            if _aggregator is None:
+                aggregator = SharedAggregator(conf.SHARED_METRICS_PATH,
+                                              conf.SHARED_METRICS_SLOTS,
+                                              fallback=clients.get_client())
+                aggregator.start_flusher(conf.SHARED_FLUSH_INTERVAL)
+                _aggregator = aggregator
+    return _aggregator
+
+
+@clients.after_fork
+def reset():
+    """Drop the parent's aggregator; its flusher thread didn't survive the fork.
+    """
+    global _aggregator, _lock
+    _lock = threading.Lock()
+    if _aggregator is not None:
+        _aggregator.close()
+        _aggregator = None
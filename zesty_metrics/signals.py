@@ -1,23 +1,86 @@
 # -*- coding: utf-8 -*-
+import datetime
+import threading
+from contextlib import contextmanager
+
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.db.models.signals import post_save
 from django.contrib.auth.signals import user_logged_in
 
-from statsd import statsd
+from .clients import get_client
+
+_bulk = threading.local()
+
+
+@contextmanager
+def bulk_user_import():
+    """Defer per-user signal work for users created inside the block.
+
+    New users are collected instead of each getting an increment and an
+    INSERT; on exit their ``LastSeenData`` rows are created with one
+    ``bulk_create`` and ``users.new`` is incremented once. Nested blocks
+    join the outermost one. If the block raises, nothing is recorded;
+    the middleware creates ``LastSeenData`` when those users show up.
+
+    Usage::
+
+        with zesty_metrics.bulk_user_import():
+            for row in rows:
+                User.objects.create(username=row['username'])
+    """
+    if getattr(_bulk, 'users', None) is not None:
+        yield
+        return
+
+    _bulk.users = users = []
+    try:
+        yield
+    finally:
+        _bulk.users = None
+    record_new_users(users)
+
+
+def record_new_users(users):
+    """Create ``LastSeenData`` for, and count, newly created users.
+    """
+    if not users:
+        return
+    from . import models
+    now = datetime.datetime.now()
+    models.LastSeenData.objects.bulk_create(
+        [models.LastSeenData(user=user, earliest_activity=now) for user in users],
+        batch_size=1000,
+    )
+    days = {}
+    for user in users:
+        day = models.signup_day(user.date_joined)
+        days[day] = days.get(day, 0) + 1
+    for day, count in sorted(days.items()):
+        models.DailySignupCount.objects.record(day, count)
+    get_client().incr("users.new", len(users))
 
 
 @receiver(post_save, sender=User)
 def handle_new_user(sender, instance, created, **kwargs):
     if created:
+        users = getattr(_bulk, 'users', None)
+        if users is not None:
+            # Deferred to the end of bulk_user_import().
+            users.append(instance)
+            return
+
         # Increment new usercount
-        statsd.incr("users.new")
+        get_client().incr("users.new")
 
         # Create LastSeenData object.
         from . import models
         models.LastSeenData.objects.create(user=instance)
 
+        # Count the signup towards its day.
+        models.DailySignupCount.objects.record(models.signup_day(instance.date_joined))
+
 
 @receiver(user_logged_in)
 def handle_user_login(sender, request, user, **kwargs):
-    statsd.incr("users.login")
+    get_client().incr("users.login")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Tagged stat names, for StatsD servers that take dimensions as tags.
+
+By default the view, HTTP method, AJAX flag and browser are part of
+each stat's name (``view.<module>.<func>.<method>_ajax``,
+``browsers.<family>``), which makes a series per combination. With
+``ZESTY_TAG_FORMAT`` set, those stats are sent under a few fixed names
+(``view.response-time``, ``view.requests``, ...) with the dimensions as
+tags, encoded in the stat name the way the server expects:
+
+- ``'dogstatsd'``: ``name:1|c|#view:a.b,method:get`` (DogStatsD, and
+  servers that accept its extension); sent by ``clients.TaggedStatsClient``
+- ``'influx'``: ``name,view=a.b,method=get:1|c`` (Telegraf's statsd input)
+- ``'graphite'``: ``name;view=a.b;method=get:1|c`` (Graphite 1.1 tags)
+"""
+import re
+
+from . import conf
+
+DOGSTATSD_TAGS = '|#'
+
+_invalid_key = re.compile(r'[^A-Za-z0-9_]+')
+_invalid_value = re.compile(r'[^A-Za-z0-9_./-]+')
+
+
+def clean_tags(tags):
+    """``[(key, value)]`` sorted, with characters no format allows replaced.
+    """
+    return sorted(
+        (_invalid_key.sub('_', u'%s' % key),
+         _invalid_value.sub('_', (u'%s' % value).replace(' ', '-')) or '_')
+        for key, value in tags.items()
+        if value is not None
+    )
+
+
+def dogstatsd(name, tags):
+    return name + DOGSTATSD_TAGS + ','.join('%s:%s' % tag for tag in tags)
+
+
+def influx(name, tags):
+    return ','.join([name] + ['%s=%s' % tag for tag in tags])
+
+
+def graphite(name, tags):
+    return ';'.join([name] + ['%s=%s' % tag for tag in tags])
+
+
+FORMATS = {
+    'dogstatsd': dogstatsd,
+    'influx': influx,
+    'graphite': graphite,
+}
+
+
+def tagged(name, tags, tag_format=None):
+    """Stat name for ``name`` with ``tags`` (a dict) in ``tag_format``
+    (default ``ZESTY_TAG_FORMAT``).
+    """
+    tags = clean_tags(tags or {})
+    if not tags:
+        return name
+    return FORMATS[tag_format or conf.TAG_FORMAT](name, tags)
+
+
+def view_tags(view_name):
+    """Tags for a ``view.<module>.<func>.<method>[_ajax]`` view name.
+    """
+    parts = view_name.split('.')
+    if len(parts) < 3 or parts[0] != 'view':
+        return {'view': view_name}
+    method = parts[-1]
+    ajax = method.endswith('_ajax')
+    if ajax:
+        method = method[:-len('_ajax')]
+    return {
+        'view': '.'.join(parts[1:-1]),
+        'method': method,
+        'ajax': 'true' if ajax else 'false',
+    }
+
+
+def view_stats(view_name, suffix, aggregate=False, **tags):
+    """Stat names to send a per-view metric to.
+
+    Untagged, that's ``<view>.<suffix>``, plus the ``view.<suffix>``
+    total if ``aggregate``. Tagged, it's ``view.<suffix>`` tagged with
+    the view and ``tags``; the total is the sum over tags.
+    """
+    if conf.TAG_FORMAT:
+        all_tags = view_tags(view_name)
+        all_tags.update(tags)
+        return [tagged('view.' + suffix, all_tags)]
+    names = [view_name + '.' + suffix]
+    if aggregate:
+        names.append('view.' + suffix)
+    return names
+
+
+def parse_tags(value):
+    """Parse client-supplied tags, ``key:value,key:value``, into a dict.
+    """
+    tags = {}
+    for pair in (value or '').split(','):
+        key, sep, tag_value = pair.partition(':')
+        if key.strip() and sep:
+            tags[key.strip()] = tag_value.strip()
+    return tags
+
+
+def client_tags(value):
+    """Tags from a client's ``tags`` parameter, with keys limited to
+    ``ZESTY_ALLOWED_TAGS``.
+    """
+    tags = parse_tags(value)
+    if conf.ALLOWED_TAGS is not None:
+        tags = dict((key, tag) for key, tag in tags.items() if key in conf.ALLOWED_TAGS)
+    return tags
+
+
+def tag_stat(name, tags):
+    """``name`` with ``tags`` if tagging is on, else just ``name``.
+
+    Pass it to ``StatNameRegistry.resolve`` with the bare name, so tag
+    values count toward the cardinality limit.
+    """
+    if not conf.TAG_FORMAT:
+        return name
+    return tagged(name, tags)
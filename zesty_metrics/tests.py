@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
-from datetime import date, timedelta
-
-from django.test.client import Client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time as time_module
+from datetime import date, datetime, timedelta
+from importlib import import_module
+
+from wsgiref.util import FileWrapper
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.template import Context, Engine
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.test.client import Client, RequestFactory
 from django.test import TestCase
 
+from django.apps import apps
+from django.core import exceptions
 from django.core.cache import cache
+from django.db import OperationalError
 from django.contrib.auth.models import User
 
 from mock import Mock, patch, call
@@ -14,9 +29,24 @@ import six
 import statsd
 from user_agents import parse as parse_ua
 
+import zesty_metrics
+from zesty_metrics import background
+from zesty_metrics import beacons
+from zesty_metrics import caching
+from zesty_metrics import clients
+from zesty_metrics import conf
+from zesty_metrics import funnels
+from zesty_metrics import profiling
+from zesty_metrics import prometheus
 from zesty_metrics import middleware
 from zesty_metrics import views
 from zesty_metrics import models
+from zesty_metrics import registry
+from zesty_metrics import rendering
+from zesty_metrics import routing
+from zesty_metrics import shared
+from zesty_metrics import tagging
+from zesty_metrics import tracking
 from zesty_metrics.management.commands import cleanup
 from zesty_metrics.management.commands import report_metrics
 
@@ -132,18 +162,74 @@ class ActivityTests(ClientTestCase):
         self.assertEqual(activity.count(), 2)
 
 
+class ActivityDedupeTests(ClientTestCase):
+    def setUp(self):
+        super(ActivityDedupeTests, self).setUp()
+        cache.clear()
+        models.recent_activity.clear()
+        # Run commit hooks right away; the test transaction never commits.
+        patcher = patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(models.recent_activity.clear)
+        self.addCleanup(cache.clear)
+
+    def record(self, what='foo'):
+        models.DailyActivityRecord.objects.record_activity(self.user, what)
+
+    def test_repeats_should_not_touch_the_database(self):
+        self.record()
+        with self.assertNumQueries(0):
+            self.record()
+        self.assertEqual(models.DailyActivityRecord.objects.count(), 1)
+
+    def test_other_processes_should_skip_repeats_through_the_cache(self):
+        self.record()
+        models.recent_activity.clear()
+        with self.assertNumQueries(0):
+            self.record()
+
+        with patch.object(conf, 'ACTIVITY_DEDUPE_CACHE', False):
+            models.recent_activity.clear()
+            with self.assertNumQueries(4):
+                # The failing INSERT, in and out of its savepoint.
+                self.record()
+
+    def test_activity_should_be_recorded_again_the_next_day(self):
+        self.record()
+        self.record('bar')
+        with patch_today(TOMORROW):
+            self.record()
+        self.assertEqual(models.DailyActivityRecord.objects.count(), 3)
+
+    def test_recent_activity_should_be_bounded(self):
+        recent = models.RecentActivity(2)
+        today = date.today()
+        recent.add('a', today)
+        recent.add('b', today)
+        recent.add('c', today)
+        self.assertFalse(recent.seen('a', today))
+        self.assertTrue(recent.seen('c', today))
+        self.assertFalse(recent.seen('c', TOMORROW))
+
+
 class MockedStatsdTestCase(ClientTestCase):
     def setUp(self):
         self.original_pipeline = middleware.MetricsMiddleware.scope.pipeline
-        self.patched_pipeline = middleware.MetricsMiddleware.scope.pipeline = Mock()
         self.patched_StatsClient = Mock()
         self.original_StatsClient = statsd.StatsClient
         statsd.StatsClient = lambda *a, **k: self.patched_StatsClient
+        # Resetting also clears the middleware scope, so patch after.
+        clients.reset()
+        self.patched_pipeline = middleware.MetricsMiddleware.scope.pipeline = Mock()
         super(MockedStatsdTestCase, self).setUp()
+        # Forget the signup/login stats sent while setting up the user.
+        self.patched_StatsClient.reset_mock()
 
     def tearDown(self):
         middleware.MetricsMiddleware.scope.pipeline = self.original_pipeline
         statsd.StatsClient = self.original_StatsClient
+        clients.reset()
         super(MockedStatsdTestCase, self).tearDown()
 
 
@@ -212,6 +298,20 @@ class IncrViewTests(MockedStatsdTestCase):
         )
 
 
+class StatNameRegistryViewTests(MockedStatsdTestCase):
+    def test_disallowed_names_should_be_folded_into_other(self):
+        allowlist = registry.StatNameRegistry(patterns=['signup.*'])
+        with patch.object(views.StatView, 'registry', allowlist):
+            self.client.get('/metrics/incr/signup.clicked/')
+            self.client.get('/metrics/incr/evil/')
+
+        self.patched_StatsClient.incr.assert_has_calls([
+            call('signup.clicked', count=1, rate=1.0),
+            call('stats.rejected'),
+            call('other', count=1, rate=1.0),
+        ])
+
+
 class DecrViewTests(IncrViewTests):
     method = 'decr'
     stat_name = 'foo'
@@ -235,6 +335,212 @@ class GaugeViewTests(IncrViewTests):
     optional_data = {'delta': True}
 
 
+class FastIncrViewTests(IncrViewTests):
+    def get_url(self):
+        return '/beacons/%s/%s/' % (self.method, self.stat_name)
+
+    def test_it_should_respond_like_the_form_view(self):
+        cases = [{}, {'count': ''}, {'count': 'x'}, {'count': '2.0'},
+                 {'rate': 'nan'}, {'delta': ''}, {'delta': 'x'},
+                 {'value': '1.5'}, {'value': '1', 'delta': 'false'}]
+        form_url = '/metrics/%s/%s/' % (self.method, self.stat_name)
+        for data in cases:
+            for method in ('get', 'post'):
+                expected = getattr(self.client, method)(form_url, data=data)
+                actual = getattr(self.client, method)(self.get_url(), data=data)
+                self.assertEqual(actual.status_code, expected.status_code, data)
+                if expected.status_code == 400:
+                    self.assertEqual(json.loads(actual.content.decode('utf-8')),
+                                     json.loads(expected.content.decode('utf-8')))
+                else:
+                    self.assertEqual(actual.content, expected.content)
+
+    def test_other_methods_should_not_be_allowed(self):
+        response = self.client.put(self.get_url())
+        self.assertEqual(response.status_code, 405)
+
+
+class FastDecrViewTests(FastIncrViewTests, DecrViewTests):
+    pass
+
+
+class FastTimingViewTests(FastIncrViewTests, TimingViewTests):
+    pass
+
+
+class FastGaugeViewTests(FastIncrViewTests, GaugeViewTests):
+    pass
+
+
+class BeaconApplicationTests(MockedStatsdTestCase):
+    def setUp(self):
+        super(BeaconApplicationTests, self).setUp()
+        self.django_app = Mock(return_value=[b'django'])
+        self.app = beacons.BeaconApplication(self.django_app)
+        self.factory = RequestFactory()
+
+    def call(self, request):
+        start_response = Mock()
+        body = b''.join(self.app(request.environ, start_response))
+        return start_response, body
+
+    def test_GET_should_answer_without_entering_django(self):
+        start_response, body = self.call(self.factory.get('/metrics/incr/foo/', {'count': 3}))
+        self.assertFalse(self.django_app.called)
+        self.assertEqual(start_response.call_args[0][0], '200 OK')
+        self.assertEqual(body, views.TRANSPARENT_1X1_PNG)
+        self.patched_StatsClient.incr.assert_called_once_with('foo', count=3, rate=1.0)
+
+    def test_urlencoded_POST_should_answer_without_entering_django(self):
+        start_response, body = self.call(self.factory.post(
+            '/metrics/gauge/foo/', 'value=2&delta=true',
+            content_type='application/x-www-form-urlencoded'))
+        self.assertEqual(start_response.call_args[0][0], '204 No Content')
+        self.patched_StatsClient.gauge.assert_called_once_with('foo', value=2.0, delta=True)
+
+    def test_invalid_data_should_return_the_errors(self):
+        start_response, body = self.call(self.factory.get('/metrics/timing/foo/'))
+        self.assertEqual(start_response.call_args[0][0], '400 Bad Request')
+        self.assertEqual(json.loads(body.decode('utf-8')), {'delta': ['This field is required.']})
+
+    def test_other_requests_should_pass_through_to_django(self):
+        for request in [self.factory.get('/metrics/activity/foo/'),
+                        self.factory.put('/metrics/incr/foo/'),
+                        self.factory.post('/metrics/incr/foo/', {'count': 2})]:
+            start_response, body = self.call(request)
+            self.assertEqual(body, b'django')
+        self.assertEqual(self.django_app.call_count, 3)
+
+
+class ResponseTimingTests(MockedStatsdTestCase):
+    def setUp(self):
+        super(ResponseTimingTests, self).setUp()
+        self.metrics = middleware.MetricsMiddleware()
+        self.metrics.scope.view_name = 'view.foo'
+        self.metrics.scope.request_start = 0
+        self.request = RequestFactory().get('/')
+
+    def tearDown(self):
+        del self.metrics.scope.view_name
+        del self.metrics.scope.request_start
+        super(ResponseTimingTests, self).tearDown()
+
+    def stats(self, method):
+        return [c[1][0] for c in getattr(self.patched_pipeline, method).mock_calls]
+
+    def test_it_should_count_response_bytes(self):
+        self.metrics.process_response(self.request, HttpResponse(b'hello'))
+        self.patched_pipeline.incr.assert_any_call('view.foo.bytes', 5)
+        self.assertEqual(self.stats('timing'), ['view.foo', 'view.aggregate-response-time'])
+
+    def test_streaming_responses_should_be_timed_until_the_end_of_the_stream(self):
+        response = self.metrics.process_response(
+            self.request, StreamingHttpResponse(iter([b'a,b\n', b'c,d\n'])))
+        self.assertFalse(self.patched_pipeline.timing.called)
+
+        self.assertEqual(b''.join(response.streaming_content), b'a,b\nc,d\n')
+        response.close()
+        self.assertEqual(self.stats('timing'), ['view.foo', 'view.aggregate-response-time',
+                                                'view.foo.ttfb'])
+        self.patched_pipeline.incr.assert_any_call('view.foo.bytes', 8)
+        self.assertEqual(self.stats('incr').count('view.foo.requests'), 1)
+
+    def test_file_responses_should_still_be_served_by_the_server(self):
+        content = six.BytesIO(b'x' * 10)
+        response = FileResponse(content)
+        response['Content-Length'] = '10'
+        response = self.metrics.process_response(self.request, response)
+        self.assertIs(response.file_to_stream.filelike, content)
+        self.assertEqual(response.file_to_stream.read(), b'x' * 10)
+
+    def test_file_responses_sent_by_a_file_wrapper_should_be_timed(self):
+        environ = RequestFactory().get('/download/').environ
+        environ['wsgi.file_wrapper'] = FileWrapper
+        start_response = Mock()
+        with self.settings(MIDDLEWARE_CLASSES=['zesty_metrics.middleware.MetricsMiddleware']):
+            result = WSGIHandler()(environ, start_response)
+            self.assertIsInstance(result, FileWrapper)
+            self.assertEqual(b''.join(result), b'x' * 10)
+            # What the server does when it's done; the response is never closed.
+            result.close()
+
+        self.patched_pipeline.incr.assert_any_call('view.tests.urls.download.get.bytes', 10)
+        self.patched_pipeline.incr.assert_any_call('view.tests.urls.download.get.requests')
+        self.assertIn('view.tests.urls.download.get', self.stats('timing'))
+
+
+class TemplateTimingTests(MockedStatsdTestCase):
+    def setUp(self):
+        super(TemplateTimingTests, self).setUp()
+        rendering.install()
+        patcher = patch.object(conf, 'TIME_TEMPLATES', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.engine = Engine(loaders=[('django.template.loaders.locmem.Loader', {
+            'pages/home.html': '{% for i in items %}{% include "row.html" %}{% endfor %}',
+            'row.html': '<p>{{ i }}</p>',
+        })])
+        self.metrics = middleware.MetricsMiddleware()
+        self.addCleanup(self.metrics.scope.__dict__.clear)
+        self.request = RequestFactory().get('/')
+
+    def test_it_should_time_templates_with_their_includes(self):
+        self.metrics.process_request(self.request)
+        self.metrics.scope.view_name = 'view.foo'
+        page = self.engine.get_template('pages/home.html').render(Context({'items': [1, 2, 3]}))
+        total, count, templates = rendering.finish()
+
+        self.assertEqual(page, '<p>1</p><p>2</p><p>3</p>')
+        self.assertEqual(count, 4)
+        self.assertEqual(sorted(templates), ['pages/home.html', 'row.html'])
+        self.assertTrue(total >= sum(templates.values()) - 1e-6)
+
+    def test_middleware_should_send_one_total_per_request(self):
+        self.metrics.process_request(self.request)
+        self.metrics.scope.view_name = 'view.foo'
+        with patch.object(rendering, 'finish', return_value=(
+                0.5, 4, {'pages/home.html': 0.1, 'row.html': 0.4})):
+            self.metrics.process_response(self.request, HttpResponse(b'page'))
+
+        self.patched_pipeline.timing.assert_any_call('view.foo.template.time', 0.5, 1)
+        self.patched_pipeline.timing.assert_any_call(
+            'view.foo.template.slowest.row_html', 0.4, 1)
+        self.patched_pipeline.incr.assert_any_call('view.foo.template.count', 4)
+
+
+class LatencyBreakdownTests(MockedStatsdTestCase):
+    def setUp(self):
+        super(LatencyBreakdownTests, self).setUp()
+        patcher = patch.object(conf, 'LATENCY_BREAKDOWN', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(middleware.MetricsMiddleware.scope.__dict__.clear)
+
+    def test_it_should_parse_request_start_headers(self):
+        parse = middleware.parse_request_start
+        self.assertEqual(parse('t=1500000000.5'), 1500000000.5)
+        self.assertEqual(parse('1500000000500'), 1500000000.5)
+        self.assertEqual(parse('t=1500000000500000'), 1500000000.5)
+        self.assertEqual(parse('1500000000500', unit='us'), 1500000.0005)
+        self.assertIsNone(parse('t=soon'))
+
+    def test_it_should_time_each_step_of_the_request(self):
+        settings = self.settings(MIDDLEWARE_CLASSES=[
+            'zesty_metrics.middleware.MetricsMiddleware',
+        ])
+        with settings:
+            queued = time_module.time() - 0.5
+            Client().get('/metrics/incr/foo/', HTTP_X_REQUEST_START='t=%.6f' % queued)
+
+        timings = dict((c[1][0].split('.latency.')[-1], c[1][1])
+                       for c in self.patched_pipeline.timing.mock_calls
+                       if '.latency.' in c[1][0] and c[1][0].startswith('view.zesty'))
+        self.assertEqual(sorted(timings), ['after_view', 'before_view', 'queue', 'view'])
+        self.assertTrue(timings['queue'] >= 0.5)
+        self.patched_pipeline.timing.assert_any_call('view.latency.queue',
+                                                     timings['queue'], 1)
+
+
 CHROME_UA = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/43.0.2357.130 Safari/537.36'
 
 
@@ -312,6 +618,113 @@ class ReportRequestRenderedViewTests(MockedStatsdTestCase):
         ])
 
 
+class TaggingTests(MockedStatsdTestCase):
+    def test_formats(self):
+        tags = {'view': 'app.home', 'browser': 'Mobile Safari', 'bad key': 'a,b=c|d'}
+        self.assertEqual(tagging.tagged('view.requests', tags, 'dogstatsd'),
+                         'view.requests|#bad_key:a_b_c_d,browser:Mobile-Safari,view:app.home')
+        self.assertEqual(tagging.tagged('view.requests', tags, 'influx'),
+                         'view.requests,bad_key=a_b_c_d,browser=Mobile-Safari,view=app.home')
+        self.assertEqual(tagging.tagged('view.requests', tags, 'graphite'),
+                         'view.requests;bad_key=a_b_c_d;browser=Mobile-Safari;view=app.home')
+        self.assertEqual(tagging.tagged('view.requests', {}, 'influx'), 'view.requests')
+
+    def test_view_tags(self):
+        self.assertEqual(tagging.view_tags('view.app.views.home.post_ajax'),
+                         {'view': 'app.views.home', 'method': 'post', 'ajax': 'true'})
+        self.assertEqual(tagging.view_tags('UNKNOWN'), {'view': 'UNKNOWN'})
+
+    def test_tagged_client_should_send_dogstatsd_tags_after_the_value(self):
+        client = clients.TaggedStatsClient(prefix='zesty')
+        pipeline = client.pipeline()
+        pipeline.incr(tagging.tagged('view.requests', {'view': 'home'}, 'dogstatsd'))
+        pipeline.timing('view.response-time', 5, rate=1)
+        with patch('random.random', return_value=0):
+            pipeline.timing(tagging.tagged('view.ttfb', {'view': 'home'}, 'dogstatsd'),
+                            2, rate=0.5)
+        self.assertEqual(pipeline._stats, [
+            'zesty.view.requests:1|c|#view:home',
+            'zesty.view.response-time:5|ms',
+            'zesty.view.ttfb:2|ms|@0.5|#view:home',
+        ])
+
+    def test_middleware_should_send_fixed_names_with_tags(self):
+        metrics = middleware.MetricsMiddleware()
+        metrics.scope.view_name = 'view.app.home.get'
+        metrics.scope.request_start = 0
+        try:
+            with patch.object(conf, 'TAG_FORMAT', 'influx'):
+                metrics.process_response(RequestFactory().get('/'), HttpResponse(b'hello'))
+        finally:
+            del metrics.scope.view_name
+            del metrics.scope.request_start
+
+        tags = ',ajax=false,method=get,view=app.home'
+        self.assertEqual([c[1][0] for c in self.patched_pipeline.timing.mock_calls],
+                         ['view.response-time' + tags])
+        self.patched_pipeline.incr.assert_has_calls([
+            call('view.bytes' + tags, 5),
+            call('view.requests' + tags),
+        ])
+
+    def test_stat_views_should_accept_tags(self):
+        with patch.object(conf, 'TAG_FORMAT', 'graphite'):
+            self.client.get('/metrics/incr/signup/', {'tags': 'plan:pro,source:ad'})
+            self.client.get('/beacons/incr/signup/', {'tags': 'plan:pro'})
+        self.client.get('/metrics/incr/signup/', {'tags': 'plan:pro'})
+
+        self.patched_StatsClient.incr.assert_has_calls([
+            call('signup;plan=pro;source=ad', count=1, rate=1.0),
+            call('signup;plan=pro', count=1, rate=1.0),
+            call('signup', count=1, rate=1.0),
+        ])
+
+    def test_allowlists_should_apply_to_bare_names_and_tag_keys(self):
+        allowlist = registry.StatNameRegistry(patterns=['js.load'])
+        with patch.object(conf, 'TAG_FORMAT', 'influx'), \
+                patch.object(conf, 'ALLOWED_TAGS', ['page']), \
+                patch.object(views.StatView, 'registry', allowlist):
+            self.client.get('/metrics/incr/js.load/', {'tags': 'page:home,user:42'})
+            self.client.get('/metrics/incr/js.other/', {'tags': 'page:home'})
+            self.client.get('/beacons/incr/signup/', {'tags': 'user:42'})
+
+        self.patched_StatsClient.incr.assert_has_calls([
+            call('js.load,page=home', count=1, rate=1.0),
+            call('stats.rejected'),
+            call('other', count=1, rate=1.0),
+            call('signup', count=1, rate=1.0),
+        ])
+
+    def test_cardinality_limit_should_count_tag_values(self):
+        limited = registry.StatNameRegistry(limit=2)
+        with patch.object(conf, 'TAG_FORMAT', 'dogstatsd'), \
+                patch.object(views.StatView, 'registry', limited):
+            for i in range(4):
+                self.client.get('/metrics/incr/foo/', {'tags': 'id:%d' % i})
+            beacons.send('incr', 'foo', {'count': 1, 'rate': 1.0}, {'id': '9'},
+                         registry=limited)
+
+        sent = [c[1][0] for c in self.patched_StatsClient.incr.mock_calls]
+        self.assertEqual(sent, ['foo|#id:0', 'foo|#id:1',
+                                'stats.overflow', 'other',
+                                'stats.overflow', 'other',
+                                'stats.overflow', 'other'])
+
+    def test_rum_report_should_tag_view_and_browser(self):
+        cache.set('request:foo', {
+            'started': 5000,
+            'agent': parse_ua(CHROME_UA),
+            'view_name': 'view.app.home.get',
+        })
+        with patch.object(conf, 'TAG_FORMAT', 'dogstatsd'), \
+                patch('time.time', return_value=5500):
+            self.client.get('/metrics/report-request-rendered/foo/')
+
+        self.patched_StatsClient.timing.assert_called_once_with(
+            'view.client-time|#ajax:false,browser:Chrome,method:get,view:app.home',
+            delta=500)
+
+
 class CleanupCommandTests(ClientTestCase):
     def setUp(self):
         super(CleanupCommandTests, self).setUp()
@@ -358,3 +771,1071 @@ class ReportMetricsCommandTests(TestCase):
                     20,
                 ),
             ])
+
+    def test_daemon_tick_should_report_due_metrics_and_reschedule_them(self):
+        reporter = report_metrics.Command()
+        tracker = reporter._import_tracker('tests.trackers.TestTracker')
+        entries = reporter.schedule([tracker], 60)
+        now = max(entry[0] for entry in entries)
+
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch(pipeline_p) as patched:
+            next_due = reporter.tick(entries, 0, now=now)
+            self.assertEqual(next_due, now + 60)
+            patched.gauge.assert_called_once_with('things.foo', 5)
+            patched.incr.assert_called_once_with('stuff.bar', 20)
+
+            patched.reset_mock()
+            reporter.tick(entries, 0, now=now + 60)
+            patched.gauge.assert_called_once_with('things.foo', 5)
+            self.assertFalse(patched.incr.called)
+
+    def test_report_lock_should_let_one_host_report_per_interval(self):
+        cache.clear()
+        leader = report_metrics.Command()
+        follower = report_metrics.Command()
+
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch.object(conf, 'REPORT_LOCK', True), patch(pipeline_p) as patched:
+            leader.handle(interval=60)
+            self.assertEqual(patched.gauge.call_count, 1)
+
+            patched.reset_mock()
+            follower.handle(interval=60)
+            self.assertFalse(patched.gauge.called)
+            self.assertFalse(patched.incr.called)
+
+    def test_report_lock_should_expire_with_the_interval(self):
+        cache.clear()
+        reporter = report_metrics.Command()
+        with patch.object(conf, 'REPORT_LOCK', True):
+            self.assertTrue(reporter._claim('test', 60, now=120))
+            self.assertFalse(reporter._claim('test', 60, now=179))
+            self.assertTrue(reporter._claim('test', 60, now=180))
+
+    def test_daemon_tick_should_skip_metrics_claimed_by_another_host(self):
+        cache.clear()
+        reporter = report_metrics.Command()
+        tracker = reporter._import_tracker('tests.trackers.TestTracker')
+        entries = reporter.schedule([tracker], 60)
+        now = max(entry[0] for entry in entries)
+
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch.object(conf, 'REPORT_LOCK', True), patch(pipeline_p) as patched:
+            reporter._claim('%s.foo' % tracker.snapshot_name(), 60, now)
+            next_due = reporter.tick(entries, 0, now=now)
+            self.assertFalse(patched.gauge.called)
+            patched.incr.assert_called_once_with('stuff.bar', 20)
+            self.assertEqual(next_due, now + 60)
+
+    def test_daemon_should_run_until_stopped(self):
+        reporter = report_metrics.Command()
+
+        def tick(entries, jitter):
+            reporter.stop.set()
+            return 0
+
+        with patch.object(reporter, 'tick', side_effect=tick) as patched:
+            reporter.handle(daemon=True, interval=60, jitter=0)
+        self.assertEqual(patched.call_count, 1)
+
+
+class LastSeenDataTests(ClientTestCase):
+    def test_save_should_record_the_earliest_remembered_activity(self):
+        data = models.LastSeenData.objects.get(user=self.user)
+        data.active_last_month = datetime.now() - timedelta(days=45)
+        data.active_this_month = datetime.now() - timedelta(days=10)
+        data.save()
+
+        self.assertEqual(data.earliest_activity, data.active_last_month)
+
+    def test_save_should_fall_back_to_last_seen(self):
+        data = models.LastSeenData.objects.get(user=self.user)
+        self.assertIsNotNone(data.earliest_activity)
+        self.assertTrue(data.earliest_activity <= data.last_seen)
+
+
+class UserAccountsTests(TestCase):
+    populate_migration = 'zesty_metrics.migrations.0002_lastseendata_earliest_activity'
+
+    def seen(self, username, last_seen, active_this_month=None,
+             active_last_month=None):
+        ago = lambda days: None if days is None else datetime.now() - timedelta(days=days)
+        user = User.objects.create(username=username)
+        models.LastSeenData.objects.filter(user=user).update(
+            last_seen = ago(last_seen),
+            active_this_month = ago(active_this_month),
+            active_last_month = ago(active_last_month),
+        )
+
+    def setUp(self):
+        super(UserAccountsTests, self).setUp()
+        self.seen('churned', 45, 45)
+        self.seen('returning', 10, 10, 45)
+        self.seen('new', 5, 5)
+        self.seen('gone', 90, 90)
+        # Rows written with .update() skip save(), as pre-existing rows
+        # did; the data migration is what backfills them.
+        migration = import_module(self.populate_migration)
+        migration.populate_earliest_activity(apps, None)
+        cache.clear()
+        self.tracker = tracking.UserAccounts()
+
+    def test_last_month_users(self):
+        self.assertEqual(
+            sorted(self.tracker.last_month_users.values_list('user__username', flat=True)),
+            ['churned', 'returning'])
+
+    def test_returning_users(self):
+        self.assertEqual(
+            list(self.tracker.returning_users.values_list('user__username', flat=True)),
+            ['returning'])
+
+    def test_churned_users(self):
+        self.assertEqual(
+            list(self.tracker.churned_users.values_list('user__username', flat=True)),
+            ['churned'])
+
+    def test_evaluate_should_compute_derived_rates(self):
+        values = self.tracker.evaluate(['user_duration_average',
+                                        'retention_rate', 'churn_rate'])
+        self.assertEqual(values, {
+            'retention_rate': 0.5,
+            'churn_rate': 0.5,
+            'user_duration_average': 2.0,
+        })
+
+    def test_evaluate_should_report_every_gauge(self):
+        values = self.tracker.evaluate(list(self.tracker.gauges))
+        self.assertEqual(set(values), set(self.tracker.gauges))
+
+
+class GraphTracker(tracking.Tracker):
+    def __init__(self):
+        self.calls = []
+
+    @tracking.Tracker.metric
+    def a(self):
+        self.calls.append('a')
+        return 2
+
+    @tracking.Tracker.metric
+    def b(self):
+        self.calls.append('b')
+        return 3
+
+    @tracking.Tracker.metric('a', 'b')
+    def c(self, a, b):
+        self.calls.append('c')
+        return a * b
+
+    @tracking.Tracker.metric('c', 'a')
+    def d(self, c, a):
+        self.calls.append('d')
+        return c + a
+
+    @tracking.Tracker.metric
+    def broken(self):
+        self.calls.append('broken')
+        raise ValueError('nope')
+
+    @tracking.Tracker.metric('broken', 'a')
+    def e(self, broken, a):
+        self.calls.append('e')
+        return a
+
+
+class TrackerGraphTests(TestCase):
+    def test_metric_graph_should_map_metrics_to_dependencies(self):
+        graph = GraphTracker.metric_graph()
+        self.assertEqual(graph['d'], ('c', 'a'))
+        self.assertEqual(graph['a'], ())
+
+    def test_metric_graph_should_reject_cycles(self):
+        class CyclicTracker(tracking.Tracker):
+            @tracking.Tracker.metric('y')
+            def x(self, y):
+                return y
+
+            @tracking.Tracker.metric('x')
+            def y(self, x):
+                return x
+
+        self.assertRaises(exceptions.ImproperlyConfigured,
+                          CyclicTracker.metric_graph)
+
+    def test_evaluate_should_compute_each_metric_once(self):
+        tracker = GraphTracker()
+        self.assertEqual(tracker.evaluate(['c', 'd']), {'c': 6, 'd': 8})
+        self.assertEqual(sorted(tracker.calls), ['a', 'b', 'c', 'd'])
+
+    def test_evaluate_should_run_concurrently(self):
+        tracker = GraphTracker()
+        self.assertEqual(tracker.evaluate(['d'], concurrency=4), {'d': 8})
+        self.assertEqual(sorted(tracker.calls), ['a', 'b', 'c', 'd'])
+
+    def test_evaluate_should_skip_metrics_whose_inputs_failed(self):
+        tracker = GraphTracker()
+        self.assertEqual(tracker.evaluate(['e', 'c']), {'c': 6})
+        self.assertNotIn('e', tracker.calls)
+
+    def test_attribute_access_should_reuse_evaluated_values(self):
+        tracker = GraphTracker()
+        tracker.evaluate(['c'])
+        self.assertEqual(tracker.d, 8)
+        self.assertEqual(sorted(tracker.calls), ['a', 'b', 'c', 'd'])
+
+
+class ClientsTests(TestCase):
+    def tearDown(self):
+        clients.reset()
+        super(ClientsTests, self).tearDown()
+
+    def test_get_client_should_reuse_one_client_per_process(self):
+        self.assertIs(clients.get_client(), clients.get_client())
+
+    def test_reset_should_drop_the_client(self):
+        client = clients.get_client()
+        clients.reset()
+        self.assertIsNot(clients.get_client(), client)
+
+    def test_get_client_should_recreate_the_client_in_a_forked_child(self):
+        client = clients.get_client()
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(clients.get_client(), client)
+
+    def test_local_statsd_should_create_its_pipeline_on_first_use(self):
+        scope = middleware.LocalStatsd()
+        self.assertNotIn('pipeline', scope.__dict__)
+        pipeline = scope.pipeline
+        self.assertIs(scope.pipeline, pipeline)
+        self.assertIs(scope.client, clients.get_client())
+
+    def test_reset_should_clear_the_middleware_scope(self):
+        middleware.MetricsMiddleware.scope.pipeline
+        clients.reset()
+        self.assertNotIn('pipeline', middleware.MetricsMiddleware.scope.__dict__)
+
+
+class BulkUserImportTests(TestCase):
+    def test_it_should_defer_new_user_work_to_the_end_of_the_block(self):
+        with patch('zesty_metrics.signals.get_client') as get_client:
+            with zesty_metrics.bulk_user_import():
+                for i in range(3):
+                    User.objects.create(username='user%s' % i)
+                self.assertEqual(models.LastSeenData.objects.count(), 0)
+                self.assertFalse(get_client.called)
+
+        self.assertEqual(models.LastSeenData.objects.count(), 3)
+        get_client.return_value.incr.assert_called_once_with('users.new', 3)
+
+    def test_nested_blocks_should_join_the_outer_block(self):
+        with patch('zesty_metrics.signals.get_client') as get_client:
+            with zesty_metrics.bulk_user_import():
+                User.objects.create(username='outer')
+                with zesty_metrics.bulk_user_import():
+                    User.objects.create(username='inner')
+                self.assertEqual(models.LastSeenData.objects.count(), 0)
+
+        get_client.return_value.incr.assert_called_once_with('users.new', 2)
+
+    def test_it_should_record_nothing_if_the_block_raises(self):
+        with patch('zesty_metrics.signals.get_client') as get_client:
+            try:
+                with zesty_metrics.bulk_user_import():
+                    User.objects.create(username='fred')
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        self.assertEqual(models.LastSeenData.objects.count(), 0)
+        self.assertFalse(get_client.called)
+
+    def test_users_created_outside_the_block_are_handled_immediately(self):
+        with patch('zesty_metrics.signals.get_client') as get_client:
+            User.objects.create(username='fred')
+        self.assertEqual(models.LastSeenData.objects.count(), 1)
+        get_client.return_value.incr.assert_called_once_with('users.new')
+
+
+class StatNameRegistryTests(TestCase):
+    def test_it_should_allow_everything_without_patterns(self):
+        names = registry.StatNameRegistry()
+        self.assertEqual(names.resolve('anything.at.all'), ('anything.at.all', None))
+
+    def test_it_should_match_shell_style_patterns(self):
+        names = registry.StatNameRegistry(patterns=['view.*', 'signup.?'])
+        self.assertTrue(names.allowed('view.foo.get'))
+        self.assertTrue(names.allowed('signup.a'))
+        self.assertFalse(names.allowed('signup.ab'))
+        self.assertFalse(names.allowed('viewxfoo'))
+        self.assertEqual(names.resolve('nope'), ('other', registry.StatNameRegistry.REJECTED))
+
+    def test_it_should_fold_new_names_beyond_the_limit(self):
+        names = registry.StatNameRegistry(limit=2)
+        self.assertEqual(names.resolve('a'), ('a', None))
+        self.assertEqual(names.resolve('b'), ('b', None))
+        self.assertEqual(names.resolve('c'), ('other', registry.StatNameRegistry.OVERFLOW))
+        self.assertEqual(names.resolve('a'), ('a', None))
+        self.assertEqual(len(names.seen), 2)
+
+    def test_it_should_start_a_new_budget_each_window(self):
+        names = registry.StatNameRegistry(limit=1, window=60)
+        names.resolve('a')
+        with patch('time.time', return_value=names.window_start + 61):
+            self.assertEqual(names.resolve('b'), ('b', None))
+
+
+class PrometheusTests(MockedStatsdTestCase):
+    def setUp(self):
+        super(PrometheusTests, self).setUp()
+        prometheus.registry.clear()
+        cache.delete(prometheus.TRACKER_GAUGES_KEY)
+        patcher = patch.object(conf, 'PROMETHEUS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self):
+        response = self.client.get('/metrics/prometheus')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8').splitlines()
+
+    def test_it_should_render_histograms_cumulatively(self):
+        registry = prometheus.Registry(buckets=[0.1, 1])
+        registry.observe('latency_seconds', 0.05, {'view': 'a'})
+        registry.observe('latency_seconds', 0.5, {'view': 'a'})
+        registry.observe('latency_seconds', 5, {'view': 'a'})
+        self.assertEqual(registry.render().splitlines(), [
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{view="a",le="0.1"} 1',
+            'latency_seconds_bucket{view="a",le="1.0"} 2',
+            'latency_seconds_bucket{view="a",le="+Inf"} 3',
+            'latency_seconds_sum{view="a"} 5.55',
+            'latency_seconds_count{view="a"} 3',
+        ])
+
+    def test_it_should_escape_label_values(self):
+        registry = prometheus.Registry()
+        registry.incr('things_total', labels={'name': 'a"b\\c'})
+        self.assertEqual(registry.render().splitlines()[1],
+                         'things_total{name="a\\"b\\\\c"} 1.0')
+
+    def test_it_should_expose_client_stats(self):
+        self.client.get('/metrics/incr/foo/', data={'count': 2})
+        self.client.get('/metrics/timing/bar/', data={'delta': 20})
+        lines = self.scrape()
+        self.assertIn('zesty_client_increments_total{stat="foo"} 2.0', lines)
+        self.assertIn('zesty_client_timing_seconds_bucket{stat="bar",le="0.025"} 1', lines)
+
+    def test_rum_timings_should_be_recorded_in_seconds(self):
+        cache.set('request:foo', {
+            'started': 5000,
+            'agent': parse_ua(CHROME_UA),
+            'view_name': 'view.app.home.get',
+        })
+        with patch('time.time', return_value=5002):
+            self.client.get('/metrics/report-request-rendered/foo/')
+        lines = self.scrape()
+        self.assertIn('zesty_client_timing_seconds_sum{stat="browsers.Chrome"} 2.0', lines)
+
+    def test_merged_registries_should_sum_counters_and_keep_the_latest_gauge(self):
+        a, b = prometheus.Registry(buckets=[1]), prometheus.Registry(buckets=[1])
+        a.incr('things_total', 2, {'view': 'x'})
+        b.incr('things_total', 3, {'view': 'x'})
+        b.observe('latency_seconds', 0.5)
+        a.gauge('level', 1)
+        b.gauge('level', 7)
+        merged = prometheus.Registry(buckets=[1])
+        for registry in (a, b):
+            merged.merge(json.loads(json.dumps(registry.dump())))
+        self.assertEqual(merged.render().splitlines(), [
+            '# TYPE things_total counter',
+            'things_total{view="x"} 5.0',
+            '# TYPE level gauge',
+            'level 7.0',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="1.0"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            'latency_seconds_sum 0.5',
+            'latency_seconds_count 1',
+        ])
+
+    def test_scrapes_should_merge_every_workers_metrics(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(prometheus.reset)
+        other = prometheus.Registry()
+        other.incr('zesty_client_increments_total', 5, {'stat': 'foo'})
+        prometheus.write(os.path.join(directory, '1.json'), other.dump())
+        prometheus.write(os.path.join(directory, '2.json'), other.dump())
+        alive = lambda pid: pid in (os.getpid(), 1)
+
+        with patch.object(conf, 'PROMETHEUS_DIR', directory), \
+                patch.object(prometheus, 'alive', alive):
+            self.client.get('/metrics/incr/foo/', data={'count': 2})
+            self.assertIn('zesty_client_increments_total{stat="foo"} 12.0', self.scrape())
+            # Worker 2 exited; its counts are kept in the archive.
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['.lock', '1.json', '%d.json' % os.getpid(), 'archive.json'])
+            self.assertIn('zesty_client_increments_total{stat="foo"} 12.0', self.scrape())
+
+    def test_it_should_serve_tracker_gauges_from_the_cache(self):
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch(pipeline_p):
+            report_metrics.Command().handle()
+        with patch('tests.trackers.TestTracker.foo') as foo:
+            lines = self.scrape()
+        self.assertFalse(foo.called)
+        self.assertIn('zesty_tracker{name="things.foo"} 5.0', lines)
+
+    def test_it_should_404_when_disabled(self):
+        with patch.object(conf, 'PROMETHEUS', False):
+            response = self.client.get('/metrics/prometheus')
+        self.assertEqual(response.status_code, 404)
+
+
+class SharedAggregatorTests(TestCase):
+    def setUp(self):
+        super(SharedAggregatorTests, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'metrics')
+        self.aggregators = []
+
+    def tearDown(self):
+        for aggregator in self.aggregators:
+            aggregator.close()
+        shutil.rmtree(self.tmp)
+        super(SharedAggregatorTests, self).tearDown()
+
+    def aggregator(self, slots=16, fallback=None):
+        aggregator = shared.SharedAggregator(self.path, slots, fallback)
+        self.aggregators.append(aggregator)
+        return aggregator
+
+    def test_workers_should_aggregate_into_the_same_slots(self):
+        worker1, worker2 = self.aggregator(), self.aggregator()
+        worker1.incr('view.requests')
+        worker2.incr('view.requests', 2)
+
+        self.assertEqual(worker1.drain(), [
+            ('view.requests', 3),
+        ])
+        self.assertEqual(worker2.drain(), [])
+
+    def test_it_should_fall_back_when_the_table_is_full(self):
+        fallback = Mock()
+        aggregator = self.aggregator(slots=1, fallback=fallback)
+        aggregator.incr('a')
+        aggregator.incr('b', 2)
+        fallback.incr.assert_called_once_with('b', 2, 1)
+        self.assertEqual(aggregator.drain(), [('a', 1)])
+
+    def test_it_should_not_truncate_long_names(self):
+        fallback = Mock()
+        aggregator = self.aggregator(fallback=fallback)
+        long_name = 'view.' + 'x' * shared.NAME_SIZE
+        aggregator.incr(long_name)
+        aggregator.incr(long_name[:shared.NAME_SIZE])
+        fallback.incr.assert_called_once_with(long_name, 1, 1)
+        self.assertEqual(aggregator.drain(), [
+            (long_name[:shared.NAME_SIZE], 1)])
+
+    def test_flush_should_send_host_totals(self):
+        aggregator = self.aggregator()
+        aggregator.incr('view.requests', 3)
+        client = Mock()
+        aggregator.flush(client)
+        pipeline = client.pipeline.return_value
+        pipeline.incr.assert_called_once_with('view.requests', 3)
+        pipeline.send.assert_called_once_with()
+
+    def test_only_one_worker_should_lead_until_it_goes_away(self):
+        worker1, worker2 = self.aggregator(), self.aggregator()
+        self.assertTrue(worker1.lead())
+        self.assertFalse(worker2.lead())
+        self.aggregators.remove(worker1)
+        worker1.close()
+        self.assertTrue(worker2.lead())
+
+    def test_middleware_should_record_view_metrics_in_the_shared_area(self):
+        aggregator = self.aggregator()
+        metrics = middleware.MetricsMiddleware()
+        self.addCleanup(metrics.scope.__dict__.clear)
+        metrics.scope.view_name = 'view.foo'
+        metrics.scope.request_start = 0
+        metrics.scope.pipeline = pipeline = Mock()
+        with patch.object(conf, 'SHARED_METRICS_PATH', self.path), \
+                patch.object(shared, 'get_aggregator', return_value=aggregator):
+            metrics.stop_timing(None)
+        names = sorted(name for name, count in aggregator.drain())
+        self.assertEqual(names, ['view.foo.requests', 'view.requests'])
+        # Timings keep their distribution: every value goes to StatsD.
+        self.assertEqual([c[1][0] for c in pipeline.timing.mock_calls],
+                         ['view.foo', 'view.aggregate-response-time'])
+
+
+class MetricSnapshotTests(TestCase):
+    tracker = 'tests.trackers.TestTracker'
+
+    def setUp(self):
+        super(MetricSnapshotTests, self).setUp()
+        self.start = datetime(2020, 1, 1)
+        for hour in range(48):
+            models.MetricSnapshot.objects.record(
+                self.tracker, {'foo': hour, 'label': 'not a number'},
+                timestamp=self.start + timedelta(hours=hour))
+
+    def test_record_should_store_numeric_values(self):
+        self.assertEqual(models.MetricSnapshot.objects.count(), 48)
+
+    def test_series_should_query_a_time_range(self):
+        series = models.MetricSnapshot.objects.series(
+            self.tracker, 'foo', self.start + timedelta(hours=10),
+            self.start + timedelta(hours=13))
+        self.assertEqual([s.value for s in series], [10, 11, 12])
+
+    def test_previous_should_return_the_latest_snapshot(self):
+        snapshots = models.MetricSnapshot.objects
+        self.assertEqual(snapshots.previous(self.tracker, 'foo').value, 47)
+        self.assertEqual(snapshots.previous(
+            self.tracker, 'foo', before=self.start + timedelta(hours=5)).value, 4)
+        self.assertIsNone(snapshots.previous(self.tracker, 'bar'))
+
+    def test_downsample_should_average_windows(self):
+        self.assertEqual(
+            models.MetricSnapshot.objects.downsample(self.tracker, 'foo', timedelta(days=1)),
+            [(self.start, 11.5), (self.start + timedelta(days=1), 35.5)])
+
+    def test_compact_should_replace_old_snapshots_with_averages(self):
+        models.MetricSnapshot.objects.compact(self.start + timedelta(days=1),
+                                              timedelta(days=1))
+        series = models.MetricSnapshot.objects.series(self.tracker, 'foo')
+        self.assertEqual(series.count(), 25)
+        self.assertEqual((series[0].timestamp, series[0].value), (self.start, 11.5))
+
+    def test_compact_should_only_compact_new_snapshots(self):
+        snapshots = models.MetricSnapshot.objects
+        snapshots.compact(self.start + timedelta(days=1), timedelta(days=1))
+        with patch.object(snapshots, 'bulk_create') as bulk_create:
+            snapshots.compact(self.start + timedelta(days=1), timedelta(days=1))
+        self.assertFalse(bulk_create.called)
+
+        snapshots.compact(self.start + timedelta(days=2), timedelta(days=1))
+        series = snapshots.series(self.tracker, 'foo')
+        self.assertEqual([(s.value, s.compacted) for s in series],
+                         [(11.5, True), (35.5, True)])
+
+    def test_snapshot_errors_should_not_stop_reporting(self):
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch(pipeline_p) as patched, \
+                patch.object(models.MetricSnapshot.objects, 'record',
+                             side_effect=OperationalError('no such table')):
+            report_metrics.Command().handle()
+        patched.gauge.assert_called_once_with('things.foo', 5)
+        patched.incr.assert_called_once_with('stuff.bar', 20)
+
+    def test_trackers_should_read_their_previous_values(self):
+        reporter = report_metrics.Command()
+        tracker = reporter._import_tracker(self.tracker)
+        self.assertEqual(tracker.previous('foo'), 47)
+
+    def test_report_metrics_should_record_snapshots(self):
+        pipeline_p = 'zesty_metrics.management.commands.report_metrics.Command.pipeline'
+        with patch(pipeline_p):
+            report_metrics.Command().handle()
+        latest = models.MetricSnapshot.objects.previous(self.tracker, 'bar')
+        self.assertEqual(latest.value, 20)
+
+
+class DailySignupCountTests(TestCase):
+    def setUp(self):
+        super(DailySignupCountTests, self).setUp()
+        cache.clear()
+        # Run commit hooks right away; the test transaction never commits.
+        patcher = patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.today = date.today()
+        self.counts = models.DailySignupCount.objects
+
+    def join(self, username, days_ago):
+        User.objects.create(username=username,
+                            date_joined=datetime.now() - timedelta(days=days_ago))
+
+    def test_signups_should_be_counted_per_day(self):
+        User.objects.create(username='fred')
+        User.objects.create(username='barney')
+        self.assertEqual(self.counts.counts(self.today, self.today), {self.today: 2})
+
+    def test_bulk_imports_should_be_counted_once_per_day(self):
+        with patch('zesty_metrics.signals.get_client'):
+            with zesty_metrics.bulk_user_import():
+                for i in range(3):
+                    User.objects.create(username='user%s' % i)
+        self.assertEqual(self.counts.get(day=self.today).count, 3)
+
+    def test_counters_should_not_be_locked_inside_the_signup_transaction(self):
+        with patch('django.db.transaction.on_commit') as on_commit:
+            with self.assertNumQueries(0):
+                self.counts.record(self.today, 2)
+        on_commit.call_args[0][0]()
+        self.assertEqual(self.counts.get(day=self.today).count, 2)
+
+    def test_counts_should_be_served_from_the_cache(self):
+        self.counts.record(self.today, 4)
+        self.counts.counts(self.today, self.today)
+        self.counts.all().delete()
+        self.assertEqual(self.counts.counts(self.today, self.today), {self.today: 4})
+
+    def test_window_should_prorate_the_first_day(self):
+        yesterday = self.today - timedelta(days=1)
+        self.counts.record(yesterday, 12)
+        self.counts.record(self.today, 3)
+        now = datetime.combine(self.today, datetime.min.time()) + timedelta(hours=6)
+        self.assertEqual(self.counts.window(now - timedelta(days=1), now), 12)
+
+    def test_reconcile_should_recount_from_the_user_table(self):
+        yesterday = self.today - timedelta(days=1)
+        self.join('fred', 0)
+        self.join('barney', 2)
+        self.counts.record(yesterday, 5)
+        self.counts.reconcile(self.today - timedelta(days=3))
+        counts = self.counts.counts(self.today - timedelta(days=3), yesterday)
+        self.assertEqual(counts[self.today - timedelta(days=2)], 1)
+        self.assertEqual(sum(counts.values()), 1)
+
+    def test_reconcile_should_leave_today_alone(self):
+        self.join('fred', 0)
+        self.counts.record(self.today, 5)
+        self.counts.reconcile(self.today - timedelta(days=3))
+        self.assertEqual(self.counts.counts(self.today, self.today), {self.today: 6})
+
+    def test_user_accounts_should_count_new_users_from_the_counters(self):
+        self.join('fred', 0)
+        self.join('barney', 10)
+        self.counts.reconcile(self.today - timedelta(days=31))
+        tracker = tracking.UserAccounts()
+        values = tracker.evaluate(['new_users_daily_count', 'new_users_monthly_count'])
+        self.assertEqual(values, {
+            'new_users_daily_count': 1,
+            'new_users_monthly_count': 2,
+        })
+
+
+class ReadDatabaseTests(TestCase):
+    def setUp(self):
+        super(ReadDatabaseTests, self).setUp()
+        patcher = patch.object(routing, 'connections')
+        self.connections = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.replica = self.connections.__getitem__.return_value
+
+    def test_it_should_read_from_the_default_database_by_default(self):
+        self.assertEqual(routing.read_database(), 'default')
+
+    def test_trackers_should_read_from_the_configured_database(self):
+        with patch.object(conf, 'READ_DB', 'replica'):
+            tracker = tracking.UserAccounts()
+            self.assertEqual(tracker.db, 'replica')
+            self.assertEqual(tracker.daily_active_users.db, 'replica')
+
+            tracker.read_db = 'other'
+            tracker.reset()
+            self.assertEqual(tracker.objects(User).all().db, 'other')
+
+    def test_it_should_fall_back_when_the_replica_is_unavailable(self):
+        self.replica.ensure_connection.side_effect = OperationalError()
+        self.assertEqual(routing.read_database('replica'), 'default')
+
+    def test_it_should_fall_back_when_the_replica_is_too_stale(self):
+        with patch.object(routing, 'replication_lag', return_value=120.0):
+            self.assertEqual(routing.read_database('replica', max_lag=300), 'replica')
+            self.assertEqual(routing.read_database('replica', max_lag=60), 'default')
+
+
+def slow_view(request):
+    return HttpResponse(b'zzz')
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        super(ProfilingTests, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for name, value in [('PROFILE_DIR', self.tmp), ('PROFILE_SAMPLE_RATE', 1),
+                            ('PROFILE_THRESHOLD', 1.0)]:
+            patcher = patch.object(conf, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def profile(self):
+        profiler = profiling.cProfile.Profile()
+        profiler.enable()
+        sorted(range(10))
+        profiler.disable()
+        return profiler
+
+    def test_store_should_keep_a_bounded_ring_indexed_by_view(self):
+        store = profiling.ProfileStore(self.tmp, keep=2)
+        for view_name in ('view.a', 'view.b', 'view.c'):
+            store.save(view_name, self.profile(), 1.5)
+
+        self.assertEqual([p['view'] for p in store.profiles()], ['view.c', 'view.b'])
+        self.assertEqual(store.profiles('view.c')[0]['file'], '0.prof')
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp) if f.endswith('.prof')),
+                         ['0.prof', '1.prof'])
+
+    def test_it_should_only_sample_matching_views(self):
+        with patch.object(conf, 'PROFILE_SAMPLE_RATE', 0):
+            self.assertIsNone(profiling.sample('view.foo'))
+        with patch.object(profiling, '_views', None), \
+                patch.object(conf, 'PROFILE_VIEWS', ['view.bar.*']):
+            self.assertIsNone(profiling.sample('view.foo.get'))
+            profiler = profiling.sample('view.bar.get')
+        profiler.disable()
+
+    def test_middleware_should_keep_profiles_of_slow_requests_only(self):
+        metrics = middleware.MetricsMiddleware()
+        self.addCleanup(metrics.scope.__dict__.clear)
+        request = RequestFactory().get('/')
+        store = profiling.ProfileStore(self.tmp)
+
+        for started in (time_module.time(), time_module.time() - 5):
+            metrics.process_request(request)
+            metrics.scope.request_start = started
+            metrics.process_view(request, slow_view, (), {})
+            metrics.process_response(request, slow_view(request))
+
+        profiles = store.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['view'], 'view.zesty_metrics.tests.slow_view.get')
+        self.assertTrue(profiles[0]['elapsed'] >= 5)
+
+
+class StackSamplerTests(TestCase):
+    def setUp(self):
+        super(StackSamplerTests, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.sampler = profiling.StackSampler(self.tmp, hz=100, max_stacks=2, keep=2)
+
+    def test_it_should_be_off_by_default(self):
+        self.assertIsNone(profiling.get_sampler())
+
+    def test_it_should_attribute_samples_to_the_active_view(self):
+        self.sampler.sample()
+        self.assertEqual(self.sampler.stacks, {})
+
+        self.sampler.enter('view.foo')
+        self.sampler.sample()
+        self.sampler.leave()
+        self.sampler.sample()
+
+        [(stack, count)] = self.sampler.stacks.items()
+        frames = stack.split(';')
+        self.assertEqual(frames[0], 'view.foo')
+        self.assertEqual(frames[-1], 'zesty_metrics.profiling.sample')
+        self.assertIn('zesty_metrics.tests.test_it_should_attribute_samples_to_the_active_view',
+                      frames)
+        self.assertEqual(count, 1)
+
+    def test_it_should_bound_the_number_of_stacks(self):
+        for view_name in ('view.a', 'view.b', 'view.c', 'view.d'):
+            self.sampler.enter(view_name)
+            self.sampler.sample()
+        self.assertEqual(sorted(stack for stack in self.sampler.stacks
+                                if stack.endswith('[other]')),
+                         ['view.c;[other]', 'view.d;[other]'])
+
+    def test_dump_should_write_collapsed_stacks(self):
+        self.sampler.stacks = {'view.foo;a.b;a.c': 3, 'view.bar;a.b': 1}
+        path = self.sampler.dump()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'view.bar;a.b 1\nview.foo;a.b;a.c 3\n')
+
+    def test_dump_should_start_a_new_interval(self):
+        for view_name in ('view.a', 'view.b', 'view.c'):
+            self.sampler.enter(view_name)
+            self.sampler.sample()
+        self.sampler.dump()
+        self.assertEqual(self.sampler.stacks, {})
+        self.assertIsNone(self.sampler.dump())
+
+        self.sampler.enter('view.d')
+        self.sampler.sample()
+        [stack] = self.sampler.stacks
+        self.assertTrue(stack.startswith('view.d;'))
+        self.assertFalse(stack.endswith('[other]'))
+
+    def test_dumps_should_be_kept_in_a_bounded_ring(self):
+        paths = []
+        for count in range(3):
+            self.sampler.stacks = {'view.foo;a.b': count + 1}
+            paths.append(self.sampler.dump())
+        self.assertEqual(paths[2], paths[0])
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp) if f.endswith('.collapsed')),
+                         ['stacks.0.collapsed', 'stacks.1.collapsed'])
+        with open(paths[2]) as f:
+            self.assertEqual(f.read(), 'view.foo;a.b 3\n')
+
+
+class BackgroundTests(TestCase):
+    def test_submit_should_run_inline_when_disabled(self):
+        func = Mock()
+        with patch.object(conf, 'BACKGROUND_WORKERS', 0):
+            background.submit(func, 1, key='value')
+        func.assert_called_once_with(1, key='value')
+
+    def test_middleware_should_send_the_request_pipeline_from_the_workers(self):
+        client = statsd.StatsClient()
+        client._send = Mock()
+        clients.reset()
+        self.addCleanup(clients.reset)
+        self.addCleanup(background.reset)
+        metrics = middleware.MetricsMiddleware()
+        with patch.object(conf, 'BACKGROUND_WORKERS', 1), \
+                patch.object(clients, 'get_client', return_value=client):
+            for i in range(3):
+                request = RequestFactory().get('/')
+                metrics.process_request(request)
+                request.statsd.incr('custom.thing')
+                metrics.process_response(request, HttpResponse(b'hello'))
+            background.get_executor().shutdown(5)
+
+        sent = '\n'.join(c[1][0] for c in client._send.mock_calls).split('\n')
+        self.assertEqual(sent.count('custom.thing:1|c'), 3)
+        self.assertEqual(sent.count('view.requests:1|c'), 3)
+        self.assertEqual(metrics.scope.__dict__.get('pipeline', Mock())._stats, [])
+
+    def test_executor_should_drop_and_count_tasks_when_full(self):
+        executor = background.Executor(1, 1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        func = Mock()
+        with patch.object(clients, 'get_client') as get_client:
+            self.assertTrue(executor.submit(block))
+            started.wait(5)
+            self.assertTrue(executor.submit(func, 'queued'))
+            self.assertFalse(executor.submit(func, 'dropped'))
+            release.set()
+            executor.shutdown(5)
+
+        func.assert_called_once_with('queued')
+        self.assertEqual(executor.dropped, 1)
+        get_client.return_value.incr.assert_called_once_with('background.dropped', 1)
+
+    def test_shutdown_should_drain_queued_tasks(self):
+        executor = background.Executor(2, 100)
+        done = []
+        for i in range(50):
+            executor.submit(done.append, i)
+        executor.shutdown(5)
+        self.assertEqual(sorted(done), list(range(50)))
+        self.assertFalse(any(thread.is_alive() for thread in executor.threads))
+
+        # Late tasks still run.
+        executor.submit(done.append, 50)
+        self.assertEqual(done[-1], 50)
+
+    def test_shutdown_should_give_up_on_stuck_workers(self):
+        executor = background.Executor(1, 1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        executor.submit(block)
+        started.wait(5)
+        executor.submit(Mock())
+        begun = time_module.time()
+        executor.shutdown(0.2)
+        self.assertTrue(time_module.time() - begun < 2)
+        release.set()
+
+    def test_executor_should_survive_failing_tasks(self):
+        executor = background.Executor(1, 10)
+        done = []
+        executor.submit(Mock(side_effect=ValueError))
+        executor.submit(done.append, 1)
+        executor.shutdown(5)
+        self.assertEqual(done, [1])
+
+
+class InstrumentedCacheTests(TestCase):
+    def setUp(self):
+        super(InstrumentedCacheTests, self).setUp()
+        cache.clear()
+        self.cache = caching.InstrumentedCache('default', {
+            'OPTIONS': {'PREFIXES': ['session_'], 'PREFIX_LIMIT': 3},
+        })
+        patcher = patch.object(caching.clients, 'get_pipeline')
+        self.pipeline = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_it_should_proxy_the_wrapped_cache(self):
+        self.cache.set('user:1', 'fred')
+        self.assertEqual(cache.get('user:1'), 'fred')
+        self.assertEqual(self.cache.get('user:1'), 'fred')
+        self.assertEqual(self.cache.get('user:2', 'nobody'), 'nobody')
+        self.assertEqual(self.cache.get_many(['user:1', 'user:2']), {'user:1': 'fred'})
+
+    def test_it_should_group_keys_by_prefix(self):
+        self.assertEqual(self.cache.prefix('zesty_metric_foo'), 'zesty_metric')
+        self.assertEqual(self.cache.prefix('session_abc'), 'session')
+        self.assertEqual(self.cache.prefix('user:1:name'), 'user')
+        self.assertEqual(self.cache.prefix('plain'), 'other')
+        self.assertEqual(self.cache.prefix('team:1'), 'other')
+
+    def test_flush_should_send_hits_misses_and_mean_times(self):
+        self.cache.set('user:1', 'fred')
+        self.cache.get('user:1')
+        self.cache.get('user:2')
+        self.cache.get_many(['user:1', 'user:3'])
+        self.cache.flush()
+
+        sent = dict((c[1][0], c[1][1]) for c in self.pipeline.incr.mock_calls)
+        self.assertEqual(sent['cache.default.user.hits'], 2)
+        self.assertEqual(sent['cache.default.user.misses'], 2)
+        self.assertEqual(sent['cache.default.user.get.calls'], 2)
+        self.assertEqual(sorted(c[1][0] for c in self.pipeline.timing.mock_calls),
+                         ['cache.default.user.get', 'cache.default.user.get_many',
+                          'cache.default.user.set'])
+        self.pipeline.send.assert_called_once_with()
+
+    def test_it_should_flush_periodically(self):
+        self.cache.get('user:1')
+        self.assertFalse(self.pipeline.send.called)
+        self.cache.next_flush = 0
+        self.cache.get('user:1')
+        self.pipeline.incr.assert_any_call('cache.default.user.misses', 2)
+
+
+class ActivityTrackerTests(TestCase):
+    def setUp(self):
+        super(ActivityTrackerTests, self).setUp()
+        cache.clear()
+        users = [User.objects.create(username='user%s' % i) for i in range(3)]
+        activity = [
+            (0, users[0], 'login'), (0, users[1], 'login'), (3, users[2], 'login'),
+            (10, users[0], 'login'), (0, users[0], 'export csv'),
+            (20, users[1], 'export csv'), (40, users[2], 'export csv'),
+            (5, users[2], 'upload'),
+        ]
+        for days, user, what in activity:
+            with patch_today(date.today() - timedelta(days=days)):
+                models.DailyActivityRecord.objects.create(user=user, what=what)
+        self.tracker = tracking.ActivityTracker()
+
+    def test_it_should_count_distinct_users_per_activity_and_window(self):
+        values = self.tracker.evaluate(list(self.tracker.gauges))
+        self.assertEqual(values, {
+            'daily_activity_users': {'login': 2, 'export_csv': 1, 'upload': 0},
+            'weekly_activity_users': {'login': 3, 'export_csv': 1, 'upload': 1},
+            'monthly_activity_users': {'login': 3, 'export_csv': 2, 'upload': 1},
+        })
+
+    def test_it_should_only_report_the_top_activities(self):
+        self.tracker.top = 2
+        values = self.tracker.evaluate(['weekly_activity_users'])
+        self.assertEqual(values, {'weekly_activity_users': {'login': 3, 'export_csv': 1}})
+
+    def test_report_metrics_should_send_a_gauge_per_activity(self):
+        reporter = report_metrics.Command()
+        with patch.object(report_metrics.Command, 'pipeline') as pipeline:
+            reporter._report(self.tracker, ['monthly_activity_users'])
+        self.assertEqual(sorted(pipeline.gauge.mock_calls), [
+            call('activity.export_csv.mau', 2),
+            call('activity.login.mau', 3),
+            call('activity.upload.mau', 1),
+        ])
+        snapshot = models.MetricSnapshot.objects.previous(
+            self.tracker.snapshot_name(), 'monthly_activity_users.login')
+        self.assertEqual(snapshot.value, 3)
+
+
+class SignupFunnel(tracking.FunnelTracker):
+    name = 'signup'
+    steps = ['signup_start', 'signup_complete', 'first_purchase']
+
+
+class FunnelTests(TestCase):
+    def setUp(self):
+        super(FunnelTests, self).setUp()
+        cache.clear()
+        self.day = date.today() - timedelta(days=10)
+        ann, bob, cat, dan = [User.objects.create(username=name)
+                              for name in ('ann', 'bob', 'cat', 'dan')]
+        activity = [
+            (ann, 'signup_start', 0), (ann, 'signup_complete', 0), (ann, 'first_purchase', 3),
+            (bob, 'signup_start', 0), (bob, 'signup_complete', 2), (bob, 'first_purchase', 1),
+            (cat, 'signup_start', 0), (cat, 'signup_complete', -1), (cat, 'first_purchase', 2),
+            # Outside the window:
+            (dan, 'signup_start', 0), (dan, 'signup_complete', 7),
+        ]
+        for user, what, days in activity:
+            with patch_today(self.day + timedelta(days=days)):
+                models.DailyActivityRecord.objects.create(user=user, what=what)
+        self.funnel = funnels.Funnel(SignupFunnel.steps, window=7)
+
+    def test_it_should_count_users_reaching_each_step_in_order(self):
+        self.assertEqual(self.funnel.compute(self.day), [4, 2, 1])
+        self.assertEqual(self.funnel.conversion(self.day, self.day), [0.5, 0.5])
+
+    def test_closed_days_should_be_computed_once(self):
+        today = date.today()
+        self.funnel.counts(self.day, today)
+        models.DailyActivityRecord.objects.all().delete()
+        counts = self.funnel.counts(self.day, today)
+        self.assertEqual(counts[self.day], [4, 2, 1])
+        self.assertEqual(counts[today], [0, 0, 0])
+
+    def test_tracker_should_report_closed_cohorts(self):
+        tracker = SignupFunnel()
+        values = tracker.evaluate(['step_users', 'step_conversion'])
+        self.assertEqual(values, {
+            'step_users': {
+                'signup.signup_start': 4,
+                'signup.signup_complete': 2,
+                'signup.first_purchase': 1,
+            },
+            'step_conversion': {
+                'signup.signup_complete': 0.5,
+                'signup.first_purchase': 0.5,
+            },
+        })
+
+
+class EngagementTrackerTests(TestCase):
+    def setUp(self):
+        super(EngagementTrackerTests, self).setUp()
+        cache.clear()
+        ann, bob, cat = [User.objects.create(username=name) for name in ('ann', 'bob', 'cat')]
+        activity = [
+            (ann, 0, 'login'), (ann, 0, 'upload'), (ann, 1, 'login'), (ann, 2, 'login'),
+            (bob, 0, 'login'), (bob, 10, 'login'),
+            (cat, 20, 'upload'), (cat, 40, 'login'),
+        ]
+        for user, days, what in activity:
+            with patch_today(date.today() - timedelta(days=days)):
+                models.DailyActivityRecord.objects.create(user=user, what=what)
+        self.tracker = tracking.EngagementTracker()
+
+    def test_it_should_count_users_per_number_of_active_days(self):
+        values = self.tracker.evaluate(['l7_histogram', 'l30_histogram'])
+        l7, l30 = values['l7_histogram'], values['l30_histogram']
+        self.assertEqual(len(l7), 7)
+        self.assertEqual(dict((k, v) for k, v in l7.items() if v), {'1': 1, '3': 1})
+        self.assertEqual(len(l30), 30)
+        self.assertEqual(dict((k, v) for k, v in l30.items() if v), {'1': 1, '2': 1, '3': 1})
+
+    def test_it_should_only_count_the_configured_activities(self):
+        self.tracker.activities = ['upload']
+        self.assertEqual(dict((k, v) for k, v in self.tracker.histogram(30).items() if v),
+                         {'1': 2})
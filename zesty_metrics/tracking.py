@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 import datetime as dt
+import logging
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 
+from django.core import exceptions
 from django.core.cache import cache
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import connections
+from django.db.models import Count
 
+from . import conf
+from . import funnels
 from . import models
+from . import routing
+from .registry import stat_name
+
+logger = logging.getLogger('metrics')
 
 
 def cache_metric(func_or_expiration):
@@ -31,12 +41,12 @@ def cache_metric(func_or_expiration):
         cache_key = 'zesty_metric_%s' % func.__name__
 
         @wraps(func)
-        def wrapper(self):
+        def wrapper(self, *args):
             local_key = '_' + cache_key
             if not hasattr(self, local_key):
                 result = cache.get(cache_key, None)
                 if result is None:
-                    result = func(self)
+                    result = func(self, *args)
                     cache.set(cache_key, result, expiration)
                 setattr(self, local_key, result)
 
@@ -50,11 +60,228 @@ def cache_metric(func_or_expiration):
         return decorator
 
 
+class metric(object):
+    """Declare a tracker metric and the metrics it is derived from.
+
+    The decorated method receives the values of its dependencies, in
+    order. Accessing the metric as an attribute computes it (and its
+    dependencies) once per tracker instance.
+
+    Usage::
+
+        class PhilosophyTracker(Tracker):
+            @Tracker.metric
+            @Tracker.cache_metric
+            def answer(self):
+                return 42
+
+            @Tracker.metric('answer')
+            def question(self, answer):
+                return answer / 6.0
+    """
+    def __init__(self, *depends_on):
+        self.func = None
+        if len(depends_on) == 1 and callable(depends_on[0]):
+            self.depends_on = ()
+            self(depends_on[0])
+        else:
+            self.depends_on = depends_on
+
+    def __call__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        return self
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        values = instance.__dict__.setdefault('_metric_values', {})
+        if self.name not in values:
+            args = [getattr(instance, name) for name in self.depends_on]
+            values[self.name] = self.func(instance, *args)
+        return values[self.name]
+
+
 class Tracker(object):
     gauges = {}
     counters = {}
 
+    # Map metric attributes to seconds between reports in
+    # ``report_metrics --daemon``; others use ``ZESTY_REPORT_INTERVAL``.
+    intervals = {}
+
+    # Number of threads used to evaluate independent metrics; ``None``
+    # means ``ZESTY_TRACKER_CONCURRENCY``.
+    concurrency = None
+
+    # Database alias to run this tracker's queries on; ``None`` means
+    # ``ZESTY_READ_DB``. See ``routing.read_database``.
+    read_db = None
+
     cache_metric = staticmethod(cache_metric)
+    metric = staticmethod(metric)
+
+    @classmethod
+    def snapshot_name(cls):
+        """Name this tracker's values are stored under in ``MetricSnapshot``.
+        """
+        return '%s.%s' % (cls.__module__, cls.__name__)
+
+    def previous(self, metric, before=None):
+        """The value last reported for ``metric`` (before ``before``), or None.
+
+        Lets metrics be computed as deltas from the previous run instead
+        of rescanning.
+        """
+        snapshot = models.MetricSnapshot.objects.previous(
+            self.snapshot_name(), metric, before)
+        return None if snapshot is None else snapshot.value
+
+    @property
+    def db(self):
+        """Alias of the database to read from; chosen once per run.
+        """
+        if '_db' not in self.__dict__:
+            self.__dict__['_db'] = routing.read_database(self.read_db)
+        return self.__dict__['_db']
+
+    def objects(self, model):
+        """``model``'s default manager, reading from ``self.db``.
+        """
+        return model._default_manager.db_manager(self.db)
+
+    def reset(self):
+        """Forget locally cached metric values, so the next access recomputes.
+        """
+        for key in list(self.__dict__):
+            if key in ('_metric_values', '_db') or key.startswith('_zesty_metric_'):
+                del self.__dict__[key]
+
+    @classmethod
+    def metric_graph(cls):
+        """Map each declared metric on this class to its dependencies.
+
+        Built once per class; raises ``ImproperlyConfigured`` on cycles.
+        """
+        if '_metric_graph' not in cls.__dict__:
+            graph = {}
+            for name in dir(cls):
+                attr = getattr(cls, name, None)
+                if isinstance(attr, metric):
+                    graph[name] = attr.depends_on
+
+            visiting, done = set(), set()
+
+            def visit(name):
+                if name in done:
+                    return
+                if name in visiting:
+                    raise exceptions.ImproperlyConfigured(
+                        'Metric dependency cycle on %s.%s' % (cls.__name__, name))
+                visiting.add(name)
+                for dep in graph.get(name, ()):
+                    visit(dep)
+                visiting.discard(name)
+                done.add(name)
+
+            for name in graph:
+                visit(name)
+            cls._metric_graph = graph
+        return cls._metric_graph
+
+    def _metric_levels(self, names):
+        """Group the metrics needed for ``names`` into dependency levels.
+
+        Every metric in a level depends only on metrics in earlier levels.
+        """
+        graph = self.metric_graph()
+        depth = {}
+
+        def visit(name):
+            if name not in depth:
+                deps = graph.get(name, ())
+                depth[name] = 1 + max([visit(dep) for dep in deps] or [-1])
+            return depth[name]
+
+        for name in names:
+            visit(name)
+        levels = [[] for i in range(max(depth.values() or [-1]) + 1)]
+        for name, level in sorted(depth.items()):
+            levels[level].append(name)
+        return levels
+
+    def _compute(self, name, values):
+        try:
+            attr = getattr(type(self), name, None)
+            if isinstance(attr, metric):
+                args = [values[dep] for dep in attr.depends_on]
+                value = attr.func(self, *args)
+            else:
+                value = getattr(self, name)
+                if callable(value):
+                    value = value()
+            return name, value, None
+        except Exception as e:
+            logger.exception('Error computing metric %s.%s',
+                             type(self).__name__, name)
+            return name, None, e
+
+    def _compute_in_thread(self, args):
+        try:
+            return self._compute(*args)
+        finally:
+            # Worker threads get their own connections; don't leak them.
+            for conn in connections.all():
+                conn.close()
+
+    def evaluate(self, names, concurrency=None):
+        """Compute the named metrics, each dependency exactly once.
+
+        Independent metrics are evaluated concurrently when
+        ``concurrency`` is greater than one. Metrics that fail, and
+        everything derived from them, are left out of the result.
+
+        Returns a dict mapping metric names to values.
+        """
+        if concurrency is None:
+            concurrency = self.concurrency or conf.TRACKER_CONCURRENCY
+        graph = self.metric_graph()
+        values = self.__dict__.setdefault('_metric_values', {})
+        failed = set()
+        pool = ThreadPool(concurrency) if concurrency > 1 else None
+        try:
+            for level in self._metric_levels(names):
+                runnable = []
+                for name in level:
+                    if name in values:
+                        continue
+                    broken = [dep for dep in graph.get(name, ()) if dep in failed]
+                    if broken:
+                        logger.warning('Skipping metric %s.%s: %s failed',
+                                       type(self).__name__, name,
+                                       ', '.join(broken))
+                        failed.add(name)
+                    else:
+                        runnable.append(name)
+
+                if pool is not None and len(runnable) > 1:
+                    results = pool.map(self._compute_in_thread,
+                                       [(name, values) for name in runnable])
+                else:
+                    results = [self._compute(name, values) for name in runnable]
+
+                for name, value, error in results:
+                    if error is None:
+                        values[name] = value
+                    else:
+                        failed.add(name)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return dict((name, values[name]) for name in names if name in values)
 
 
 class UserAccounts(Tracker):
@@ -73,6 +300,16 @@ class UserAccounts(Tracker):
         engagement_ratio = 'users.engagement_ratio',
     )
 
+    # The retention queries are heavy and move slowly.
+    intervals = dict(
+        last_month_users_count = 60 * 60,
+        returning_users_count = 60 * 60,
+        churned_users_count = 60 * 60,
+        retention_rate = 60 * 60,
+        churn_rate = 60 * 60,
+        user_duration_average = 60 * 60,
+    )
+
     @property
     def past_day(self):
         return dt.datetime.now() - dt.date.resolution
@@ -89,9 +326,9 @@ class UserAccounts(Tracker):
     def daily_active_users(self):
         """Query for users active in the past day.
         """
-        return models.LastSeenData.objects.filter(last_seen__gte=self.past_day)
+        return self.objects(models.LastSeenData).filter(last_seen__gte=self.past_day)
 
-    @property
+    @metric
     @cache_metric
     def daily_active_users_count(self):
         """Count of users active in the past day.
@@ -102,9 +339,9 @@ class UserAccounts(Tracker):
     def monthly_active_users(self):
         """Query for users active in the past 30 days.
         """
-        return models.LastSeenData.objects.filter(last_seen__gte=self.past_30_days)
+        return self.objects(models.LastSeenData).filter(last_seen__gte=self.past_30_days)
 
-    @property
+    @metric
     @cache_metric
     def monthly_active_users_count(self):
         """Count of users active in the past 30 days.
@@ -115,42 +352,42 @@ class UserAccounts(Tracker):
     def new_users_monthly(self):
         """Query of newly registered users in the past 30 days.
         """
-        return User.objects.filter(date_joined__gte=self.past_30_days)
+        return self.objects(User).filter(date_joined__gte=self.past_30_days)
 
     @property
     def new_users_daily(self):
         """Query of newly registered users in the past 24 hours.
         """
-        return User.objects.filter(date_joined__gte=self.past_day)
+        return self.objects(User).filter(date_joined__gte=self.past_day)
 
-    @property
-    @cache_metric
+    @metric
     def new_users_monthly_count(self):
         """Count of newly registered users in the past 30 days.
+
+        Summed from the daily signup counters, not counted in
+        ``auth_user``; see ``DailySignupCount.objects.reconcile``.
         """
-        return self.new_users_monthly.count()
+        return models.DailySignupCount.objects.window(self.past_30_days)
 
-    @property
-    @cache_metric
+    @metric
     def new_users_daily_count(self):
         """Count of newly registered users in the past 24 hours.
         """
-        return self.new_users_monthly.count()
+        return models.DailySignupCount.objects.window(self.past_day)
 
     @property
     def last_month_users(self):
         """Query for users who showed up last month.
         """
-        return models.LastSeenData.objects.filter(
-            (Q(last_seen__gte=self.past_60_days) \
-             | Q(active_this_month__gte=self.past_60_days) \
-             | Q(active_last_month__gte=self.past_60_days))
-            & (Q(last_seen__lt=self.past_30_days) \
-               | Q(active_this_month__lt=self.past_30_days) \
-               | Q(active_last_month__lt=self.past_30_days))
+        # ``last_seen`` is the latest and ``earliest_activity`` the
+        # earliest remembered activity, so both predicates are served
+        # by the (last_seen, earliest_activity) index.
+        return self.objects(models.LastSeenData).filter(
+            last_seen__gte=self.past_60_days,
+            earliest_activity__lt=self.past_30_days,
         )
 
-    @property
+    @metric
     @cache_metric
     def last_month_users_count(self):
         """Count of users who showed up 30-60 days ago.
@@ -165,7 +402,7 @@ class UserAccounts(Tracker):
             last_seen__gte=self.past_30_days
         )
 
-    @property
+    @metric
     @cache_metric
     def returning_users_count(self):
         """Count of users who showed up 30-60 days ago who also showed up in the past 30 days.
@@ -180,46 +417,207 @@ class UserAccounts(Tracker):
             last_seen__lte=self.past_30_days,
         )
 
-    @property
+    @metric
     @cache_metric
     def churned_users_count(self):
         """Count of users who showed up 30-60 days ago who have not shown up in the past 30 days.
         """
         return self.churned_users.count()
 
-    @property
-    @cache_metric
-    def retention_rate(self):
+    @metric('returning_users_count', 'last_month_users_count')
+    def retention_rate(self, returning_users_count, last_month_users_count):
         """The percentage of users who showed up last month who also showed up this month.
         """
         try:
-            return float(self.returning_users_count) / self.last_month_users_count
+            return float(returning_users_count) / last_month_users_count
         except ZeroDivisionError:
             return 0.0
 
-    @property
-    @cache_metric
-    def churn_rate(self):
+    @metric('retention_rate')
+    def churn_rate(self, retention_rate):
         """1 - retention rate; the percentage of users who showed up last month who did not show up this month.
         """
-        return 1 - self.retention_rate
+        return 1 - retention_rate
 
-    @property
-    @cache_metric
-    def user_duration_average(self):
+    @metric('churn_rate')
+    def user_duration_average(self, churn_rate):
         """Defined as 1 / churn; the number of months the average customer attends.
         """
         try:
-            return 1 / self.churn_rate
+            return 1 / churn_rate
         except ZeroDivisionError:
             return 0.0
 
-    @property
-    @cache_metric
-    def engagement_ratio(self):
+    @metric('daily_active_users_count', 'monthly_active_users_count')
+    def engagement_ratio(self, daily_active_users_count, monthly_active_users_count):
         """How good are we at driving retention?
         """
         try:
-            return self.daily_active_users_count / float(self.monthly_active_users_count)
+            return daily_active_users_count / float(monthly_active_users_count)
         except ZeroDivisionError:
             return 0.0
+
+
+class ActivityTracker(Tracker):
+    """Distinct users per ``DailyActivityRecord.what``, per day, week and month.
+
+    Each window is one ``GROUP BY what`` query. Only the ``top``
+    activities with the most monthly users are reported; ``None`` means
+    ``ZESTY_ACTIVITY_TOP``. Windows are calendar days up to and
+    including today.
+    """
+    gauges = dict(
+        daily_activity_users = 'activity.%s.dau',
+        weekly_activity_users = 'activity.%s.wau',
+        monthly_activity_users = 'activity.%s.mau',
+    )
+
+    top = None
+
+    def activity_users(self, days, activities=None):
+        """Map each activity to its distinct users in the past ``days`` days.
+        """
+        since = dt.date.today() - dt.timedelta(days=days - 1)
+        query = self.objects(models.DailyActivityRecord).filter(when__gte=since)
+        if activities is not None:
+            query = query.filter(what__in=activities)
+        rows = query.values('what').annotate(users=Count('user', distinct=True))
+        return dict((row['what'], row['users']) for row in rows)
+
+    def stats(self, users):
+        return dict((stat_name(what), count) for what, count in users.items())
+
+    def top_activity_users(self, days, top_activities):
+        """``activity_users`` for the top activities, ``0`` for those with
+        no users in the window, since gauges keep their last value.
+        """
+        users = dict((what, 0) for what in top_activities)
+        users.update(self.activity_users(days, list(top_activities)))
+        return self.stats(users)
+
+    @metric
+    def top_activities(self):
+        """Monthly users of the ``top`` activities with the most of them.
+        """
+        users = self.activity_users(30)
+        top = sorted(users, key=lambda what: (-users[what], what))
+        return dict((what, users[what]) for what in top[:self.top or conf.ACTIVITY_TOP])
+
+    @metric('top_activities')
+    def monthly_activity_users(self, top_activities):
+        """Distinct users per activity in the past 30 days.
+        """
+        return self.stats(top_activities)
+
+    @metric('top_activities')
+    def weekly_activity_users(self, top_activities):
+        """Distinct users per activity in the past 7 days.
+        """
+        return self.top_activity_users(7, top_activities)
+
+    @metric('top_activities')
+    def daily_activity_users(self, top_activities):
+        """Distinct users per activity today.
+        """
+        return self.top_activity_users(1, top_activities)
+
+
+class FunnelTracker(Tracker):
+    """Conversion through ``steps``, an ordered list of activities.
+
+    Subclass it for each funnel::
+
+        class SignupFunnel(FunnelTracker):
+            steps = ['signup_start', 'signup_complete', 'first_purchase']
+
+    Reports ``funnel.<name>.<step>.users`` and, for every step but the
+    first, ``funnel.<name>.<step>.conversion`` from the previous step,
+    over the cohorts of the last ``days`` days whose ``window`` is over.
+    ``name`` defaults to the class name.
+    """
+    gauges = dict(
+        step_users = 'funnel.%s.users',
+        step_conversion = 'funnel.%s.conversion',
+    )
+
+    steps = ()
+    name = None
+    window = 7
+    days = 30
+
+    @property
+    def funnel(self):
+        return funnels.Funnel(self.steps, self.window, using=self.db)
+
+    def step_stats(self, values, steps):
+        name = stat_name(self.name or type(self).__name__)
+        return dict(('%s.%s' % (name, stat_name(step)), value)
+                    for step, value in zip(steps, values))
+
+    @metric
+    def step_totals(self):
+        """Users reaching each step, over the reported cohorts.
+        """
+        end = dt.date.today() - dt.timedelta(days=self.window)
+        start = end - dt.timedelta(days=self.days - 1)
+        return self.funnel.totals(start, end)
+
+    @metric('step_totals')
+    def step_users(self, step_totals):
+        return self.step_stats(step_totals, self.steps)
+
+    @metric('step_totals')
+    def step_conversion(self, step_totals):
+        return self.step_stats(funnels.conversion(step_totals), self.steps[1:])
+
+
+class EngagementTracker(Tracker):
+    """How many days users were active in the last 7 and 30 days.
+
+    Reports ``engagement.l7.<days>`` and ``engagement.l30.<days>``: the
+    number of users active on exactly that many of the days, from
+    ``DailyActivityRecord``. Set ``activities`` to count only some
+    ``what`` values. Windows are calendar days up to and including
+    today.
+    """
+    gauges = dict(
+        l7_histogram = 'engagement.l7.%s',
+        l30_histogram = 'engagement.l30.%s',
+    )
+
+    activities = None
+
+    def histogram(self, days):
+        """Map ``1..days`` to the number of users active on that many days.
+
+        Days per user, then users per day count, in one query; only
+        the ``days`` buckets come back from the database.
+        """
+        since = dt.date.today() - dt.timedelta(days=days - 1)
+        records = self.objects(models.DailyActivityRecord).filter(when__gte=since)
+        if self.activities is not None:
+            records = records.filter(what__in=self.activities)
+        per_user = records.order_by().values('user').annotate(
+            active_days=Count('when', distinct=True)).values('active_days')
+        connection = connections[self.db]
+        sql, params = per_user.query.get_compiler(connection=connection).as_sql()
+        histogram = dict((str(n), 0) for n in range(1, days + 1))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT active_days, COUNT(*) FROM (%s) per_user GROUP BY active_days' % sql,
+                params)
+            for active_days, users in cursor.fetchall():
+                histogram[str(active_days)] = users
+        return histogram
+
+    @metric
+    def l7_histogram(self):
+        """Users per number of active days in the last 7 days.
+        """
+        return self.histogram(7)
+
+    @metric
+    def l30_histogram(self):
+        """Users per number of active days in the last 30 days.
+        """
+        return self.histogram(30)
@@ -1,14 +1,28 @@
 from django.conf.urls import url
 from django.views.decorators.csrf import csrf_exempt
 
+from . import conf
 from . import views
 
 
+if conf.FAST_BEACONS:
+    from .beacons import beacon_view
+    beacon_patterns = [
+        url(r'^%s/(?P<stat>[^/]+)/?' % method, beacon_view, {'method': method},
+            name="metrics_%s" % method)
+        for method in ('incr', 'decr', 'timing', 'gauge')
+    ]
+else:
+    beacon_patterns = [
+        url(r'^incr/(?P<stat>[^/]+)/?', csrf_exempt(views.IncrView.as_view()), name="metrics_incr"),
+        url(r'^decr/(?P<stat>[^/]+)/?', csrf_exempt(views.DecrView.as_view()), name="metrics_decr"),
+        url(r'^timing/(?P<stat>[^/]+)/?', csrf_exempt(views.TimingView.as_view()), name="metrics_timing"),
+        url(r'^gauge/(?P<stat>[^/]+)/?', csrf_exempt(views.GaugeView.as_view()), name="metrics_gauge"),
+    ]
+
 urlpatterns = [
     url(r'^activity/(?P<what>[^/]+)/?', csrf_exempt(views.ActivityView.as_view()), name="metrics_activity"),
-    url(r'^incr/(?P<stat>[^/]+)/?', csrf_exempt(views.IncrView.as_view()), name="metrics_incr"),
-    url(r'^decr/(?P<stat>[^/]+)/?', csrf_exempt(views.DecrView.as_view()), name="metrics_decr"),
-    url(r'^timing/(?P<stat>[^/]+)/?', csrf_exempt(views.TimingView.as_view()), name="metrics_timing"),
-    url(r'^gauge/(?P<stat>[^/]+)/?', csrf_exempt(views.GaugeView.as_view()), name="metrics_gauge"),
+] + beacon_patterns + [
     url(r'^report-request-rendered/(?P<request_id>[^/]+)/?', csrf_exempt(views.RequestTimingReportView.as_view()), name="metrics_report_request_rendered"),
+    url(r'^prometheus/?$', views.PrometheusView.as_view(), name="metrics_prometheus"),
 ]
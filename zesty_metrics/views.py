@@ -1,17 +1,19 @@
 # -*- coding: utf-8 -*-
 import time
 import json
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.views.generic import View
 from django.views.generic.edit import ProcessFormView, FormMixin
 from django.forms import Form
 from django.core.cache import cache
 
-import statsd
-
+from . import clients
 from . import conf
 from . import forms
 from . import models
+from . import prometheus
+from . import tagging
+from .registry import default_registry
 
 
 TRANSPARENT_1X1_PNG = (
@@ -47,6 +49,10 @@ class ActivityView(View):
 class StatView(ProcessFormView, FormMixin):
     http_method_names = ['get', 'post']
     stat_method = None
+    # Stat names come from clients; see ``registry.StatNameRegistry``.
+    registry = default_registry
+    # Unit of timings sent, for Prometheus.
+    timing_unit = 'ms'
 
     get = ProcessFormView.post
 
@@ -55,11 +61,7 @@ class StatView(ProcessFormView, FormMixin):
             return self.request.statsd
         except AttributeError:
             # We must not be using the Middleware.
-            return statsd.StatsClient(
-                host = conf.HOST,
-                port = conf.PORT,
-                prefix = conf.PREFIX,
-            )
+            return clients.get_client()
 
     def get_form_kwargs(self):
         kwargs = super(StatView, self).get_form_kwargs()
@@ -80,13 +82,25 @@ class StatView(ProcessFormView, FormMixin):
     def get_stat_data(self, form):
         return {self.kwargs['stat']: form.cleaned_data}
 
+    def get_tags(self):
+        """Tags for the stats sent, in tagged mode.
+        """
+        params = self.request.GET if self.request.method == 'GET' else self.request.POST
+        return tagging.client_tags(params.get('tags'))
+
     def send_stat(self, form):
         client = self.get_client()
         handler = getattr(client, self.stat_method)
         stat_data = self.get_stat_data(form)
         if stat_data is not None:
             for name, value in sorted(stat_data.items()):
-                handler(name, **value)
+                stat, folded = self.registry.resolve(
+                    name, tagging.tag_stat(name, self.get_tags()))
+                if folded is not None:
+                    client.incr('stats.' + folded)
+                    name = stat
+                handler(stat, **value)
+                prometheus.record_stat(self.stat_method, name, self.timing_unit, **value)
 
 
 class IncrView(StatView):
@@ -120,6 +134,8 @@ class GaugeView(StatView):
 class RequestTimingReportView(TimingView):
     form_class = Form
     stat_method = 'timing'
+    # ``delta`` is measured here, in seconds.
+    timing_unit = 's'
 
     def get_stat_data(self, form):
         now = time.time()
@@ -134,6 +150,10 @@ class RequestTimingReportView(TimingView):
 
             if agent is not None:
                 payload = {'delta': delta}
+                if conf.TAG_FORMAT:
+                    self.tags = tagging.view_tags(data['view_name'])
+                    self.tags['browser'] = agent.browser.family
+                    return {'view.client-time': payload}
                 names = [
                     "{data[view_name]}",
                     "{data[view_name]}.{ua.browser.family}",
@@ -144,3 +164,18 @@ class RequestTimingReportView(TimingView):
                     (name.format(ua=agent, data=data).replace(' ', '-'), payload)
                     for name in names
                 )
+
+    def get_tags(self):
+        return getattr(self, 'tags', {})
+
+
+class PrometheusView(View):
+    """Expose in-process metrics in the Prometheus text format.
+    """
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        if not conf.PROMETHEUS:
+            raise Http404
+        return HttpResponse(prometheus.render(),
+                            content_type="text/plain; version=0.0.4; charset=utf-8")